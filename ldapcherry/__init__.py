@@ -11,8 +11,12 @@ import sys
 import re
 import traceback
 import json
+import base64
 import logging
 import logging.handlers
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from operator import itemgetter
 from socket import error as socket_error
 
@@ -20,6 +24,8 @@ from ldapcherry.exceptions import *
 from ldapcherry.lclogging import *
 from ldapcherry.roles import Roles
 from ldapcherry.attributes import Attributes
+from ldapcherry.cache import TTLCache, SearchCache
+from ldapcherry.api import Api
 
 # Cherrypy http framework imports
 import cherrypy
@@ -34,11 +40,20 @@ from mako import exceptions
 if sys.version < '3':
     from sets import Set as set
     from urllib import quote_plus
+    from Queue import Queue, Empty
 else:
     from urllib.parse import quote_plus
+    from queue import Queue, Empty
 
 SESSION_KEY = '_cp_username'
 
+# placeholder of the rows in streamed search pages
+ROWS_MARKER = '<!-- ldapcherry search rows -->'
+
+# number of users of a streamed search completed at once
+# by the backends other than search.backend
+STREAM_BATCH = 20
+
 
 class LdapCherry(object):
 
@@ -75,14 +90,80 @@ class LdapCherry(object):
         else:
             raise MissingParameter(section, key)
 
+    def _dispatch(self, call, partial=False, backends=None):
+        """ Call a function for every backend concurrently
+        @function call: function taking the backend id as argument
+        @bool partial: if True, backends not answering before the deadline
+            are skipped, otherwise BackendTimeout is raised
+        @list backends: backends to call (default: all the backends)
+        @rtype: list of (<backend id>, <result>), in self.backends order
+        """
+        if backends is None:
+            backends = list(self.backends)
+        if not backends:
+            return []
+
+        # make the current request visible from the worker threads
+        request = cherrypy.serving.request
+        response = cherrypy.serving.response
+
+        def run(b):
+            cherrypy.serving.load(request, response)
+            try:
+                return call(b)
+            finally:
+                cherrypy.serving.clear()
+
+        futures = [(b, self.executor.submit(run, b)) for b in backends]
+        deadline = time.time() + self.backends_timeout
+        ret = []
+        for b, future in futures:
+            try:
+                res = future.result(max(0, deadline - time.time()))
+            except FutureTimeoutError:
+                if not partial:
+                    raise BackendTimeout(b, self.backends_timeout)
+                cherrypy.log.error(
+                    msg="backend '" + b + "' timed out, partial result",
+                    severity=logging.WARNING,
+                )
+                continue
+            ret.append((b, res))
+        return ret
+
+    def _notify_partial(self, results, backends=None):
+        """ Warn the user about backends missing in a partial result
+        @list results: result of _dispatch
+        @list backends: backends called (default: all the backends)
+        """
+        if backends is None:
+            backends = list(self.backends)
+        answered = [b for b, res in results]
+        for b in backends:
+            if b not in answered:
+                self._add_notification(
+                    'Backend "' + self.backends_display_names[b] +
+                    '" did not answer in time, results are incomplete'
+                    )
+
     def _get_groups(self, username):
         """ Get groups of a user
         @str username: name of the user
         @rtype: dict, format { '<backend>': [<list of groups>] }
         """
         ret = {}
+        missing = []
         for b in self.backends:
-            ret[b] = self.backends[b].get_groups(username)
+            groups = self.groups_cache.get((b, username))
+            if groups is None:
+                missing.append(b)
+            else:
+                ret[b] = groups
+        for b, groups in self._dispatch(
+                lambda b: self.backends[b].get_groups(username),
+                backends=missing):
+            self.groups_cache.set((b, username), groups)
+            ret[b] = groups
         cherrypy.log.error(
             msg="user '" + username + "' groups: " + str(ret),
             severity=logging.DEBUG,
@@ -95,22 +176,49 @@ class LdapCherry(object):
         @rtype: dict, format { 'roles': [<list of roles>],
             'unusedgroups': [<list of groups not matching roles>] }
         """
-        groups = self._get_groups(username)
-        user_roles = self.roles.get_roles(groups)
+        user_roles = self.roles_cache.get(username)
+        if user_roles is None:
+            groups = self._get_groups(username)
+            user_roles = self.roles.get_roles(groups)
+            self.roles_cache.set(username, user_roles)
         cherrypy.log.error(
             msg="user '" + username + "' roles: " + str(user_roles),
             severity=logging.DEBUG,
         )
         return user_roles
 
-    def _is_admin(self, username):
+    def _invalidate_user(self, username):
+        """ Drop the cached groups and roles of a user
+        @str username: name of the user
+        """
+        self.roles_cache.invalidate(username)
+        for b in self.backends:
+            self.groups_cache.invalidate((b, username))
+        # the user may appear in (or disappear from) any search
+        self.search_cache.clear()
+
+    def _is_admin(self, username, roles=None):
         """ Check if a user is an ldapcherry administrator
         @str username: name of the user
+        @dict roles: roles of the user (as returned by _get_roles)
+            if already computed
         @rtype: bool, True if administrator, False otherwise
         """
-        roles = self._get_roles(username)
+        if roles is None:
+            roles = self._get_roles(username)
         return self.roles.is_admin(roles['roles'])
 
+    def _auth_backends(self):
+        """ Get the backends in the order they must be tried
+        in 'or' authentication mode
+        @rtype: list of backends ids
+        """
+        ret = list(self.auth_backends_order)
+        for b in self.backends:
+            if b not in ret:
+                ret.append(b)
+        return ret
+
     def _check_backends(self):
         """ Check that every backend in roles and attributes
         is declared in main configuration
@@ -122,14 +230,26 @@ class LdapCherry(object):
         for b in self.attributes.get_backends():
             if b not in backends:
                 raise MissingBackend(b, 'attribute')
+        for b in self.auth_backends_order:
+            if b not in backends:
+                raise MissingBackend(b, 'auth.backends_order')
 
     def _init_backends(self, config):
         """ Init all backends
         @dict: configuration of ldapcherry
         """
+        old_backends = getattr(self, 'backends', {})
         self.backends_params = {}
         self.backends = {}
         self.backends_display_names = {}
+        # each cherrypy thread uses at most one connection
+        # per backend at a time, size connection pools accordingly
+        thread_pool = self._get_param(
+            'global',
+            'server.thread_pool',
+            config,
+            10,
+            )
         for entry in config['backends']:
             # split at the first dot
             backend, sep, param = entry.partition('.')
@@ -146,6 +266,8 @@ class LdapCherry(object):
                 self.backends_display_names[backend] = backend
                 self.backends_params[backend]['display_name'] = backend
             params = self.backends_params[backend]
+            if 'pool.max_size' not in params:
+                params['pool.max_size'] = thread_pool
             # Loading the backend module
             try:
                 module = params['module']
@@ -166,11 +288,112 @@ class LdapCherry(object):
                     attrslist,
                     key,
                     )
+                # searches only need the attributes they display
+                self.backends[backend].set_displayed_attrs(
+                    self.attributes.get_backend_displayed_attributes(backend)
+                    )
             except MissingParameter as e:
                 raise
             except Exception as e:
                 self._handle_exception(e)
                 raise BackendModuleInitFail(module)
+        # release the backends of the previous configuration (reload)
+        for backend in old_backends.values():
+            try:
+                backend.close()
+            except Exception as e:
+                self._handle_exception(e)
+
+    def _init_dispatcher(self, config):
+        """ Init the thread pool used to query the backends concurrently
+        @dict: configuration of ldapcherry
+        """
+        # by default, enough threads to have every cherrypy thread
+        # querying all the backends at the same time
+        thread_pool = self._get_param(
+            'global',
+            'server.thread_pool',
+            config,
+            10,
+            )
+        workers = self._get_param(
+            'parallel',
+            'parallel.workers',
+            config,
+            int(thread_pool) * max(1, len(self.backends)),
+            )
+        self.backends_timeout = float(self._get_param(
+            'parallel',
+            'parallel.timeout',
+            config,
+            10,
+            ))
+        old_executor = getattr(self, 'executor', None)
+        self.executor = ThreadPoolExecutor(max_workers=int(workers))
+        if old_executor is not None:
+            old_executor.shutdown(wait=False)
+
+    def _init_cache(self, config):
+        """ Init the caches of users groups and roles
+        @dict: configuration of ldapcherry
+        """
+        max_size = int(self._get_param(
+            'cache',
+            'cache.max_size',
+            config,
+            1000,
+            ))
+        ttl = int(self._get_param('cache', 'cache.ttl', config, 60))
+        # one entry per user and backend for groups
+        self.groups_cache = TTLCache(
+            max_size * max(1, len(self.backends)),
+            ttl,
+            )
+        self.roles_cache = TTLCache(max_size, ttl)
+
+    def _init_search(self, config):
+        """ Init the search parameters
+        @dict: configuration of ldapcherry
+        """
+        stream = self._get_param('search', 'search.stream', config, 'off')
+        if stream not in ['on', 'off']:
+            raise WrongParamValue(
+                'search.stream',
+                'search',
+                ['on', 'off'],
+                )
+        self.search_stream = stream == 'on'
+        # the paged searches list the users of this backend, the other
+        # backends complete their attributes (default: the first backend)
+        self.search_backend = self._get_param(
+            'search',
+            'search.backend',
+            config,
+            next(iter(self.backends), ''),
+            )
+        if self.backends and self.search_backend not in self.backends:
+            raise WrongParamValue(
+                'search.backend',
+                'search',
+                list(self.backends),
+                )
+        cache_max_size = int(self._get_param(
+            'search',
+            'search.cache_max_size',
+            config,
+            100,
+            ))
+        cache_ttl = int(self._get_param(
+            'search',
+            'search.cache_ttl',
+            config,
+            30,
+            ))
+        # one entry per search string and backend
+        self.search_cache = SearchCache(
+            cache_max_size * max(1, len(self.backends)),
+            cache_ttl,
+            )
 
     def _init_custom_js(self, config):
         self.custom_js = []
@@ -207,6 +430,16 @@ class LdapCherry(object):
         @dict: configuration of ldapcherry
         """
         self.auth_mode = self._get_param('auth', 'auth.mode', config)
+        # backends tried first in 'or' mode (comma separated list)
+        self.auth_backends_order = [
+            b for b in re.split(r'\s*,\s*', self._get_param(
+                'auth',
+                'auth.backends_order',
+                config,
+                '',
+                ).strip())
+            if b
+            ]
         if self.auth_mode in ['and', 'or', 'none']:
             pass
         elif self.auth_mode == 'custom':
@@ -346,13 +579,21 @@ class LdapCherry(object):
         if self.auth_mode == 'none':
             return {'connected': True, 'isadmin': True}
         elif self.auth_mode == 'and':
-            ret1 = True
-            for b in self.backends:
-                ret1 = self.backends[b].auth(user, password) and ret1
+            results = self._dispatch(
+                lambda b: self.backends[b].auth(user, password),
+                partial=True,
+                )
+            # a backend not answering cannot authenticate the user
+            ret1 = len(results) == len(self.backends)
+            for b, res in results:
+                ret1 = res and ret1
         elif self.auth_mode == 'or':
             ret1 = False
-            for b in self.backends:
-                ret1 = self.backends[b].auth(user, password) or ret1
+            # stop at the first backend accepting the credentials
+            for b in self._auth_backends():
+                if self.backends[b].auth(user, password):
+                    ret1 = True
+                    break
         elif self.auth_mode == 'custom':
             ret1 = self.auth.auth(user, password)
         else:
@@ -360,7 +601,8 @@ class LdapCherry(object):
         if not ret1:
             return {'connected': False, 'isadmin': False}
         else:
-            isadmin = self._is_admin(user)
+            roles = self._get_roles(user)
+            isadmin = self._is_admin(user, roles)
             return {'connected': True, 'isadmin': isadmin}
 
     def _load_templates(self, config):
@@ -438,6 +680,9 @@ class LdapCherry(object):
             )
             self._init_backends(config)
             self._check_backends()
+            self._init_dispatcher(config)
+            self._init_cache(config)
+            self._init_search(config)
 
             # loading the ppolicy
             self._init_ppolicy(config)
@@ -445,6 +690,9 @@ class LdapCherry(object):
             # loading custom javascript
             self._init_custom_js(config)
 
+            # json api, on /api/
+            self.api = Api(self)
+
             cherrypy.log.error(
                 msg="application started",
                 severity=logging.INFO
@@ -490,6 +738,37 @@ class LdapCherry(object):
                 if attrid not in attrs_out:
                     attrs_out[attrid] = attrs_backend[attr]
 
+    def _cached_search(self, b, searchstring):
+        """ get the results of a backend search from the search cache,
+        refining the results of a shorter search string if possible
+        @str b: backend
+        @str searchstring: search string
+        @rtype: dict, {<user>: {<attr>: <value>}}, None if not cached
+        """
+        # the attributes returned by a backend search are fixed,
+        # the backend identifies them
+        return self.search_cache.get_refined(
+            b,
+            searchstring,
+            self.backends[b].search_matcher(searchstring),
+            )
+
+    def _cache_search(self, b, searchstring, users, cookie):
+        """ store the results of the first page of a backend search
+        in the search cache, if it was also the last page
+        @str b: backend
+        @str searchstring: search string
+        @dict users: {<user>: {<attr>: <value>}}
+        @str cookie: cookie of the next page, None if there is none
+        """
+        if cookie is not None:
+            return
+        # results reaching the backend limit may be truncated
+        max_results = int(self.backends[b].get_param('search.max_results', 0))
+        if max_results and len(users) >= max_results:
+            return
+        self.search_cache.set_results(b, searchstring, users)
+
     def _search(self, searchstring):
         """ search users
         @str searchstring: search string
@@ -498,28 +777,239 @@ class LdapCherry(object):
         if searchstring is None:
             return {}
         ret = {}
-        for b in self.backends:
-            tmp = self.backends[b].search(searchstring)
+
+        def search(b):
+            users = self._cached_search(b, searchstring)
+            if users is None:
+                users = self.backends[b].search(searchstring)
+                self._cache_search(b, searchstring, users, None)
+            return users
+
+        results = self._dispatch(search, partial=True)
+        self._notify_partial(results)
+        for b, tmp in results:
             for u in tmp:
                 if u not in ret:
                     ret[u] = {}
                 self._merge_user_attrs(tmp[u], ret[u], b)
         return ret
 
-    def _get_user(self, username):
+    def _encode_page(self, cookie):
+        """ build the page token given in query strings
+        @str cookie: cookie of the page in search.backend
+        @rtype: string, None if there is no page left
+        """
+        if cookie is None:
+            return None
+        token = json.dumps(
+            {self.search_backend: cookie},
+            separators=(',', ':'),
+            )
+        token = base64.urlsafe_b64encode(token.encode('utf-8'))
+        return token.decode('ascii')
+
+    def _decode_page(self, page):
+        """ parse a page token
+        @str page: page token, None for the first page
+        @rtype: string, cookie of the page in search.backend,
+            None for the first page
+        """
+        if not page:
+            return None
+        try:
+            token = base64.urlsafe_b64decode(page.encode('ascii'))
+            cookies = json.loads(token.decode('utf-8'))
+            # token of another search.backend (configuration reload)
+            if list(cookies) != [self.search_backend]:
+                raise ValueError(page)
+            cookie = cookies[self.search_backend]
+            if not isinstance(cookie, type(u'')):
+                raise ValueError(page)
+        except (ValueError, TypeError, UnicodeError, AttributeError):
+            raise cherrypy.HTTPError(400, 'invalid page')
+        return cookie
+
+    def _complete_users(self, users, partial=True):
+        """ get the attributes of the users found by search.backend
+        in the other backends, and merge them
+        @dict users: {<user>: {<attr>: <value>}}, from search.backend
+        @bool partial: if True, backends not answering before the deadline
+            are skipped, otherwise BackendTimeout is raised
+        @rtype: tuple, ({<user>: {<attr>: <value>}}, <list of
+            (<backend id>, <users>) like _dispatch, with the backends
+            which answered in time>)
+        """
+        others = [b for b in self.backends if b != self.search_backend]
+        if users:
+            results = self._dispatch(
+                lambda b: self.backends[b].get_users(list(users)),
+                partial=partial,
+                backends=others,
+                )
+        else:
+            results = [(b, {}) for b in others]
+        results.append((self.search_backend, users))
+        answers = dict(results)
+        ret = {}
+        for u in users:
+            ret[u] = {}
+            # same precedence as _search(), in backends order
+            for b in self.backends:
+                if b in answers and u in answers[b]:
+                    self._merge_user_attrs(answers[b][u], ret[u], b)
+        return (ret, results)
+
+    def _search_page(self, searchstring, page=None, partial=True):
+        """ search users, one page at a time
+        (the users of search.backend, see _complete_users())
+        @str searchstring: search string
+        @str page: page token, None for the first page
+        @bool partial: if True, the users are not completed by the
+            backends not answering in time (the user is notified),
+            otherwise BackendTimeout is raised
+        @rtype: tuple, ({<user>: {<attr>: <value>}}, <next page token>)
+        """
+        cookie = self._decode_page(page)
+
+        def search_page(b):
+            if cookie is not None:
+                return self.backends[b].search_page(searchstring, cookie)
+            users = self._cached_search(b, searchstring)
+            if users is not None:
+                return (users, None)
+            users, next_cookie = self.backends[b].search_page(searchstring)
+            self._cache_search(b, searchstring, users, next_cookie)
+            return (users, next_cookie)
+
+        # the page is only made of the users of search.backend,
+        # no partial result
+        results = self._dispatch(search_page, backends=[self.search_backend])
+        users, next_cookie = results[0][1]
+        ret, results = self._complete_users(users, partial)
+        if partial:
+            self._notify_partial(results)
+        return (ret, self._encode_page(next_cookie))
+
+    def _search_stream(self, searchstring, page=None):
+        """ search users, one page at a time, yielding the users
+        of search.backend by batches of STREAM_BATCH users, as soon as
+        the other backends completed them (see _complete_users())
+        @str searchstring: search string
+        @str page: page token, None for the first page
+        @rtype: iterator of (<user>, {<attr>: <value>}), the last item is
+            (None, (<next page token>, <list of backends not answering>))
+        """
+        cookie = self._decode_page(page)
+        b = self.search_backend
+        queue = Queue()
+
+        # make the current request visible from the worker threads
+        request = cherrypy.serving.request
+        response = cherrypy.serving.response
+
+        def run():
+            cherrypy.serving.load(request, response)
+            try:
+                # first pages are cached, users are kept to fill the cache
+                first_page = cookie is None
+                users = None
+                if first_page:
+                    users = self._cached_search(b, searchstring)
+                if users is not None:
+                    for user in users:
+                        queue.put(('user', (user, users[user])))
+                    queue.put(('end', None))
+                    return
+                found = {}
+                users = self.backends[b].search_stream(searchstring, cookie)
+                for user, attrs in users:
+                    if user is None:
+                        if first_page:
+                            self._cache_search(b, searchstring, found, attrs)
+                        queue.put(('end', attrs))
+                    else:
+                        if first_page:
+                            found[user] = attrs
+                        queue.put(('user', (user, attrs)))
+            except Exception as e:
+                queue.put(('error', e))
+            finally:
+                cherrypy.serving.clear()
+
+        # the search is started right away, not at the first iteration
+        self.executor.submit(run)
+        deadline = time.time() + self.backends_timeout
+        return self._merge_stream(queue, page, deadline)
+
+    def _merge_stream(self, queue, page, deadline):
+        """ complete the users sent by the search of _search_stream
+        """
+        others = [b for b in self.backends if b != self.search_backend]
+        missing = set()
+        # the page is searched again if search.backend didn't answer
+        # in time (users of this page may then be listed twice)
+        next_page = page
+        batch = {}
+        done = False
+        while not done:
+            try:
+                kind, payload = queue.get(
+                    timeout=max(0, deadline - time.time())
+                    )
+            except Empty:
+                cherrypy.log.error(
+                    msg="backend '" + self.search_backend +
+                        "' timed out, partial result",
+                    severity=logging.WARNING,
+                )
+                missing.add(self.search_backend)
+                kind, payload = ('end', None)
+            if kind == 'error':
+                raise payload
+            if kind == 'user':
+                user, attrs = payload
+                batch[user] = attrs
+                if len(batch) < STREAM_BATCH and others:
+                    continue
+            else:
+                done = True
+                if self.search_backend not in missing:
+                    next_page = self._encode_page(payload)
+            if not batch:
+                continue
+            users, results = self._complete_users(batch)
+            batch = {}
+            answered = [b for b, res in results]
+            missing.update([b for b in others if b not in answered])
+            for user in users:
+                yield (user, users[user])
+
+        missing = [b for b in self.backends if b in missing]
+        yield (None, (next_page, missing))
+
+    def _get_user(self, username, partial=False):
         """ get user attributes
         @str username: user to get
+        @bool partial: if True, backends not answering in time are skipped
+            (read-only views only, the attributes are incomplete),
+            otherwise BackendTimeout is raised
         @rtype: dict, {<attr>: <value>}
         """
         if username is None:
             return {}
-        ret = {}
-        for b in self.backends:
+
+        def get_user(b):
             try:
-                tmp = self.backends[b].get_user(username)
+                return self.backends[b].get_user(username)
             except UserDoesntExist as e:
                 self._handle_exception(e)
-                tmp = {}
+                return {}
+
+        ret = {}
+        results = self._dispatch(get_user, partial=partial)
+        if partial:
+            self._notify_partial(results)
+        for b, tmp in results:
             self._merge_user_attrs(tmp, ret, b)
 
         cherrypy.log.error(
@@ -633,7 +1123,15 @@ class LdapCherry(object):
                     "You must be logged in to access this ressource.",
                     )
 
-    def _adduser(self, params):
+    def _adduser(self, params, notify=None):
+        """ add a user
+        @dict params: user attributes, roles and groups (see _parse_params)
+        @notify: function receiving the warnings,
+            defaults to the notifications of the session
+        @rtype: boolean, False if the user already exists
+        """
+        if notify is None:
+            notify = self._add_notification
         cherrypy.log.error(
             msg="add user form attributes: " + str(params),
             severity=logging.DEBUG
@@ -662,10 +1160,8 @@ class LdapCherry(object):
                 self.backends[b].add_user(badd[b])
                 added = True
             except UserAlreadyExists as e:
-                self._add_notification(
-                    'User already exists in backend "' + b + '"'
-                    )
-                return
+                notify('User already exists in backend "' + b + '"')
+                return False
         if not added:
             raise e
 
@@ -688,8 +1184,11 @@ class LdapCherry(object):
             if r in params['roles']:
                 roles.append(r)
         groups = self.roles.get_groups(roles)
-        for b in groups:
-            self.backends[b].add_to_groups(username, set(groups[b]))
+        try:
+            for b in groups:
+                self.backends[b].add_to_groups(username, set(groups[b]))
+        finally:
+            self._invalidate_user(username)
 
         cherrypy.log.error(
             msg="user '" + username + "' made member of " +
@@ -700,8 +1199,11 @@ class LdapCherry(object):
             msg="user '" + username + "' groups: " + str(groups),
             severity=logging.DEBUG
         )
+        return True
 
-    def _modify_attrs(self, params, attr_list, username):
+    def _modify_attrs(self, params, attr_list, username, notify=None):
+        if notify is None:
+            notify = self._add_notification
         badd = {}
         for attr in attr_list:
             if self.attributes.attributes[attr]['type'] == 'password':
@@ -727,9 +1229,7 @@ class LdapCherry(object):
             try:
                 self.backends[b].set_attrs(username, badd[b])
             except UserDoesntExist as e:
-                self._add_notification(
-                    'User does not exist in backend "' + b + '"'
-                    )
+                notify('User does not exist in backend "' + b + '"')
 
         return badd
 
@@ -740,11 +1240,15 @@ class LdapCherry(object):
         )
         sess = cherrypy.session
         username = sess.get(SESSION_KEY, None)
-        badd = self._modify_attrs(
-            params,
-            self.attributes.get_selfattributes(),
-            username,
-            )
+        try:
+            badd = self._modify_attrs(
+                params,
+                self.attributes.get_selfattributes(),
+                username,
+                )
+        finally:
+            # no stale attributes in the cached searches
+            self._invalidate_user(username)
         cherrypy.log.error(
             msg="user '" + username + "' modified his attributes",
             severity=logging.INFO
@@ -754,18 +1258,38 @@ class LdapCherry(object):
             severity=logging.DEBUG
         )
 
-    def _modify(self, params):
+    def _modify(self, params, notify=None, attrs=True, roles=True):
+        """ modify a user
+        @dict params: user attributes, roles and groups (see _parse_params)
+        @notify: function receiving the warnings,
+            defaults to the notifications of the session
+        @boolean attrs: modify the attributes of the user
+        @boolean roles: set the roles of the user (roles and groups
+            missing from params are removed)
+        """
         cherrypy.log.error(
             msg="modify user form attributes: " + str(params),
             severity=logging.DEBUG
         )
         key = self.attributes.get_key()
         username = params['attrs'][key]
-
+        # compute the changes against the current state of the backends,
+        # and make sure nothing stale remains cached after the changes
+        self._invalidate_user(username)
+        try:
+            if attrs:
+                self._modify_user(params, username, notify)
+            if roles:
+                self._modify_roles(params, username)
+        finally:
+            self._invalidate_user(username)
+
+    def _modify_user(self, params, username, notify=None):
         badd = self._modify_attrs(
             params,
             self.attributes.get_attributes(),
-            username
+            username,
+            notify,
             )
 
         sess = cherrypy.session
@@ -780,6 +1304,10 @@ class LdapCherry(object):
             severity=logging.DEBUG
         )
 
+    def _modify_roles(self, params, username):
+        sess = cherrypy.session
+        admin = sess.get(SESSION_KEY, 'unknown')
+
         tmp = self._get_roles(username)
         roles_current = tmp['roles']
         lonely_groups = tmp['unusedgroups']
@@ -857,7 +1385,7 @@ class LdapCherry(object):
         sess = cherrypy.session
         admin = sess.get(SESSION_KEY, 'unknown')
 
-        for b in self.backends:
+        def del_user(b):
             try:
                 self.backends[b].del_user(username)
             except UserDoesntExist as e:
@@ -871,6 +1399,11 @@ class LdapCherry(object):
                 severity=logging.DEBUG
             )
 
+        try:
+            self._dispatch(del_user)
+        finally:
+            self._invalidate_user(username)
+
         cherrypy.log.error(
             msg="User '" + username + "' deleted by '" + admin + "'",
             severity=logging.INFO
@@ -959,7 +1492,7 @@ class LdapCherry(object):
         if self.auth_mode == 'none':
             user_attrs = None
         else:
-            user_attrs = self._get_user(user)
+            user_attrs = self._get_user(user, partial=True)
         attrs_list = self.attributes.get_search_attributes()
         return self.temp['index.tmpl'].render(
             is_admin=is_admin,
@@ -968,25 +1501,105 @@ class LdapCherry(object):
             notifications=self._empty_notification(),
             )
 
+    def _render_search(self, tmpl, searchstring, page, is_admin):
+        """ render a search page
+        (the rows are streamed if search.stream is on)
+        """
+        attrs_list = self.attributes.get_search_attributes()
+        template = self.temp[tmpl]
+        params = {
+            'searchresult': {},
+            'searchstring': searchstring,
+            'page': page,
+            'next_page': None,
+            'attrs_list': attrs_list,
+            'is_admin': is_admin,
+            'custom_js': self.custom_js,
+            'notifications': self._empty_notification(),
+            'rows_marker': None,
+            }
+        if not self.search_stream:
+            res, params['next_page'] = self._search_page(searchstring, page)
+            params['searchresult'] = res
+            return template.render(**params)
+
+        users = self._search_stream(searchstring, page)
+        # render the page once with a placeholder for the rows
+        # to send its head right away
+        params['rows_marker'] = ROWS_MARKER
+        head = template.render(**params).split(ROWS_MARKER)[0]
+        row = template.get_def('user_row')
+        alert = template.get_def('alert_row')
+
+        def stream():
+            yield head
+            try:
+                for user, attrs in users:
+                    if user is not None:
+                        yield row.render(
+                            user=user,
+                            attrs=attrs,
+                            attrs_list=attrs_list,
+                            )
+                        continue
+                    params['next_page'], missing = attrs
+                    for b in missing:
+                        yield alert.render(
+                            message='Backend "' +
+                            self.backends_display_names[b] +
+                            '" did not answer in time,'
+                            ' results are incomplete',
+                            attrs_list=attrs_list,
+                            )
+            except Exception as e:
+                # headers are already sent, report the error in the page
+                self._handle_exception(e)
+                yield alert.render(
+                    message="An error occured, please check logs for details",
+                    attrs_list=attrs_list,
+                    )
+            # the tail holds the links to the next page, render it last
+            yield template.render(**params).split(ROWS_MARKER)[1]
+
+        cherrypy.response.stream = True
+        return stream()
+
     @cherrypy.expose
     @exception_decorator
-    def searchuser(self, searchstring=None):
+    def searchuser(self, searchstring=None, page=None):
         """ search user page """
         self._check_auth(must_admin=False)
         is_admin = self._check_admin()
         if searchstring is not None and len(searchstring) > 2:
-            res = self._search(searchstring)
-        else:
-            res = None
+            return self._render_search(
+                'searchuser.tmpl', searchstring, page, is_admin
+                )
         attrs_list = self.attributes.get_search_attributes()
         return self.temp['searchuser.tmpl'].render(
-            searchresult=res,
+            searchresult=None,
+            searchstring=searchstring,
+            page=None,
+            next_page=None,
             attrs_list=attrs_list,
             is_admin=is_admin,
             custom_js=self.custom_js,
             notifications=self._empty_notification(),
+            rows_marker=None,
             )
 
+    @cherrypy.expose
+    @exception_decorator
+    def stats(self):
+        """ cache statistics (json) """
+        self._check_auth(must_admin=True, redir_login=False)
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        ret = {
+            'search_cache': self.search_cache.stats(),
+            'groups_cache': self.groups_cache.stats(),
+            'roles_cache': self.roles_cache.stats(),
+            }
+        return json.dumps(ret, separators=(',', ':'), sort_keys=True)
+
     @cherrypy.expose
     @exception_decorator
     def checkppolicy(self, **params):
@@ -1007,21 +1620,25 @@ class LdapCherry(object):
 
     @cherrypy.expose
     @exception_decorator
-    def searchadmin(self, searchstring=None):
+    def searchadmin(self, searchstring=None, page=None):
         """ search user page """
         self._check_auth(must_admin=True)
         is_admin = self._check_admin()
         if searchstring is not None:
-            res = self._search(searchstring)
-        else:
-            res = None
+            return self._render_search(
+                'searchadmin.tmpl', searchstring, page, is_admin
+                )
         attrs_list = self.attributes.get_search_attributes()
         return self.temp['searchadmin.tmpl'].render(
-            searchresult=res,
+            searchresult=None,
+            searchstring=searchstring,
+            page=None,
+            next_page=None,
             attrs_list=attrs_list,
             is_admin=is_admin,
             custom_js=self.custom_js,
             notifications=self._empty_notification(),
+            rows_marker=None,
             )
 
     @cherrypy.expose
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+# vim:set expandtab tabstop=4 shiftwidth=4:
+#
+# The MIT License (MIT)
+# LdapCherry
+# Copyright (c) 2014 Carpentier Pierre-Francois
+
+# JSON api, mounted on /api/ by LdapCherry
+#
+# Every call is a POST with a json list in the body (a single item
+# is accepted too), every item is handled separately and gets its
+# own result:
+#   {"results": [{"status": "ok", ...}, {"status": "error",
+#                 "error": "<message>", ...}, ...]}
+# Users are described with the parameters of the html forms
+# (see LdapCherry._parse_params()):
+#   {"attr.uid": "jsmith", "attr.sn": "Smith", "role.users": "on",
+#    "group.ldap.cn=itpeople,ou=groups,dc=example,dc=org": "on"}
+
+import sys
+import cherrypy
+from ldapcherry.exceptions import MissingUserKey
+
+if sys.version < '3':
+    text_type = unicode
+else:
+    text_type = str
+
+
+def _api_call(func):
+    """common handling of api calls: administrators only, POST only,
+    json in and out"""
+    func = cherrypy.tools.json_out()(func)
+    func = cherrypy.tools.json_in()(func)
+    func = cherrypy.tools.allow(methods=['POST'])(func)
+    func.exposed = True
+    return func
+
+
+class ApiV1(object):
+    """version 1 of the api"""
+
+    def __init__(self, app):
+        """
+        @app: the LdapCherry instance
+        """
+        self.app = app
+
+    def _items(self):
+        """get the items of the request"""
+        body = cherrypy.request.json
+        if not isinstance(body, list):
+            body = [body]
+        return body
+
+    def _run(self, call, check):
+        """ run a call on each item of the request
+        @call: function taking an item, and returning its result (dict)
+        @check: function checking the type of an item
+        @rtype: dict, {'results': [<result of each item>]}
+        """
+        self.app._check_auth(must_admin=True, redir_login=False)
+        items = self._items()
+        for item in items:
+            if not check(item):
+                raise cherrypy.HTTPError(400, 'invalid item')
+        results = []
+        for item in items:
+            try:
+                ret = call(item)
+                ret.setdefault('status', 'ok')
+            except Exception as e:
+                self.app._handle_exception(e)
+                ret = {
+                    'status': 'error',
+                    'error': getattr(e, 'log', 'internal error'),
+                    }
+            results.append(ret)
+        return {'results': results}
+
+    @staticmethod
+    def _is_string(item):
+        return isinstance(item, text_type)
+
+    @staticmethod
+    def _is_form(item):
+        return isinstance(item, dict)
+
+    def _username(self, params):
+        key = self.app.attributes.get_key()
+        if key not in params['attrs']:
+            raise MissingUserKey()
+        return params['attrs'][key]
+
+    @_api_call
+    def get(self):
+        """ get users
+        items: usernames
+        results: {'user', 'attrs': {<attr>: <value>}, 'roles': [<roles>]}
+        """
+        def get(user):
+            attrs = self.app._get_user(user)
+            if attrs == {}:
+                return {
+                    'user': user,
+                    'status': 'error',
+                    'error': "user '" + user + "' does not exist",
+                    }
+            roles = sorted(self.app._get_roles(user)['roles'])
+            return {'user': user, 'attrs': attrs, 'roles': roles}
+        return self._run(get, self._is_string)
+
+    @_api_call
+    def search(self):
+        """ search users
+        items: search strings
+        results: {'searchstring', 'users': {<user>: {<attr>: <value>}}}
+        """
+        def search(searchstring):
+            users = self.app._search(searchstring)
+            return {'searchstring': searchstring, 'users': users}
+        return self._run(search, self._is_string)
+
+    @_api_call
+    def add(self):
+        """ add users
+        items: users (attributes, roles and groups)
+        results: {'user', 'warnings': [<messages>]}
+        """
+        def add(form):
+            params = self.app._parse_params(form)
+            user = self._username(params)
+            warnings = []
+            ret = {'user': user, 'warnings': warnings}
+            if not self.app._adduser(params, warnings.append):
+                ret['status'] = 'error'
+                ret['error'] = "user '" + user + "' already exists"
+            return ret
+        return self._run(add, self._is_form)
+
+    @_api_call
+    def modify(self):
+        """ modify users attributes (roles are left untouched)
+        items: users (key and modified attributes)
+        results: {'user', 'warnings': [<messages>]}
+        """
+        def modify(form):
+            params = self.app._parse_params(form)
+            user = self._username(params)
+            warnings = []
+            self.app._modify(params, warnings.append, roles=False)
+            return {'user': user, 'warnings': warnings}
+        return self._run(modify, self._is_form)
+
+    @_api_call
+    def setroles(self):
+        """ set users roles (roles and groups not listed are removed)
+        items: users (key, roles and groups)
+        results: {'user', 'roles': [<roles>]}
+        """
+        def setroles(form):
+            params = self.app._parse_params(form)
+            user = self._username(params)
+            self.app._modify(params, attrs=False)
+            roles = sorted(self.app._get_roles(user)['roles'])
+            return {'user': user, 'roles': roles}
+        return self._run(setroles, self._is_form)
+
+    @_api_call
+    def delete(self):
+        """ delete users
+        items: usernames
+        results: {'user'}
+        """
+        def delete(user):
+            self.app._deleteuser(user)
+            return {'user': user}
+        return self._run(delete, self._is_string)
+
+
+class Api(object):
+    """root of the api, one attribute per version"""
+
+    def __init__(self, app):
+        self.v1 = ApiV1(app)
@@ -134,6 +134,19 @@ class Attributes:
         ret.sort()
         return ret
 
+    def get_backend_displayed_attributes(self, backend):
+        """get the attributes of a backend displayed in the search results
+        (key included)"""
+        if backend not in self.backends:
+            raise WrongBackend(backend)
+        ret = []
+        for attr in self.backend_attributes[backend]:
+            attrid = self.backend_attributes[backend][attr]
+            if attrid in self.displayed_attributes or attrid == self.key:
+                ret.append(attr)
+        ret.sort()
+        return ret
+
     def get_backend_key(self, backend):
         if backend not in self.backends:
             raise WrongBackend(backend)
@@ -5,7 +5,7 @@
 # LdapCherry
 # Copyright (c) 2014 Carpentier Pierre-Francois
 
-from ldapcherry.exceptions import MissingParameter
+from ldapcherry.exceptions import MissingParameter, UserDoesntExist
 
 
 class Backend(object):
@@ -88,6 +88,26 @@ class Backend(object):
         """
         pass
 
+    def set_displayed_attrs(self, attrslist):
+        """ Set the attributes displayed in the search results,
+        called once after the initialization
+
+        :param attrslist: list of the backend attributes displayed
+            in the search results (key included)
+        :type attrslist: list of strings
+
+        .. note:: searches may return only these attributes,
+            get_user() must still return all the attributes
+        """
+        pass
+
+    def close(self):
+        """ Release the resources of the backend (connections,
+        threads...), called when the backend is replaced
+        (configuration reload)
+        """
+        pass
+
     def search(self, searchstring):
         """ Search backend for users
 
@@ -97,6 +117,71 @@ class Backend(object):
         """
         return {}
 
+    def search_page(self, searchstring, cookie=None):
+        """ Search backend for users, one page at a time
+
+        :param searchstring: the search string
+        :type searchstring: string
+        :param cookie: position in the results, None for the first page,
+            then the cookie returned with the previous page
+        :type cookie: string or None
+        :rtype: tuple (dict of dict ( {<user attr key>: {<attr>: <value>}} ),
+            cookie of the next page or None if it was the last page)
+
+        .. note:: this default implementation pages the result of
+            search(), backends able to page their queries should
+            override it
+        """
+        page_size = int(self.get_param('search.page_size', 100))
+        try:
+            offset = int(cookie or 0)
+        except ValueError:
+            offset = 0
+        users = self.search(searchstring)
+        keys = sorted(users)[offset:offset + page_size]
+        ret = {}
+        for key in keys:
+            ret[key] = users[key]
+        if offset + page_size < len(users):
+            return (ret, str(offset + page_size))
+        return (ret, None)
+
+    def search_stream(self, searchstring, cookie=None):
+        """ Search backend for users, one page at a time,
+        yielding the users as soon as they are found
+
+        :param searchstring: the search string
+        :type searchstring: string
+        :param cookie: position in the results (see search_page())
+        :type cookie: string or None
+        :rtype: iterator of tuples (<user attr key>, {<attr>: <value>}),
+            the last tuple is (None, cookie of the next page or None)
+
+        .. note:: this default implementation iterates on the result
+            of search_page(), backends able to return the users
+            progressively should override it
+        """
+        users, cookie = self.search_page(searchstring, cookie)
+        for user in users:
+            yield (user, users[user])
+        yield (None, cookie)
+
+    def search_matcher(self, searchstring):
+        """ Get a function telling if a user found by a previous search
+        matches this search, used to refine cached search results
+        instead of querying the backend again (when someone types
+        'jo', then 'joh', then 'john')
+
+        :param searchstring: the search string
+        :type searchstring: string
+        :rtype: function ({<attr>: <value>}) -> boolean, or None if
+            the results of shorter search strings cannot be refined
+
+        .. note:: the users matching searchstring must be a subset
+            of the users matching any prefix of searchstring
+        """
+        return None
+
     def get_user(self, username):
         """ Get a user's attributes
 
@@ -108,6 +193,27 @@ class Backend(object):
         """
         return {}
 
+    def get_users(self, usernames):
+        """ Get the attributes of several users, used to complete
+        the pages of a search paged on another backend
+
+        :param usernames: 'key' attributes of the users
+        :type usernames: list of strings
+        :rtype: dict of dict ( {<user attr key>: {<attr>: <value>}} ),
+            the users which don't exist are left out
+
+        .. note:: this default implementation calls get_user() for
+            each user, backends able to get several users at once
+            should override it
+        """
+        ret = {}
+        for username in usernames:
+            try:
+                ret[username] = self.get_user(username)
+            except UserDoesntExist:
+                continue
+        return ret
+
     def get_groups(self, username):
         """ Get a user's groups
 
@@ -117,6 +223,21 @@ class Backend(object):
         """
         return []
 
+    def async_backend(self, executor=None):
+        """ Get the native asynchronous (asyncio) version of the backend,
+        python 3 only
+
+        :param executor: executor for the blocking calls it still has
+        :type executor: concurrent.futures executor or None
+        :rtype: ldapcherry.backend.aio.AsyncBackend, or None if the
+            backend has no native version
+
+        .. note:: use ldapcherry.backend.aio.get_async_backend(),
+            which runs the methods of the backends without native
+            version in a thread pool
+        """
+        return None
+
     def get_param(self, param, default=None):
         """ Get a parameter in config (handle default value)
 
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+# vim:set expandtab tabstop=4 shiftwidth=4:
+#
+# The MIT License (MIT)
+# LdapCherry
+# Copyright (c) 2014 Carpentier Pierre-Francois
+
+# Asynchronous (asyncio) backend interface (python 3.5+ only)
+#
+# The backends implement the blocking interface of ldapcherry.backend.Backend.
+# From an event loop, use get_async_backend() to get their asynchronous
+# version: the native one if the backend provides it (see
+# Backend.async_backend()), or an adapter running the blocking methods
+# in a thread pool:
+#
+#   backend = get_async_backend(app.backends['ldap'])
+#   users = await backend.search(u'smith')
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+# threads of the default executor of the adapters
+EXECUTOR_MAX_WORKERS = 8
+
+_executor = None
+
+
+def default_executor():
+    """executor shared by the adapters without executor of their own"""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=EXECUTOR_MAX_WORKERS)
+    return _executor
+
+
+class AsyncBackend(object):
+    """Coroutine versions of the methods of ldapcherry.backend.Backend,
+    same parameters, same return values, same exceptions
+    """
+
+    async def auth(self, username, password):
+        """ Check authentication against the backend
+
+        :rtype: boolean (True is authentication success, False otherwise)
+        """
+        return False
+
+    async def add_user(self, attrs):
+        """ Add a user to the backend """
+        pass
+
+    async def del_user(self, username):
+        """ Delete a user from the backend """
+        pass
+
+    async def set_attrs(self, username, attrs):
+        """ Set a list of attributes for a given user """
+        pass
+
+    async def add_to_groups(self, username, groups):
+        """ Add a user to a list of groups """
+        pass
+
+    async def del_from_groups(self, username, groups):
+        """ Delete a user from a list of groups """
+        pass
+
+    async def search(self, searchstring):
+        """ Search backend for users
+
+        :rtype: dict of dict ( {<user attr key>: {<attr>: <value>}} )
+        """
+        return {}
+
+    async def search_page(self, searchstring, cookie=None):
+        """ Search backend for users, one page at a time
+
+        :rtype: tuple ({<user attr key>: {<attr>: <value>}},
+            cookie of the next page or None)
+        """
+        return ({}, None)
+
+    async def get_user(self, username):
+        """ Get a user's attributes
+
+        :rtype: dict ( {<attr>: <value>} )
+        """
+        return {}
+
+    async def get_groups(self, username):
+        """ Get a user's groups
+
+        :rtype: list of groups
+        """
+        return []
+
+
+class SyncBackendAdapter(AsyncBackend):
+    """Asynchronous version of a blocking backend,
+    its methods are run in a thread pool
+    """
+
+    def __init__(self, backend, executor=None):
+        """
+        @backend: the blocking backend (ldapcherry.backend.Backend)
+        @executor: concurrent.futures executor running the calls,
+            default_executor() if None
+        """
+        self.backend = backend
+        self.backend_name = backend.backend_name
+        self.executor = executor
+
+    async def _run(self, method, *args):
+        """run a method of the blocking backend in the executor"""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self.executor or default_executor(),
+            functools.partial(getattr(self.backend, method), *args),
+            )
+
+    async def auth(self, username, password):
+        return await self._run('auth', username, password)
+
+    async def add_user(self, attrs):
+        return await self._run('add_user', attrs)
+
+    async def del_user(self, username):
+        return await self._run('del_user', username)
+
+    async def set_attrs(self, username, attrs):
+        return await self._run('set_attrs', username, attrs)
+
+    async def add_to_groups(self, username, groups):
+        return await self._run('add_to_groups', username, groups)
+
+    async def del_from_groups(self, username, groups):
+        return await self._run('del_from_groups', username, groups)
+
+    async def search(self, searchstring):
+        return await self._run('search', searchstring)
+
+    async def search_page(self, searchstring, cookie=None):
+        return await self._run('search_page', searchstring, cookie)
+
+    async def get_user(self, username):
+        return await self._run('get_user', username)
+
+    async def get_groups(self, username):
+        return await self._run('get_groups', username)
+
+
+def get_async_backend(backend, executor=None):
+    """ get the asynchronous version of a backend
+    @backend: the blocking backend (ldapcherry.backend.Backend)
+    @executor: executor of the blocking calls (see SyncBackendAdapter)
+    @rtype: AsyncBackend
+    """
+    native = getattr(backend, 'async_backend', None)
+    if native is not None:
+        ret = native(executor)
+        if ret is not None:
+            return ret
+    return SyncBackendAdapter(backend, executor)
@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+# vim:set expandtab tabstop=4 shiftwidth=4:
+#
+# The MIT License (MIT)
+# LdapCherry
+# Copyright (c) 2014 Carpentier Pierre-Francois
+
+# Non blocking version of the ldap backend (python 3.5+ only)
+#
+# The requests are sent with the asynchronous methods of python-ldap
+# (search_ext(), simple_bind()..., returning message ids) and their
+# answers are read when the socket of the connection becomes readable,
+# so a single connection carries many requests in flight without
+# pinning a thread for each of them.
+# Opening a connection (connect, start_tls, bind of the technical
+# account) is still blocking and done in the executor.
+
+import asyncio
+import logging
+import time
+import ldap
+from ldap.controls import SimplePagedResultsControl
+from ldapcherry.backend.aio import SyncBackendAdapter
+from ldapcherry.backend.backendLdap import NO_ATTR, DISPLAYED_ATTRS, \
+    ALL_ATTRS, MEMBEROF_ATTRS
+from ldapcherry.exceptions import UserDoesntExist
+
+# interval (in second) between two polls of a connection with requests
+# in flight, in case the readiness of the socket is missed (answers
+# already buffered by the tls layer for example)
+POLL_INTERVAL = 0.05
+
+
+class AsyncConnection(object):
+    """ldap connection driven by an asyncio event loop"""
+
+    def __init__(self, ldap_client, loop):
+        self.ldap_client = ldap_client
+        self.loop = loop
+        self.closed = False
+        # requests in flight, {<msgid>: <future>}
+        self._pending = {}
+        self._fd = None
+        self._timer = None
+
+    def _watch(self):
+        """watch the socket of the connection
+        (opened by the first request if not already)
+        """
+        if self._fd is not None:
+            return
+        try:
+            fd = self.ldap_client.fileno()
+        except Exception:
+            return
+        if fd is None or fd < 0:
+            return
+        self.loop.add_reader(fd, self._poll)
+        self._fd = fd
+
+    def _schedule(self):
+        if self._pending and self._timer is None and not self.closed:
+            self._timer = self.loop.call_later(POLL_INTERVAL, self._tick)
+
+    def _tick(self):
+        self._timer = None
+        self._poll()
+
+    def request(self, method, *args, **kwargs):
+        """ send a request
+        @str method: asynchronous method of the ldap client
+            (search_ext, simple_bind, modify_ext...)
+        @rtype: future of the answer, as returned by result3()
+        """
+        if self.closed:
+            raise ldap.SERVER_DOWN({'desc': 'connection closed'})
+        msgid = getattr(self.ldap_client, method)(*args, **kwargs)
+        future = self.loop.create_future()
+        self._pending[msgid] = future
+        self._watch()
+        self._schedule()
+        return future
+
+    def _poll(self):
+        """read the answers available, without blocking"""
+        for msgid in list(self._pending):
+            future = self._pending[msgid]
+            if future.cancelled():
+                del self._pending[msgid]
+                try:
+                    self.ldap_client.abandon(msgid)
+                except Exception:
+                    pass
+                continue
+            try:
+                ret = self.ldap_client.result3(msgid, 1, 0)
+            except ldap.SERVER_DOWN as e:
+                self.close(e)
+                return
+            except Exception as e:
+                del self._pending[msgid]
+                future.set_exception(e)
+                continue
+            # not answered yet
+            if ret[0] is None:
+                continue
+            del self._pending[msgid]
+            future.set_result(ret)
+        self._schedule()
+
+    def close(self, error=None):
+        """close the connection, the requests in flight fail
+        with **error** (or SERVER_DOWN)
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if self._fd is not None:
+            self.loop.remove_reader(self._fd)
+        if self._timer is not None:
+            self._timer.cancel()
+        if error is None:
+            error = ldap.SERVER_DOWN({'desc': 'connection closed'})
+        pending = self._pending
+        self._pending = {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(error)
+        try:
+            self.ldap_client.unbind_s()
+        except Exception:
+            pass
+
+
+class AsyncBackend(SyncBackendAdapter):
+    """Non blocking version of the ldap backend
+
+    auth, search, get_user and get_groups are sent on a connection
+    shared by all the requests, the other methods (modifications, and
+    paged searches which keep a connection per unfinished search) are
+    run in the executor.
+    The shared connection goes to the read servers, the reads which
+    must see a recent write (see read_your_writes.ttl) are run in the
+    executor, on the write servers.
+    An instance must only be used from a single event loop.
+    """
+
+    def __init__(self, backend, executor=None):
+        """
+        @backend: the ldap backend (ldapcherry.backend.backendLdap.Backend)
+        @executor: executor of the blocking calls
+        """
+        super(AsyncBackend, self).__init__(backend, executor)
+        # task opening the shared connection
+        self._opening = None
+
+    def _pinned(self, username=None):
+        """check if the reads about a user (the searches if **username**
+        is None) must go to the write servers, which the shared
+        connection does not reach"""
+        b = self.backend
+        return b.read_servers is not b.servers and \
+            b._reads_on_writer(username)
+
+    async def _open(self):
+        ldap_client = await self._run('_bind_read')
+        return AsyncConnection(ldap_client, asyncio.get_event_loop())
+
+    async def _connection(self):
+        """get the shared connection, bound with the technical account"""
+        while True:
+            if self._opening is None:
+                self._opening = asyncio.ensure_future(self._open())
+            opening = self._opening
+            try:
+                # one requester cancelled must not cancel the others
+                conn = await asyncio.shield(opening)
+            except Exception:
+                if self._opening is opening:
+                    self._opening = None
+                raise
+            if not conn.closed:
+                return conn
+            if self._opening is opening:
+                self._opening = None
+
+    async def _request(self, method, *args, **kwargs):
+        """send a request on the shared connection and wait for its answer
+        (retry once on a new connection if the connection was dead)
+        """
+        retry = True
+        while True:
+            conn = await self._connection()
+            try:
+                return await conn.request(method, *args, **kwargs)
+            except ldap.SERVER_DOWN as e:
+                conn.close(e)
+                if retry:
+                    retry = False
+                    continue
+                self.backend._exception_handler(e)
+            except ldap.LDAPError as e:
+                self.backend._exception_handler(e)
+
+    @staticmethod
+    def _entries(rdata):
+        """entries of a search answer (search references are skipped)"""
+        return [entry for entry in rdata if entry[0] is not None]
+
+    async def _search(self, searchfilter, attrs, basedn, decode=True):
+        """Generic search
+        @bool decode: convert the entries to unicode (else, they are
+        returned as python-ldap returns them)
+        """
+        b = self.backend
+        b._logger(
+            severity=logging.DEBUG,
+            msg="%(backend)s: executing search "
+                "with filter '%(filter)s' in DN '%(dn)s'" % {
+                    'backend': b.backend_name,
+                    'dn': basedn,
+                    'filter': b._uni(searchfilter)
+                }
+        )
+        rtype, rdata, rmsgid, serverctrls = await self._request(
+            'search_ext',
+            basedn,
+            ldap.SCOPE_SUBTREE,
+            searchfilter,
+            attrlist=b._attrlist(attrs),
+            )
+        if not decode:
+            return self._entries(rdata)
+        return b._uni_entries(self._entries(rdata))
+
+    async def _search_page(self, searchfilter, attrlist, cookie, size):
+        """Get one page of a paged search of the users (RFC 2696)
+        @rtype: tuple, (<entries>, <cookie of the next page or None>)
+        """
+        b = self.backend
+        control = SimplePagedResultsControl(True, size=size, cookie=cookie)
+        rtype, rdata, rmsgid, serverctrls = await self._request(
+            'search_ext',
+            b.userdn,
+            ldap.SCOPE_SUBTREE,
+            searchfilter,
+            attrlist=attrlist,
+            serverctrls=[control],
+            )
+        cookie = None
+        for ctrl in serverctrls:
+            if ctrl.controlType == SimplePagedResultsControl.controlType:
+                cookie = ctrl.cookie or None
+        return (self._entries(rdata), cookie)
+
+    async def _get_user(self, username, attrs=ALL_ATTRS, unwrap=False):
+        """Get a user from the ldap
+        @bool unwrap: replace the lists of one value by the value
+        """
+        b = self.backend
+        r = await self._search(
+            b._user_filter(username), attrs, b.userdn, decode=False
+            )
+        if len(r) == 0:
+            return None
+        if attrs == NO_ATTR:
+            return b._uni(r[0][0])
+        return b._decode_entry(r[0], unwrap)
+
+    async def auth(self, username, password):
+        b = self.backend
+        if self._pinned(username):
+            return await self._run('auth', username, password)
+        binddn = await self._get_user(b._byte_p2(username), NO_ATTR)
+        if binddn is None:
+            return False
+        # bind on the best server answering, like the ldap backend _open()
+        servers = b.read_servers
+        error = None
+        for server in servers.candidates():
+            start = time.time()
+            conn = None
+            try:
+                ldap_client = await self._run('_connect', server)
+                conn = AsyncConnection(ldap_client, asyncio.get_event_loop())
+                await conn.request(
+                    'simple_bind',
+                    b._byte_p2(binddn),
+                    b._byte_p2(password),
+                    )
+            except (ldap.SERVER_DOWN, ldap.TIMEOUT) as e:
+                servers.failure(server)
+                error = error or e
+                continue
+            except ldap.INVALID_CREDENTIALS:
+                servers.success(server, time.time() - start)
+                return False
+            except Exception:
+                # the server answered
+                servers.success(server, time.time() - start)
+                raise
+            finally:
+                if conn is not None:
+                    conn.close()
+            servers.success(server, time.time() - start)
+            return True
+        raise error
+
+    async def search(self, searchstring):
+        b = self.backend
+        if self._pinned():
+            return await self._run('search', searchstring)
+        searchfilter = b._search_filter(searchstring)
+        attrlist = b._attrlist(DISPLAYED_ATTRS)
+        ret = {}
+        count = 0
+        cookie = ''
+        # get the results page by page (at most search.max_results)
+        while cookie is not None:
+            entries, cookie = await self._search_page(
+                searchfilter, attrlist, cookie, b.page_size
+                )
+            if b.max_results and count + len(entries) >= b.max_results:
+                if cookie is not None:
+                    b._logger(
+                        severity=logging.WARNING,
+                        msg="%(backend)s: search results truncated to "
+                            "%(max)d entries, "
+                            "see '%(backend)s.search.max_results'" %
+                            {'backend': b.backend_name,
+                             'max': b.max_results}
+                    )
+                    # release the server side state of the search
+                    try:
+                        await self._search_page(searchfilter, [], cookie, 0)
+                    except Exception:
+                        pass
+                entries = entries[:max(b.max_results - count, 0)]
+                cookie = None
+            count += len(entries)
+            b._search_results(entries, ret)
+        return ret
+
+    async def get_user(self, username):
+        b = self.backend
+        if self._pinned(username):
+            return await self._run('get_user', username)
+        tmp = await self._get_user(
+            b._byte_p2(username), ALL_ATTRS, unwrap=True
+            )
+        if tmp is None:
+            raise UserDoesntExist(username, b.backend_name)
+        return tmp[1]
+
+    async def get_groups(self, username):
+        b = self.backend
+        if self._pinned(username):
+            return await self._run('get_groups', username)
+        if b.membership_mode == 'memberof':
+            tmp = await self._get_user(b._byte_p2(username), MEMBEROF_ATTRS)
+            if tmp is None:
+                return []
+            return b._groupdn_groups(b._memberof_values(tmp[1]))
+        userdn = await self._get_user(b._byte_p2(username), NO_ATTR)
+        searchfilter = b._group_filter(username, userdn)
+        if searchfilter is None:
+            return []
+        groups = await self._search(searchfilter, NO_ATTR, b.groupdn)
+        ret = []
+        for entry in groups:
+            ret.append(b._uni(entry[0]))
+        return ret
@@ -12,7 +12,10 @@ import ldap.modlist as modlist
 import ldap.filter
 import logging
 import ldapcherry.backend
-from ldapcherry.exceptions import UserDoesntExist, GroupDoesntExist
+from ldapcherry.backend.ldapfilter import FilterTemplate
+from ldapcherry.cache import TTLCache
+from ldapcherry.exceptions import UserDoesntExist, GroupDoesntExist, \
+    WrongParamValue
 import os
 import re
 import sys
@@ -34,6 +37,24 @@ NO_ATTR = 0
 DISPLAYED_ATTRS = 1
 LISTED_ATTRS = 2
 ALL_ATTRS = 3
+MEMBERSHIP_ATTRS = 4
+MEMBEROF_ATTRS = 5
+
+# ways of recovering the groups of a user (membership_mode parameter):
+# * search: search the groups having the user as member
+# * memberof: read memberOf, recovered with the user entry
+# * tokengroups: read tokenGroups (nested groups included) of the user
+# * inchain: search the groups having the user as member, directly or
+#   through nested groups
+MEMBERSHIP_MODES = ['search', 'memberof', 'tokengroups', 'inchain']
+# modes expanding nested groups, their results are cached
+TRANSITIVE_MODES = ['tokengroups', 'inchain']
+
+# groups of a user, nested groups included, with the matching rule
+# walking the chain of nested groups
+INCHAIN_FILTER = FilterTemplate(
+    '(member:1.2.840.113556.1.4.1941:=%(userdn)s)'
+)
 
 # UserAccountControl Attribute/Flag Values
 # For details, look at:
@@ -110,8 +131,11 @@ class Backend(ldapcherry.backend.backendLdap.Backend):
         self.ca = self.get_param('ca', False)
         self.checkcert = self.get_param('checkcert', 'on')
         self.starttls = self.get_param('starttls', 'off')
-        self.uri = self.get_param('uri')
+        self.uri = self.get_param('uri', '')
         self.timeout = self.get_param('timeout', 1)
+        self.network_timeout = self.get_param('network_timeout', self.timeout)
+        self.page_size = int(self.get_param('search.page_size', 100))
+        self.max_results = int(self.get_param('search.max_results', 0))
         self.userdn = 'OU=Users,OU=' + self.domain.split(".")[0] + "," + basedn
         self.groupdn = self.userdn
         self.builtin = 'CN=Builtin,' + basedn
@@ -128,6 +152,28 @@ class Backend(ldapcherry.backend.backendLdap.Backend):
             '(!(objectClass=computer)))' \
             ')'
         self.dn_user_attr = 'cn'
+        self.groups_check = \
+            self.get_param('groups.check_membership', 'off') == 'on'
+        self.membership_mode = self.get_param('membership_mode', 'search')
+        if self.membership_mode not in MEMBERSHIP_MODES:
+            raise WrongParamValue(
+                self.backend_name + '.membership_mode',
+                'backends',
+                MEMBERSHIP_MODES,
+                )
+        # groups of the users, with nested groups expanded
+        self.membership_cache = TTLCache(
+            max_size=int(self.get_param('membership_cache.max_size', 1000)),
+            ttl=int(self.get_param('membership_cache.ttl', 60)),
+            )
+        self.all_attrlist = None
+        self.displayed_attrlist = None
+        if self.membership_mode == 'memberof':
+            # recover memberOf with the user entry
+            self.all_attrlist = [
+                self._byte_p2('*'),
+                self._byte_p2('memberOf'),
+                ]
         self.key = 'sAMAccountName'
         self.objectclasses = [
             self._byte_p23('top'),
@@ -151,6 +197,13 @@ class Backend(ldapcherry.backend.backendLdap.Backend):
         if self._byte_p2('unicodePwd') not in self.attrlist:
             raise MissingAttr()
 
+        self._init_attrlists()
+        self._init_filters()
+        self._init_decoding()
+        self._init_servers()
+        self._init_options()
+        self._init_pool()
+
     if sys.version < '3':
         @staticmethod
         def _tobyte(in_int):
@@ -160,22 +213,83 @@ class Backend(ldapcherry.backend.backendLdap.Backend):
         def _tobyte(in_int):
             return in_int.to_bytes(4, byteorder='big')
 
-    def _search_group(self, searchfilter, groupdn):
+    def _search_groups(self, ldap_client, searchfilter):
+        """search the groups in groupdn and in builtin at once
+        (both searches are sent before reading the answers)
+        """
         searchfilter = self._byte_p2(searchfilter)
-        ldap_client = self._bind()
+        sent = []
+        error = None
         try:
-            r = ldap_client.search_s(
-                groupdn,
-                ldap.SCOPE_SUBTREE,
-                searchfilter,
-                attrlist=['CN']
-                )
-        except Exception as e:
-            ldap_client.unbind_s()
-            self._exception_handler(e)
+            for groupdn in [self.groupdn, self.builtin]:
+                sent.append(ldap_client.search_ext(
+                    groupdn,
+                    ldap.SCOPE_SUBTREE,
+                    searchfilter,
+                    attrlist=['CN']
+                    ))
+        except ldap.LDAPError as e:
+            error = e
+        # read every answer before the connection goes back to the pool
+        r = []
+        for msgid in sent:
+            try:
+                r.extend(ldap_client.result3(msgid)[1])
+            except ldap.LDAPError as e:
+                error = error or e
+        self._raise_group_error(error)
+        # search references are skipped
+        return [entry for entry in r if entry[0] is not None]
+
+    def _group_names(self, dns):
+        """get the names of the groups of groupdn and builtin
+        from their dns"""
+        ret = []
+        for dn in dns:
+            ndn = self._normalize_dn(dn)
+            if not self._under_groupdn(ndn) and \
+                    not self._under_dn(ndn, self.builtin):
+                continue
+            ret.append(self._uni(ldap.dn.str2dn(self._uni(dn))[0][0][1]))
+        return ret
 
-        ldap_client.unbind_s()
-        return r
+    def _memberof_groups(self, username):
+        """get the groups of a user from its memberOf attribute"""
+        return self._group_names(self._memberof(username))
+
+    @staticmethod
+    def _escape_binary(value):
+        """escape every byte of a binary value for a filter"""
+        return ''.join(['\\%02x' % c for c in bytearray(value)])
+
+    def _tokengroups_groups(self, username):
+        """get the groups of a user from its tokenGroups attribute
+        (only returned by a base search on the user entry)"""
+        userdn = self._get_user(self._byte_p2(username), NO_ATTR)
+        if userdn is None:
+            return []
+        with self._read_pool(username).connection() as ldap_client:
+            try:
+                r = ldap_client.search_s(
+                    self._byte_p2(userdn),
+                    ldap.SCOPE_BASE,
+                    '(objectClass=*)',
+                    attrlist=['tokenGroups']
+                    )
+            except Exception as e:
+                self._exception_handler(e)
+            sids = []
+            for dn, attrs in r:
+                for attr in attrs or {}:
+                    if attr.lower() == 'tokengroups':
+                        sids.extend(attrs[attr])
+            if not sids:
+                return []
+            searchfilter = '(|%s)' % ''.join(
+                ['(objectSid=%s)' % self._escape_binary(sid) for sid in sids]
+            )
+            groups = self._search_groups(ldap_client, searchfilter)
+        return [self._uni(entry[1]['cn'][0]) for entry in groups]
 
     def _build_groupdn(self, groups):
         ad_groups = []
@@ -190,8 +304,6 @@ class Backend(ldapcherry.backend.backendLdap.Backend):
         unicode_pass = '\"' + password + '\"'
         password_value = unicode_pass.encode('utf-16-le')
 
-        ldap_client = self._bind()
-
         if by_cn:
             dn = self._byte_p2('CN=%(cn)s,%(user_dn)s' % {
                         'cn': name,
@@ -200,10 +312,11 @@ class Backend(ldapcherry.backend.backendLdap.Backend):
         else:
             dn = self._byte_p2(name)
 
-        ldap_client.modify_s(
-            dn,
-            [(ldap.MOD_REPLACE, 'unicodePwd', [password_value])]
-        )
+        with self.pool.connection() as ldap_client:
+            ldap_client.modify_s(
+                dn,
+                [(ldap.MOD_REPLACE, 'unicodePwd', [password_value])]
+            )
         return
 
         attrs = {}
@@ -229,28 +342,26 @@ class Backend(ldapcherry.backend.backendLdap.Backend):
         attrs['displayName'] = attrs['cn']
         super(Backend, self).add_user(attrs)
 
-        ldap_client = self._bind()
-
         dn = self._byte_p2('CN=%(cn)s,%(user_dn)s' % {
             'cn': attrs['cn'], 'user_dn': self.userdn
         })
 
         # Set password
         encoded_password = '"{}"'.format(password).encode('utf-16-le')
-        ldap_client.modify_s(
-            dn,
-            [(ldap.MOD_REPLACE, 'unicodePwd', [encoded_password])]
-        )
-
-        # Enable user account
-        ldap_client.modify_s(
-            dn,
-            [(ldap.MOD_REPLACE, 'UserAccountControl', [b'512'])]
-        )
-
-        ldap_client.unbind_s()
+        with self.pool.connection() as ldap_client:
+            ldap_client.modify_s(
+                dn,
+                [(ldap.MOD_REPLACE, 'unicodePwd', [encoded_password])]
+            )
+
+            # Enable user account
+            ldap_client.modify_s(
+                dn,
+                [(ldap.MOD_REPLACE, 'UserAccountControl', [b'512'])]
+            )
 
     def set_attrs(self, username, attrs):
+        self._record_write(username)
         if 'unicodePwd' in attrs:
             password = attrs['unicodePwd']
             del(attrs['unicodePwd'])
@@ -258,53 +369,86 @@ class Backend(ldapcherry.backend.backendLdap.Backend):
             self._set_password(userdn, password, False)
         super(Backend, self).set_attrs(username, attrs)
 
+    def del_user(self, username):
+        try:
+            super(Backend, self).del_user(username)
+        finally:
+            self.membership_cache.invalidate(username)
+
     def add_to_groups(self, username, groups):
         ad_groups = self._build_groupdn(groups)
-        super(Backend, self).add_to_groups(username, ad_groups)
+        try:
+            super(Backend, self).add_to_groups(username, ad_groups)
+        finally:
+            self.membership_cache.invalidate(username)
 
     def del_from_groups(self, username, groups):
         ad_groups = self._build_groupdn(groups)
-        super(Backend, self).del_from_groups(username, ad_groups)
+        try:
+            super(Backend, self).del_from_groups(username, ad_groups)
+        finally:
+            self.membership_cache.invalidate(username)
 
-    def get_groups(self, username):
-        username = ldap.filter.escape_filter_chars(username)
+    def _inchain_groups(self, username):
+        """get the groups of a user, nested groups included,
+        in one search"""
         userdn = self._get_user(self._byte_p2(username), NO_ATTR)
+        if userdn is None:
+            return []
+        searchfilter = INCHAIN_FILTER.fill({'userdn': self._uni(userdn)})
+        with self._read_pool(username).connection() as ldap_client:
+            groups = self._search_groups(ldap_client, searchfilter)
+        return [self._uni(entry[1]['cn'][0]) for entry in groups]
 
-        searchfilter = self.group_filter_tmpl % {
-            'userdn': userdn,
-            'username': username
-        }
-
-        groups = self._search_group(searchfilter, self.groupdn)
-        groups = groups + self._search_group(searchfilter, self.builtin)
-        ret = []
+    def get_groups(self, username):
+        transitive = self.membership_mode in TRANSITIVE_MODES
+        if transitive:
+            ret = self.membership_cache.get(username)
+            if ret is not None:
+                return ret
+        if self.membership_mode == 'memberof':
+            ret = self._memberof_groups(username)
+        elif self.membership_mode == 'tokengroups':
+            ret = self._tokengroups_groups(username)
+        elif self.membership_mode == 'inchain':
+            ret = self._inchain_groups(username)
+        else:
+            userdn = self._get_user(self._byte_p2(username), NO_ATTR)
+            searchfilter = self._group_filter(username, userdn)
+            ret = []
+            if searchfilter is not None:
+                pool = self._read_pool(username)
+                with pool.connection() as ldap_client:
+                    groups = self._search_groups(ldap_client, searchfilter)
+                for entry in groups:
+                    ret.append(self._uni(entry[1]['cn'][0]))
         self._logger(
             severity=logging.DEBUG,
             msg="%(backend)s: groups of '%(user)s' are %(groups)s" % {
                 'user': username,
-                'groups': str(groups),
+                'groups': str(ret),
                 'backend': self.backend_name
                 }
         )
-
-        for entry in groups:
-            ret.append(self._uni(entry[1]['cn'][0]))
+        if transitive:
+            self.membership_cache.set(username, ret)
         return ret
 
     def auth(self, username, password):
 
         binddn = username + '@' + self.domain
-        if binddn is not None:
-            ldap_client = self._connect()
-            try:
-                ldap_client.simple_bind_s(
-                    self._byte_p2(binddn),
-                    self._byte_p2(password)
+        try:
+            ldap_client = self._open(
+                self._byte_p2(binddn),
+                self._byte_p2(password),
+                self._read_servers(username),
                 )
-            except ldap.INVALID_CREDENTIALS:
-                ldap_client.unbind_s()
-                return False
-            ldap_client.unbind_s()
-            return True
-        else:
+        except ldap.INVALID_CREDENTIALS:
             return False
+        ldap_client.unbind_s()
+        return True
+
+    def async_backend(self, executor=None):
+        """no native asynchronous version (auth and get_groups differ
+        from the ldap backend), the calls are run in the executor"""
+        return None
@@ -9,12 +9,23 @@ import cherrypy
 import ldap
 import ldap.modlist as modlist
 import ldap.filter
+from ldap.controls import SimplePagedResultsControl
 import logging
 import ldapcherry.backend
 import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from ldapcherry.backend.pool import ConnectionPool
+from ldapcherry.backend.servers import ServerSet
+from ldapcherry.cache import TTLCache
+from ldapcherry.backend.ldapfilter import SearchRefiner, FilterTemplate
 from ldapcherry.exceptions import UserDoesntExist, \
     GroupDoesntExist, \
-    UserAlreadyExists
+    UserAlreadyExists, \
+    WrongParamValue, \
+    MissingParameter
 import os
 import re
 if sys.version < '3':
@@ -22,6 +33,25 @@ if sys.version < '3':
 
 PYTHON_LDAP_MAJOR_VERSION = ldap.__version__[0]
 
+# how the groups of a user are recovered:
+# * search: search the groups having the user as member
+# * memberof: read memberOf (memberof overlay), recovered with the dn
+#   of the user
+MEMBERSHIP_MODES = ['search', 'memberof']
+
+# time (in second) an unfinished paged search is kept open
+# waiting for the next page to be requested
+CURSOR_TIMEOUT = 60
+
+# max number of unfinished paged searches kept open per backend,
+# each one keeps its own connection (out of the pool)
+MAX_CURSORS = 4
+
+# max number of entries skipped to resume a paged search whose cursor
+# was lost, if search.max_results is not set (the offset comes from
+# the page token, the search starts over beyond)
+MAX_SKIP = 10000
+
 
 class CaFileDontExist(Exception):
     def __init__(self, cafile):
@@ -47,6 +77,57 @@ NO_ATTR = 0
 DISPLAYED_ATTRS = 1
 LISTED_ATTRS = 2
 ALL_ATTRS = 3
+MEMBERSHIP_ATTRS = 4
+MEMBEROF_ATTRS = 5
+
+# attribute list requesting no attribute at all (RFC 4511),
+# an empty list requests all the user attributes
+NO_ATTR_LIST = ['1.1']
+
+
+class PagedSearch(object):
+    """One page of a paged search (RFC 2696)
+
+    The search is sent at creation, entries are then returned
+    while iterating, as soon as the directory sends them.
+    Once the iteration is over, **cookie** is the cookie of the
+    next page (None if it was the last page).
+    """
+
+    def __init__(self, backend, ldap_client, searchfilter, attrlist,
+                 basedn, cookie, size):
+        self.backend = backend
+        self.ldap_client = ldap_client
+        self.cookie = None
+        control = SimplePagedResultsControl(True, size=size, cookie=cookie)
+        try:
+            self.msgid = ldap_client.search_ext(
+                basedn,
+                ldap.SCOPE_SUBTREE,
+                searchfilter,
+                attrlist=attrlist,
+                serverctrls=[control],
+                )
+        except Exception as e:
+            backend._exception_handler(e)
+
+    def __iter__(self):
+        while True:
+            try:
+                rtype, rdata, rmsgid, serverctrls = \
+                    self.ldap_client.result3(self.msgid, all=0)
+            except Exception as e:
+                self.backend._exception_handler(e)
+            if rtype == ldap.RES_SEARCH_ENTRY:
+                for entry in rdata:
+                    yield entry
+            elif rtype == ldap.RES_SEARCH_RESULT:
+                for ctrl in serverctrls:
+                    if ctrl.controlType == \
+                            SimplePagedResultsControl.controlType:
+                        self.cookie = ctrl.cookie or None
+                return
+            # search references are skipped
 
 
 class Backend(ldapcherry.backend.Backend):
@@ -63,14 +144,37 @@ class Backend(ldapcherry.backend.Backend):
         self.ca = self.get_param('ca', False)
         self.checkcert = self.get_param('checkcert', 'on')
         self.starttls = self.get_param('starttls', 'off')
-        self.uri = self.get_param('uri')
+        self.uri = self.get_param('uri', '')
         self.timeout = self.get_param('timeout', 1)
+        self.network_timeout = self.get_param('network_timeout', self.timeout)
+        self.page_size = int(self.get_param('search.page_size', 100))
+        self.max_results = int(self.get_param('search.max_results', 0))
         self.userdn = self.get_param('userdn')
         self.groupdn = self.get_param('groupdn')
         self.user_filter_tmpl = self.get_param('user_filter_tmpl')
         self.group_filter_tmpl = self.get_param('group_filter_tmpl')
         self.search_filter_tmpl = self.get_param('search_filter_tmpl')
         self.dn_user_attr = self.get_param('dn_user_attr')
+        self.groups_check = \
+            self.get_param('groups.check_membership', 'off') == 'on'
+        self.membership_mode = self.get_param('membership_mode', 'search')
+        if self.membership_mode not in MEMBERSHIP_MODES:
+            raise WrongParamValue(
+                self.backend_name + '.membership_mode',
+                'backends',
+                MEMBERSHIP_MODES,
+                )
+        # attributes recovered with ALL_ATTRS (None: all user attributes)
+        self.all_attrlist = None
+        if self.membership_mode == 'memberof':
+            # recover memberOf with the user entry
+            self.all_attrlist = [
+                self._byte_p2('*'),
+                self._byte_p2('memberOf'),
+                ]
+        # attributes recovered with DISPLAYED_ATTRS
+        # (None: all the attributes of attributes.yml)
+        self.displayed_attrlist = None
         self.objectclasses = []
         self.key = key
         # objectclasses parameter is a coma separated list in configuration
@@ -91,6 +195,168 @@ class Backend(ldapcherry.backend.Backend):
         for a in attrslist:
             self.attrlist.append(self._byte_p2(a))
 
+        self._init_attrlists()
+        self._init_filters()
+        self._init_decoding()
+        self._init_servers()
+        self._init_options()
+        self._init_pool()
+
+    def set_displayed_attrs(self, attrslist):
+        """Recover only the displayed attributes (and the key)
+        in the user searches"""
+        self.displayed_attrlist = []
+        for a in attrslist:
+            self.displayed_attrlist.append(self._byte_p2(a))
+        if self._byte_p2(self.key) not in self.displayed_attrlist:
+            self.displayed_attrlist.append(self._byte_p2(self.key))
+        self._init_attrlists()
+        # the search refiner depends on the attributes returned
+        self._init_filters()
+
+    def _init_attrlists(self):
+        """Plan the attributes recovered by each kind of search,
+        only requesting what its callers use"""
+        # attributes filling the group attributes templates
+        # (the dn comes with every entry)
+        membership = [
+            self._byte_p2(a) for a in sorted(self.group_attrs_keys)
+            if a.lower() != 'dn'
+            ]
+        displayed = self.displayed_attrlist
+        if displayed is None:
+            displayed = self.attrlist
+        memberof = [self._byte_p2('memberOf')]
+        self._attrlists = {
+            # the dn only (authentication, groups searches...)
+            NO_ATTR: NO_ATTR_LIST,
+            # users searches
+            DISPLAYED_ATTRS: displayed,
+            LISTED_ATTRS: self.attrlist,
+            # modifications of the groups of a user
+            MEMBERSHIP_ATTRS: membership or NO_ATTR_LIST,
+            # groups of a user read from its entry
+            MEMBEROF_ATTRS: memberof,
+            # get_user() (None: all user attributes)
+            ALL_ATTRS: self.all_attrlist,
+            }
+        if self.membership_mode == 'memberof':
+            # the lookups of the dn (auth()...) also recover memberOf,
+            # get_groups() then finds it in the request cache
+            self._attrlists[NO_ATTR] = memberof
+
+    def _plan_covers(self, cached, attrs):
+        """check if an entry recovered with plan **cached**
+        has the attributes of plan **attrs**"""
+        if cached == attrs or cached == ALL_ATTRS:
+            return True
+        # all the user attributes (None), only a complete entry has them
+        if self._attrlist(attrs) is None or self._attrlist(cached) is None:
+            return False
+        have = set([self._uni(a).lower() for a in self._attrlist(cached)])
+        want = set([self._uni(a).lower() for a in self._attrlist(attrs)])
+        want.discard('1.1')
+        return want <= have
+
+    def _init_decoding(self):
+        """Set the attributes decoded to unicode in the search results,
+        the other ones (binary attributes...) are left as bytes
+        """
+        # lowered names of the attributes ldapcherry uses:
+        # attributes of attributes.yml, attributes filling the group
+        # attributes templates, and memberOf
+        self._decoded = set([self._uni(a).lower() for a in self.attrlist])
+        self._decoded |= set([a.lower() for a in self.group_attrs_keys])
+        self._decoded.add('memberof')
+        # {<attribute name as returned>: <decoded or not>}
+        self._decode_attr = {}
+
+    def _init_filters(self):
+        """Compile the filter templates"""
+        self.user_filter = FilterTemplate(self.user_filter_tmpl)
+        self.group_filter = FilterTemplate(self.group_filter_tmpl)
+        self.search_filter = FilterTemplate(self.search_filter_tmpl)
+        self.search_refiner = SearchRefiner(
+            self.search_filter.template,
+            self._attrlist(DISPLAYED_ATTRS),
+            )
+
+    @staticmethod
+    def _split_uris(uris):
+        """get the list of uris of a parameter
+        (several servers separated by spaces or commas)"""
+        if isinstance(uris, (list, tuple)):
+            return list(uris)
+        return [u for u in re.split(r'[\s,]+', uris) if u]
+
+    def _server_set(self, name, uris):
+        return ServerSet(
+            name,
+            uris,
+            self._probe,
+            max_failures=int(self.get_param('servers.max_failures', 3)),
+            backoff=float(self.get_param('servers.backoff', 5)),
+            max_backoff=float(self.get_param('servers.max_backoff', 300)),
+            probe_interval=float(
+                self.get_param('servers.probe_interval', 10)
+                ),
+            )
+
+    def _init_servers(self):
+        """Initialize the servers of the backend, the writes go
+        to write_uri, the reads to read_uris (both default to uri)"""
+        write = self._split_uris(self.get_param('write_uri', self.uri))
+        if not write:
+            raise MissingParameter('backends', self.backend_name + '.uri')
+        read = self._split_uris(self.get_param('read_uris', self.uri))
+        read = read or write
+        self.uris = write + [u for u in read if u not in write]
+        self.servers = self._server_set(self.backend_name, write)
+        if read == write:
+            self.read_servers = self.servers
+        else:
+            self.read_servers = self._server_set(
+                self.backend_name + '-read',
+                read,
+                )
+        # read-your-writes: after a write, the reads about the user
+        # (and the searches) go to the write servers for a while
+        self.written = TTLCache(
+            max_size=int(self.get_param('read_your_writes.max_size', 1000)),
+            ttl=float(self.get_param('read_your_writes.ttl', 10)),
+            )
+        self.last_write = 0
+
+    def _init_pool(self):
+        """Initialize the pool of connections bound with
+        the technical account"""
+        self.pool = ConnectionPool(
+            self.backend_name,
+            self._bind,
+            self._check_connection,
+            self._unbind,
+            max_size=int(self.get_param('pool.max_size', 10)),
+            idle_timeout=int(self.get_param('pool.idle_timeout', 300)),
+            broken=(ldap.SERVER_DOWN,),
+            on_broken=self._connection_broken,
+            )
+        self.read_pool = self.pool
+        if self.read_servers is not self.servers:
+            self.read_pool = ConnectionPool(
+                self.backend_name + '-read',
+                self._bind_read,
+                self._check_connection,
+                self._unbind,
+                max_size=int(self.get_param('pool.max_size', 10)),
+                idle_timeout=int(self.get_param('pool.idle_timeout', 300)),
+                broken=(ldap.SERVER_DOWN,),
+                on_broken=self._connection_broken,
+                )
+        # unfinished paged searches, the server ties the paging state
+        # to their connections, taken out of the pool
+        self._cursors = OrderedDict()
+        self._cursors_lock = threading.Lock()
+
     # exception handler (mainly to log something meaningful)
     def _exception_handler(self, e):
         """ Exception handling"""
@@ -99,7 +365,7 @@ class Backend(ldapcherry.backend.Backend):
             self._logger(
                 severity=logging.ERROR,
                 msg="cannot use starttls with ldaps://"
-                    " uri (uri: " + self.uri + ")",
+                    " uri (uri: " + ' '.join(self.uris) + ")",
             )
         elif et is ldap.INVALID_CREDENTIALS:
             self._logger(
@@ -111,7 +377,7 @@ class Backend(ldapcherry.backend.Backend):
             self._logger(
                 severity=logging.ERROR,
                 msg="Unable to contact ldap server '" +
-                    self.uri +
+                    ' '.join(self.uris) +
                     "', check 'auth.ldap.uri'"
                     " and ssl/tls configuration",
                 )
@@ -191,45 +457,46 @@ class Backend(ldapcherry.backend.Backend):
             if type(attrs[key]) is list and len(attrs[key]) != 1:
                 raise MultivaluedGroupAttr(key)
 
-    def _connect(self):
-        """Initialize an ldap client"""
-        ldap_client = ldap.initialize(self.uri)
-        ldap.set_option(ldap.OPT_REFERRALS, 0)
-        ldap.set_option(ldap.OPT_TIMEOUT, self.timeout)
-        if self.starttls == 'on':
-            ldap.set_option(ldap.OPT_X_TLS_DEMAND, True)
-        else:
-            ldap.set_option(ldap.OPT_X_TLS_DEMAND, False)
-        # set the CA file if declared and if necessary
+    def _init_options(self):
+        """Prepare the options of the connections
+
+        The options are set on each connection, not with the global
+        ldap.set_option() (shared by all the threads and backends).
+        """
+        self.options = [
+            (ldap.OPT_REFERRALS, 0),
+            (ldap.OPT_TIMEOUT, self.timeout),
+            # connecting to a dead server fails fast
+            (ldap.OPT_NETWORK_TIMEOUT, self.network_timeout),
+            ]
+        ldaps = [u for u in self.uris if u.lower().startswith('ldaps://')]
+        if self.starttls != 'on' and not ldaps:
+            return
         if self.ca and self.checkcert == 'on':
-            # check if the CA file actually exists
-            if os.path.isfile(self.ca):
-                ldap.set_option(ldap.OPT_X_TLS_CACERTFILE, self.ca)
-            else:
-                raise CaFileDontExist(self.ca)
+            self.options.append((ldap.OPT_X_TLS_CACERTFILE, self.ca))
         if self.checkcert == 'off':
-            # this is dark magic
-            # remove any of these two lines and it doesn't work
-            ldap.set_option(ldap.OPT_X_TLS_REQUIRE_CERT, ldap.OPT_X_TLS_NEVER)
-            ldap_client.set_option(
-                ldap.OPT_X_TLS_REQUIRE_CERT,
-                ldap.OPT_X_TLS_NEVER
-                )
+            require_cert = ldap.OPT_X_TLS_NEVER
         else:
-            # this is even darker magic
-            ldap_client.set_option(
-                ldap.OPT_X_TLS_REQUIRE_CERT,
-                ldap.OPT_X_TLS_DEMAND
-                )
-            # it doesn't make sense to set it to never
-            # (== don't check certifate)
-            # but it only works with this option...
-            # ... and it checks the certificat
-            # (I've lost my sanity over this)
-            ldap.set_option(
-                ldap.OPT_X_TLS_REQUIRE_CERT,
-                ldap.OPT_X_TLS_NEVER
-                )
+            require_cert = ldap.OPT_X_TLS_DEMAND
+        self.options.append((ldap.OPT_X_TLS_REQUIRE_CERT, require_cert))
+        # the tls options of a connection only apply once its
+        # tls context is created (last)
+        self.options.append((ldap.OPT_X_TLS_NEWCTX, 0))
+
+    def _connect(self, server=None):
+        """Initialize an ldap client
+        @server: server to connect to (default: the best one)
+        """
+        # check if the CA file actually exists
+        if self.ca and self.checkcert == 'on' and \
+                not os.path.isfile(self.ca):
+            raise CaFileDontExist(self.ca)
+        if server is None:
+            server = self.servers.best()
+        ldap_client = ldap.initialize(server.uri)
+        ldap_client.ldapcherry_server = server
+        for option, value in self.options:
+            ldap_client.set_option(option, value)
         if self.starttls == 'on':
             try:
                 ldap_client.start_tls_s()
@@ -237,29 +504,167 @@ class Backend(ldapcherry.backend.Backend):
                 self._exception_handler(e)
         return ldap_client
 
-    def _bind(self):
+    def _open(self, binddn, password, servers=None):
+        """connect and bind, to the best server answering
+        (the next servers are tried while the servers are down)
+        @servers: ServerSet to use (default: the write servers)
+        """
+        if servers is None:
+            servers = self.servers
+        error = None
+        for server in servers.candidates():
+            start = time.time()
+            ldap_client = None
+            try:
+                ldap_client = self._connect(server)
+                ldap_client.simple_bind_s(binddn, password)
+            except (ldap.SERVER_DOWN, ldap.TIMEOUT) as e:
+                servers.failure(server)
+                self._unbind_quietly(ldap_client)
+                error = error or e
+                continue
+            except Exception:
+                # the server answered
+                servers.success(server, time.time() - start)
+                self._unbind_quietly(ldap_client)
+                raise
+            servers.success(server, time.time() - start)
+            return ldap_client
+        raise error
+
+    @staticmethod
+    def _unbind_quietly(ldap_client):
+        if ldap_client is None:
+            return
+        try:
+            ldap_client.unbind_s()
+        except Exception:
+            pass
+
+    def _bind(self, servers=None):
         """bind to the ldap with the technical account"""
-        ldap_client = self._connect()
         try:
-            ldap_client.simple_bind_s(self.binddn, self.bindpassword)
+            return self._open(self.binddn, self.bindpassword, servers)
         except Exception as e:
-            ldap_client.unbind_s()
             self._exception_handler(e)
-        return ldap_client
 
-    def _search(self, searchfilter, attrs, basedn):
-        """Generic search"""
-        if attrs == NO_ATTR:
-            attrlist = []
-        elif attrs == DISPLAYED_ATTRS:
-            # fix me later (to much attributes)
-            attrlist = self.attrlist
-        elif attrs == LISTED_ATTRS:
-            attrlist = self.attrlist
-        elif attrs == ALL_ATTRS:
-            attrlist = None
-        else:
-            attrlist = None
+    def close(self):
+        """stop the checks of the servers, close the idle connections
+        and the unfinished paged searches"""
+        self.servers.stop()
+        self.read_servers.stop()
+        with self._cursors_lock:
+            cursors = [c[3] for c in self._cursors.values()]
+            self._cursors.clear()
+        self._discard_cursors(cursors)
+        self.pool.clear()
+        self.read_pool.clear()
+
+    def _bind_read(self):
+        """bind to a read server with the technical account"""
+        return self._bind(self.read_servers)
+
+    def _record_write(self, username):
+        """record a write on a user (see _reads_on_writer())"""
+        self.written.set(self._uni(username), True)
+        self.last_write = time.time()
+
+    def _reads_on_writer(self, username=None):
+        """check if the reads about a user (the searches if
+        **username** is None) must go to the write servers, to see
+        what was just written there"""
+        if self.read_servers is self.servers:
+            return True
+        if username is None:
+            return time.time() - self.last_write < self.written.ttl
+        return self.written.get(self._uni(username)) is not None
+
+    def _read_pool(self, username=None):
+        """get the pool for the reads about a user
+        (the searches if **username** is None)"""
+        if self._reads_on_writer(username):
+            return self.pool
+        return self.read_pool
+
+    def _read_servers(self, username=None):
+        """get the servers for the reads about a user
+        (the searches if **username** is None)"""
+        if self._reads_on_writer(username):
+            return self.servers
+        return self.read_servers
+
+    def _probe(self, server):
+        """check that a server answers (see ServerSet)"""
+        ldap_client = self._connect(server)
+        try:
+            ldap_client.simple_bind_s(self.binddn, self.bindpassword)
+        finally:
+            self._unbind_quietly(ldap_client)
+
+    def _connection_broken(self, ldap_client):
+        """record the error of the server of a broken pooled connection"""
+        server = getattr(ldap_client, 'ldapcherry_server', None)
+        if server is not None:
+            self.servers.failure(server)
+
+    def _check_connection(self, ldap_client):
+        """check that a pooled connection is still usable
+        (and that its server was not ejected meanwhile)"""
+        server = getattr(ldap_client, 'ldapcherry_server', None)
+        if server is not None and server.ejected:
+            return False
+        ldap_client.whoami_s()
+        return True
+
+    @staticmethod
+    def _unbind(ldap_client):
+        """close a pooled connection"""
+        ldap_client.unbind_s()
+
+    def _attrlist(self, attrs):
+        """get the list of attributes to recover (see _init_attrlists())"""
+        return self._attrlists.get(attrs, self.all_attrlist)
+
+    def _decode_entry(self, entry, unwrap=False):
+        """convert an entry returned by python-ldap to unicode, in one pass
+        @bool unwrap: replace the lists of one value by the value
+        @rtype: tuple, (<dn>, {<attr>: <value or list of values>})
+        """
+        # python-ldap doesn't know utf-8,
+        # it treates everything as bytes.
+        # So it's necessary to reencode
+        # it's output in utf-8.
+        # Only the attributes ldapcherry uses are decoded, the other
+        # ones are kept as is (no copy)
+        uni = self._uni
+        decode_attr = self._decode_attr
+        attrs = {}
+        for attr, values in entry[1].items():
+            decode = decode_attr.get(attr)
+            if decode is None:
+                decode = uni(attr).lower() in self._decoded
+                decode_attr[attr] = decode
+            if type(values) is not list:
+                values = uni(values) if decode else values
+            else:
+                if decode:
+                    values = [uni(value) for value in values]
+                if unwrap and len(values) == 1:
+                    values = values[0]
+            attrs[uni(attr)] = values
+        return (uni(entry[0]), attrs)
+
+    def _uni_entries(self, r):
+        """convert the result of a search to unicode"""
+        return [self._decode_entry(entry) for entry in r]
+
+    def _search(self, searchfilter, attrs, basedn, pool=None, decode=True):
+        """Generic search
+        @pool: pool of the connection to use (default: the write pool)
+        @bool decode: convert the entries to unicode (else, they are
+        returned as python-ldap returns them)
+        """
+        attrlist = self._attrlist(attrs)
 
         self._logger(
             severity=logging.DEBUG,
@@ -271,59 +676,172 @@ class Backend(ldapcherry.backend.Backend):
                 }
         )
 
-        # bind and search the ldap
-        ldap_client = self._bind()
+        # search the ldap with a pooled connection,
+        # (retry once if the pooled connection was dead)
         try:
-            r = ldap_client.search_s(
-                basedn,
-                ldap.SCOPE_SUBTREE,
-                searchfilter,
-                attrlist=attrlist
+            r = self._search_s(searchfilter, attrlist, basedn, pool)
+        except ldap.SERVER_DOWN:
+            r = self._search_s(searchfilter, attrlist, basedn, pool)
+        if not decode:
+            return r
+        return self._uni_entries(r)
+
+    def _search_s(self, searchfilter, attrlist, basedn, pool=None):
+        with (pool or self.pool).connection() as ldap_client:
+            try:
+                return ldap_client.search_s(
+                    basedn,
+                    ldap.SCOPE_SUBTREE,
+                    searchfilter,
+                    attrlist=attrlist
+                    )
+            except Exception as e:
+                self._exception_handler(e)
+
+    def _search_page_s(self, ldap_client, searchfilter, attrlist, basedn,
+                       cookie, size=None):
+        """Get one page of a paged search (RFC 2696)
+        on a given connection
+        @rtype: tuple, (<entries>, <cookie of the next page or None>)
+        """
+        if size is None:
+            size = self.page_size
+        page = PagedSearch(
+            self, ldap_client, searchfilter, attrlist, basedn, cookie, size
+            )
+        entries = list(page)
+        return (entries, page.cookie)
+
+    def _abandon_page_s(self, ldap_client, searchfilter, basedn, cookie):
+        """Release the server side state of an unfinished paged search"""
+        try:
+            self._search_page_s(
+                ldap_client, searchfilter, [], basedn, cookie, size=0
                 )
-        except Exception as e:
-            ldap_client.unbind_s()
-            self._exception_handler(e)
+        except Exception:
+            pass
 
-        ldap_client.unbind_s()
+    def _discard_cursors(self, cursors):
+        """close the connections of dropped paged searches
+        @list cursors: list of connections
+        """
+        for ldap_client in cursors:
+            self._unbind_quietly(ldap_client)
 
-        # python-ldap doesn't know utf-8,
-        # it treates everything as bytes.
-        # So it's necessary to reencode
-        # it's output in utf-8.
-        ret = []
-        for entry in r:
-            uni_dn = self._uni(entry[0])
-            uni_attrs = {}
-            for attr in entry[1]:
-                if type(entry[1][attr]) is list:
-                    tmp = []
-                    for value in entry[1][attr]:
-                        tmp.append(self._uni(value))
-                else:
-                    tmp = self._uni(entry[1][attr])
-                uni_attrs[self._uni(attr)] = tmp
-            ret.append((uni_dn, uni_attrs))
-        return ret
+    def _reap_cursors(self, now):
+        """remove the expired cursors,
+        must be called with the lock held
+        """
+        expired = []
+        for cursor_id in list(self._cursors):
+            if self._cursors[cursor_id][0] > now:
+                break
+            expired.append(self._cursors.pop(cursor_id)[3])
+        return expired
+
+    def _push_cursor(self, searchfilter, pool, ldap_client, cookie, offset):
+        """keep an unfinished paged search open, its connection
+        is taken out of **pool** (see ConnectionPool.detach())
+        @rtype: string, id of the cursor
+        """
+        cursor_id = uuid.uuid4().hex
+        now = time.time()
+        pool.detach(ldap_client)
+        with self._cursors_lock:
+            expired = self._reap_cursors(now)
+            # close the oldest searches beyond MAX_CURSORS
+            while len(self._cursors) >= MAX_CURSORS:
+                expired.append(self._cursors.popitem(last=False)[1][3])
+            self._cursors[cursor_id] = (
+                now + CURSOR_TIMEOUT, searchfilter, pool, ldap_client,
+                cookie, offset
+                )
+        self._discard_cursors(expired)
+        return cursor_id
 
-    def _get_user(self, username, attrs=ALL_ATTRS):
-        """Get a user from the ldap"""
+    def _pop_cursor(self, cursor_id, searchfilter):
+        """get back an unfinished paged search, its connection
+        is lent by its pool again (see ConnectionPool.attach())
+        @rtype: tuple, (<pool>, <connection>, <cookie>, <offset>)
+            or None if not found
+        """
+        with self._cursors_lock:
+            expired = self._reap_cursors(time.time())
+            cursor = self._cursors.pop(cursor_id, None)
+        self._discard_cursors(expired)
+        if cursor is None:
+            return None
+        expire, cursor_filter, pool, ldap_client, cookie, offset = cursor
+        # cursor used with another search, start over
+        if cursor_filter != searchfilter:
+            self._unbind_quietly(ldap_client)
+            return None
+        pool.attach(ldap_client)
+        return (pool, ldap_client, cookie, offset)
 
-        username = ldap.filter.escape_filter_chars(username)
-        user_filter = self.user_filter_tmpl % {
-            'username': self._uni(username)
-        }
-        r = self._search(self._byte_p2(user_filter), attrs, self.userdn)
+    def _request_cache(self):
+        """Get the user entries cache of the current cherrypy request
+        (None outside of a request)
+        The cache is dropped with the request object, so a user
+        is looked up at most once per request and per backend.
+        """
+        request = cherrypy.serving.request
+        if request.app is None:
+            return None
+        # setdefault is atomic, the request can be shared by the
+        # threads querying the backends concurrently
+        caches = request.__dict__.setdefault('ldapcherry_users', {})
+        return caches.setdefault(self.backend_name, {})
+
+    def _cache_user(self, username, dn, attrs, plan=ALL_ATTRS):
+        """Store (or replace) a user entry in the request cache,
+        as python-ldap returns it (it's decoded when read)
+        @int plan: attributes recovered (see _init_attrlists())
+        """
+        cache = self._request_cache()
+        if cache is not None:
+            cache[self._uni(username)] = (dn, attrs, plan)
+
+    def _forget_user(self, username):
+        """Remove a user entry from the request cache"""
+        cache = self._request_cache()
+        if cache is not None:
+            cache.pop(self._uni(username), None)
+
+    def _get_user(self, username, attrs=ALL_ATTRS, unwrap=False):
+        """Get a user from the ldap
+        @bool unwrap: replace the lists of one value by the value
+        """
+
+        # reuse the entry if already recovered during this request
+        cache = self._request_cache()
+        key = self._uni(username)
+        if cache is not None and key in cache:
+            dn, cached_attrs, plan = cache[key]
+            if attrs == NO_ATTR:
+                return self._uni(dn)
+            # a complete entry has the attributes of any other plan
+            elif self._plan_covers(plan, attrs):
+                # decoding builds a new dict, callers can modify it
+                return self._decode_entry((dn, cached_attrs), unwrap)
+
+        r = self._search(
+            self._user_filter(username),
+            attrs,
+            self.userdn,
+            self._read_pool(username),
+            decode=False,
+            )
 
         if len(r) == 0:
             return None
 
+        self._cache_user(key, r[0][0], r[0][1], attrs)
         # if NO_ATTR, only return the DN
         if attrs == NO_ATTR:
-            dn_entry = r[0][0]
+            return self._uni(r[0][0])
         # in other cases, return everything (dn + attributes)
-        else:
-            dn_entry = r[0]
-        return dn_entry
+        return self._decode_entry(r[0], unwrap)
 
     # python-ldap talks in bytes,
     # as the rest of ldapcherry talks in unicode utf-8:
@@ -401,14 +919,13 @@ class Backend(ldapcherry.backend.Backend):
 
         binddn = self._get_user(self._byte_p2(username), NO_ATTR)
         if binddn is not None:
-            ldap_client = self._connect()
             try:
-                ldap_client.simple_bind_s(
+                ldap_client = self._open(
                         self._byte_p2(binddn),
-                        self._byte_p2(password)
+                        self._byte_p2(password),
+                        self._read_servers(username),
                         )
             except ldap.INVALID_CREDENTIALS:
-                ldap_client.unbind_s()
                 return False
             ldap_client.unbind_s()
             return True
@@ -427,7 +944,7 @@ class Backend(ldapcherry.backend.Backend):
 
     def add_user(self, attrs):
         """add a user"""
-        ldap_client = self._bind()
+        self._record_write(attrs[self.key])
         # encoding crap
         attrs_srt = self.attrs_pretreatment(attrs)
 
@@ -444,113 +961,231 @@ class Backend(ldapcherry.backend.Backend):
             self._byte_p2(self.userdn)
         # gen the ldif first add_s and add the user
         ldif = modlist.addModlist(attrs_srt)
-        try:
-            ldap_client.add_s(dn, ldif)
-        except ldap.ALREADY_EXISTS as e:
-            raise UserAlreadyExists(attrs[self.key], self.backend_name)
-        except Exception as e:
-            ldap_client.unbind_s()
-            self._exception_handler(e)
-        ldap_client.unbind_s()
+        with self.pool.connection() as ldap_client:
+            try:
+                ldap_client.add_s(dn, ldif)
+            except ldap.ALREADY_EXISTS as e:
+                raise UserAlreadyExists(attrs[self.key], self.backend_name)
+            except Exception as e:
+                self._exception_handler(e)
 
     def del_user(self, username):
         """delete a user"""
-        ldap_client = self._bind()
+        self._record_write(username)
         # recover the user dn
         dn = self._byte_p2(self._get_user(self._byte_p2(username), NO_ATTR))
+        if dn is None:
+            raise UserDoesntExist(username, self.backend_name)
         # delete
-        if dn is not None:
+        with self.pool.connection() as ldap_client:
             ldap_client.delete_s(dn)
-        else:
-            ldap_client.unbind_s()
-            raise UserDoesntExist(username, self.backend_name)
-        ldap_client.unbind_s()
+        self._forget_user(username)
+
+    def _failed_attrs(self, e, attrs):
+        """guess the attributes responsible for a modification error
+        from the diagnostic message of the server
+        """
+        try:
+            info = self._uni(e.args[0]['info']).lower()
+        except (IndexError, KeyError, TypeError, AttributeError):
+            return attrs
+        ret = [attr for attr in attrs if attr.lower() in info]
+        return ret or attrs
 
     def set_attrs(self, username, attrs):
         """ set user attributes"""
-        ldap_client = self._bind()
+        self._record_write(username)
         tmp = self._get_user(self._byte_p2(username), ALL_ATTRS)
         if tmp is None:
             raise UserDoesntExist(username, self.backend_name)
         dn = self._byte_p2(tmp[0])
         old_attrs = tmp[1]
-        for attr in attrs:
-            bcontent = self._byte_p2(attrs[attr])
-            battr = self._byte_p2(attr)
-            new = {battr: self._modlist(self._byte_p3(bcontent))}
-            # if attr is dn entry, use rename
-            if attr.lower() == self.dn_user_attr.lower():
-                ldap_client.rename_s(
-                    dn,
-                    ldap.dn.dn2str([[(battr, bcontent, 1)]])
-                    )
-                dn = ldap.dn.dn2str(
-                    [[(battr, bcontent, 1)]] + ldap.dn.str2dn(dn)[1:]
-                    )
-            else:
+        # all the attributes are changed in one modification,
+        # only the changed values are sent
+        ldif = []
+        changed = []
+        with self.pool.connection() as ldap_client:
+            for attr in attrs:
+                bcontent = self._byte_p2(attrs[attr])
+                battr = self._byte_p2(attr)
+                new = {battr: self._modlist(self._byte_p3(bcontent))}
+                # if attr is dn entry, use rename (first, the other
+                # attributes are set on the renamed entry)
+                if attr.lower() == self.dn_user_attr.lower():
+                    rdn = [[(battr, bcontent, 1)]]
+                    if ldap.dn.str2dn(dn)[0] == rdn[0]:
+                        continue
+                    ldap_client.rename_s(dn, ldap.dn.dn2str(rdn))
+                    dn = ldap.dn.dn2str(rdn + ldap.dn.str2dn(dn)[1:])
+                    continue
                 # if attr is already set, replace the value
-                # (see dict old passed to modifyModlist)
+                # (see dict old passed to modifyModlist), old values
+                # are encoded like the new ones to skip unchanged ones
                 if attr in old_attrs:
                     if type(old_attrs[attr]) is list:
                         tmp = []
                         for value in old_attrs[attr]:
-                            tmp.append(self._byte_p2(value))
+                            tmp.append(self._byte_p3(self._byte_p2(value)))
                         bold_value = tmp
                     else:
                         bold_value = self._modlist(
-                            self._byte_p3(old_attrs[attr])
+                            self._byte_p3(self._byte_p2(old_attrs[attr]))
                         )
                     old = {battr: bold_value}
                 # attribute is not set, just add it
                 else:
                     old = {}
-                ldif = modlist.modifyModlist(old, new)
-                if ldif:
-                    try:
-                        ldap_client.modify_s(dn, ldif)
-                    except Exception as e:
-                        ldap_client.unbind_s()
-                        self._exception_handler(e)
+                attr_ldif = modlist.modifyModlist(old, new)
+                if attr_ldif:
+                    ldif.extend(attr_ldif)
+                    changed.append(attr)
+            if ldif:
+                try:
+                    ldap_client.modify_s(dn, ldif)
+                except Exception as e:
+                    self._forget_user(username)
+                    self._logger(
+                        severity=logging.ERROR,
+                        msg="%(backend)s: failed to set attribute(s)"
+                            " %(attrs)s of user '%(user)s'" % {
+                                'attrs': ', '.join(
+                                    self._failed_attrs(e, changed)
+                                ),
+                                'user': username,
+                                'backend': self.backend_name,
+                                }
+                    )
+                    self._exception_handler(e)
 
-        ldap_client.unbind_s()
+        # keep the request cache in sync with what was just written
+        # (encoded like python-ldap returns them, see _cache_user())
+        cache = self._request_cache()
+        key = self._uni(username)
+        if cache is not None and key in cache:
+            new_attrs = dict(cache[key][1])
+            for attr in attrs:
+                new_attrs[attr] = [self._byte_p3(self._byte_p2(attrs[attr]))]
+            self._cache_user(username, dn, new_attrs)
 
-    def add_to_groups(self, username, groups):
-        ldap_client = self._bind()
-        # recover dn of the user and his attributes
-        tmp = self._get_user(self._byte_p2(username), ALL_ATTRS)
-        dn = tmp[0]
+    def _normalize_dn(self, dn):
+        """normalize a dn for comparisons"""
+        dn = self._uni(dn)
+        try:
+            dn = ldap.dn.dn2str(ldap.dn.str2dn(dn))
+        except ldap.DECODING_ERROR:
+            pass
+        return dn.lower()
+
+    def _under_dn(self, ndn, dn):
+        """check if a normalized dn is in **dn** subtree"""
+        base = self._normalize_dn(dn)
+        return ndn == base or ndn.endswith(',' + base)
+
+    def _under_groupdn(self, ndn):
+        """check if a normalized dn is in groupdn subtree"""
+        return self._under_dn(ndn, self.groupdn)
+
+    def _membership(self, ldap_client, contents):
+        """get the groups of groupdn the user is member of,
+        one search per membership attribute
+        @dict contents: {<attr>: <membership value of the user>}
+        @rtype: dict, {<attr>: set([<normalized group dn>])}
+        """
+        ret = {}
+        for attr in contents:
+            searchfilter = '(%(attr)s=%(value)s)' % {
+                'attr': attr,
+                'value': ldap.filter.escape_filter_chars(contents[attr]),
+            }
+            try:
+                r = ldap_client.search_s(
+                    self._byte_p2(self.groupdn),
+                    ldap.SCOPE_SUBTREE,
+                    searchfilter,
+                    attrlist=NO_ATTR_LIST
+                    )
+            except Exception as e:
+                self._exception_handler(e)
+            ret[attr] = set([self._normalize_dn(dn) for dn, a in r if dn])
+        return ret
+
+    def _modify_groups(self, ldap_client, mods):
+        """send the group modifications without waiting for each
+        answer, then collect the answers
+        @list mods: [(<group>, <attr>, <ldif>)]
+        @rtype: list, [(<group>, <attr>, <exception or None>)]
+        """
+        sent = []
+        ret = []
+        try:
+            for group, attr, ldif in mods:
+                sent.append((group, attr, ldap_client.modify_ext(group, ldif)))
+        finally:
+            # read every answer before the connection goes back to the pool
+            for group, attr, msgid in sent:
+                try:
+                    ldap_client.result3(msgid)
+                    ret.append((group, attr, None))
+                except ldap.LDAPError as e:
+                    ret.append((group, attr, e))
+        return ret
+
+    def _group_contents(self, username):
+        """get the values identifying the user in the groups
+        @rtype: dict, {<group attr>: <value>}
+        """
+        tmp = self._get_user(self._byte_p2(username), MEMBERSHIP_ATTRS)
+        if tmp is None:
+            raise UserDoesntExist(username, self.backend_name)
         attrs = tmp[1]
-        attrs['dn'] = dn
+        attrs['dn'] = tmp[0]
         self._normalize_group_attrs(attrs)
-        dn = self._byte_p2(tmp[0])
-        # add user to all groups
-        for group in groups:
-            group = self._byte_p2(group)
-            # iterate on group membership attributes
-            for attr in self.group_attrs:
-                # fill the content template
-                content = self._byte_p2(self.group_attrs[attr] % attrs)
-                self._logger(
-                    severity=logging.DEBUG,
-                    msg="%(backend)s: adding user '%(user)s'"
-                        " with dn '%(dn)s' to group '%(group)s' by"
-                        " setting '%(attr)s' to '%(content)s'" % {
-                            'user': username,
-                            'dn': self._uni(dn),
-                            'group': self._uni(group),
-                            'attr': attr,
-                            'content': self._uni(content),
-                            'backend': self.backend_name
-                            }
-                )
-                ldif = modlist.modifyModlist(
-                        {},
-                        {attr: self._modlist(self._byte_p3(content))}
-                       )
-                try:
-                    ldap_client.modify_s(group, ldif)
-                # if already member, not a big deal, just log it and continue
-                except (ldap.TYPE_OR_VALUE_EXISTS, ldap.ALREADY_EXISTS) as e:
+        contents = {}
+        for attr in self.group_attrs:
+            # fill the content template
+            contents[attr] = self._byte_p2(self.group_attrs[attr] % attrs)
+        return contents
+
+    def add_to_groups(self, username, groups):
+        self._record_write(username)
+        contents = self._group_contents(username)
+        with self.pool.connection() as ldap_client:
+            if self.groups_check:
+                member = self._membership(ldap_client, contents)
+            mods = []
+            # add user to all groups
+            for group in groups:
+                ngroup = self._normalize_dn(group)
+                group = self._byte_p2(group)
+                # iterate on group membership attributes
+                for attr in self.group_attrs:
+                    content = contents[attr]
+                    if self.groups_check and self._under_groupdn(ngroup) \
+                            and ngroup in member[attr]:
+                        continue
+                    self._logger(
+                        severity=logging.DEBUG,
+                        msg="%(backend)s: adding user '%(user)s'"
+                            " to group '%(group)s' by"
+                            " setting '%(attr)s' to '%(content)s'" % {
+                                'user': username,
+                                'group': self._uni(group),
+                                'attr': attr,
+                                'content': self._uni(content),
+                                'backend': self.backend_name
+                                }
+                    )
+                    ldif = modlist.modifyModlist(
+                            {},
+                            {attr: self._modlist(self._byte_p3(content))}
+                           )
+                    mods.append((group, attr, ldif))
+            error = None
+            for group, attr, e in self._modify_groups(ldap_client, mods):
+                # if already member, not a big deal,
+                # just log it and continue
+                if isinstance(e, (ldap.TYPE_OR_VALUE_EXISTS,
+                                  ldap.ALREADY_EXISTS)):
                     self._logger(
                         severity=logging.INFO,
                         msg="%(backend)s: user '%(user)s'"
@@ -562,34 +1197,56 @@ class Backend(ldapcherry.backend.Backend):
                                 'backend': self.backend_name
                                 }
                     )
-                except ldap.NO_SUCH_OBJECT as e:
-                    raise GroupDoesntExist(group, self.backend_name)
-                except Exception as e:
-                    ldap_client.unbind_s()
-                    self._exception_handler(e)
-        ldap_client.unbind_s()
+                elif isinstance(e, ldap.NO_SUCH_OBJECT):
+                    error = error or GroupDoesntExist(
+                        group,
+                        self.backend_name,
+                        )
+                elif e is not None:
+                    error = error or e
+            self._forget_memberof(username)
+            self._raise_group_error(error)
+
+    def _forget_memberof(self, username):
+        """drop the memberOf of a user from the request cache,
+        outdated once its groups changed"""
+        if self.membership_mode == 'memberof':
+            self._forget_user(username)
+
+    def _raise_group_error(self, error):
+        """raise the first error of group requests"""
+        if error is None:
+            return
+        if isinstance(error, GroupDoesntExist):
+            raise error
+        try:
+            raise error
+        except Exception as e:
+            self._exception_handler(e)
 
     def del_from_groups(self, username, groups):
         """Delete user from groups"""
         # it follows the same logic than add_to_groups
         # but with MOD_DELETE
-        ldap_client = self._bind()
-        tmp = self._get_user(self._byte_p2(username), ALL_ATTRS)
-        if tmp is None:
-            raise UserDoesntExist(username, self.backend_name)
-        dn = tmp[0]
-        attrs = tmp[1]
-        attrs['dn'] = dn
-        self._normalize_group_attrs(attrs)
-        dn = self._byte_p2(tmp[0])
-        for group in groups:
-            group = self._byte_p2(group)
-            for attr in self.group_attrs:
-                content = self._byte_p2(self.group_attrs[attr] % attrs)
-                ldif = [(ldap.MOD_DELETE, attr, self._byte_p3(content))]
-                try:
-                    ldap_client.modify_s(group, ldif)
-                except ldap.NO_SUCH_ATTRIBUTE as e:
+        self._record_write(username)
+        contents = self._group_contents(username)
+        with self.pool.connection() as ldap_client:
+            if self.groups_check:
+                member = self._membership(ldap_client, contents)
+            mods = []
+            for group in groups:
+                ngroup = self._normalize_dn(group)
+                group = self._byte_p2(group)
+                for attr in self.group_attrs:
+                    content = contents[attr]
+                    if self.groups_check and self._under_groupdn(ngroup) \
+                            and ngroup not in member[attr]:
+                        continue
+                    ldif = [(ldap.MOD_DELETE, attr, self._byte_p3(content))]
+                    mods.append((group, attr, ldif))
+            error = None
+            for group, attr, e in self._modify_groups(ldap_client, mods):
+                if isinstance(e, ldap.NO_SUCH_ATTRIBUTE):
                     self._logger(
                         severity=logging.INFO,
                         msg="%(backend)s: user '%(user)s'"
@@ -601,64 +1258,322 @@ class Backend(ldapcherry.backend.Backend):
                             'backend': self.backend_name
                             }
                     )
-                except Exception as e:
-                    ldap_client.unbind_s()
-                    self._exception_handler(e)
-        ldap_client.unbind_s()
+                elif e is not None:
+                    error = error or e
+            self._forget_memberof(username)
+            self._raise_group_error(error)
+
+    def _search_filter(self, searchstring):
+        """build the filter of a user search"""
+        # the values are escaped to avoid injection
+        return self.search_filter.fill({
+            'searchstring': self._byte_p2(searchstring)
+        })
+
+    def _user_filter(self, username):
+        """build the filter getting a user"""
+        return self._byte_p2(self.user_filter.fill({
+            'username': self._uni(username)
+        }))
+
+    def _group_filter(self, username, userdn):
+        """build the filter getting the groups of a user
+        @rtype: the filter, None if the user doesn't exist
+            and the filter needs its dn
+        """
+        if userdn is None and 'userdn' in self.group_filter.keys:
+            return None
+        return self._byte_p2(self.group_filter.fill({
+            'userdn': self._uni(userdn or ''),
+            'username': self._uni(self._byte_p2(username)),
+        }))
+
+    def search_matcher(self, searchstring):
+        """refine the results of shorter search strings by evaluating
+        the search filter locally, possible only if appending characters
+        to the search string narrows search_filter_tmpl
+        (placeholders at the end of '<attr>=...*' assertions)
+        """
+        if not self.search_refiner.refinable:
+            return None
+        return self.search_refiner.matcher(
+            self._uni(self._search_filter(searchstring))
+        )
+
+    def _search_result(self, entry):
+        """process an entry found by a user search a little
+        @rtype: tuple, (<user key>, {<attr>: <value>}),
+            None if the entry has no key
+        """
+        attrs = self._decode_entry(entry, unwrap=True)[1]
+        if self.key in attrs:
+            return (attrs[self.key], attrs)
+        return None
+
+    def _search_results(self, entries, ret):
+        """process the entries found by a user search a little"""
+        for entry in entries:
+            user = self._search_result(entry)
+            if user is not None:
+                ret[user[0]] = user[1]
+        return ret
+
+    def _truncate(self, entries, offset, ldap_client, searchfilter, cookie):
+        """apply search.max_results
+        @rtype: tuple, (<entries>, <cookie of the next page or None>)
+        """
+        if not self.max_results or \
+                offset + len(entries) < self.max_results:
+            return (entries, cookie)
+        if cookie is not None:
+            self._logger(
+                severity=logging.WARNING,
+                msg="%(backend)s: search results truncated to "
+                    "%(max)d entries, see '%(backend)s.search.max_results'" %
+                    {'backend': self.backend_name, 'max': self.max_results}
+            )
+            self._abandon_page_s(ldap_client, searchfilter, self.userdn,
+                                 cookie)
+        return (entries[:max(self.max_results - offset, 0)], None)
+
+    def _search_all(self, searchfilter):
+        ret = {}
+        attrlist = self._attrlist(DISPLAYED_ATTRS)
+        with self._read_pool().connection() as ldap_client:
+            count = 0
+            cookie = ''
+            while cookie is not None:
+                entries, cookie = self._search_page_s(
+                    ldap_client, searchfilter, attrlist, self.userdn, cookie
+                    )
+                entries, cookie = self._truncate(
+                    entries, count, ldap_client, searchfilter, cookie
+                    )
+                count += len(entries)
+                self._search_results(entries, ret)
+        return ret
 
     def search(self, searchstring):
         """Search users"""
-        # escape special char to avoid injection
-        searchstring = ldap.filter.escape_filter_chars(
-            self._byte_p2(searchstring)
-        )
-        # fill the search string template
-        searchfilter = self.search_filter_tmpl % {
-            'searchstring': searchstring
-        }
+        searchfilter = self._search_filter(searchstring)
+        # get the results page by page (at most search.max_results)
+        # (retry once if the pooled connection was dead)
+        try:
+            return self._search_all(searchfilter)
+        except ldap.SERVER_DOWN:
+            return self._search_all(searchfilter)
+
+    def _open_page(self, cookie, searchfilter, attrlist):
+        """start the page of a paged search matching **cookie**
+        @rtype: tuple, (<PagedSearch>, <pool of its connection>, <offset>,
+            <entries to skip>)
+        """
+        offset = 0
+        cursor = None
+        if cookie:
+            cursor_id, sep, offset = cookie.partition(':')
+            try:
+                offset = int(offset)
+            except ValueError:
+                offset = 0
+            cursor = self._pop_cursor(cursor_id, searchfilter)
+
+        if cursor is not None:
+            # the offset kept with the cursor, not the one of the token
+            pool, ldap_client, ldap_cookie, offset = cursor
+            try:
+                page = PagedSearch(
+                    self, ldap_client, searchfilter, attrlist,
+                    self.userdn, ldap_cookie, self.page_size
+                    )
+                return (page, pool, offset, 0)
+            except ldap.SERVER_DOWN:
+                pool.broken(ldap_client)
+        # the entries to skip come from the client, bound them
+        # (a forged token must not walk the whole directory)
+        if offset < 0 or offset > (self.max_results or MAX_SKIP):
+            self._logger(
+                severity=logging.WARNING,
+                msg="%(backend)s: invalid offset %(offset)d in the page"
+                    " token, search started over" %
+                    {'backend': self.backend_name, 'offset': offset}
+            )
+            offset = 0
+        # new search, or the open search is lost (expired, connection
+        # closed...), start over with a pooled connection and skip what
+        # was already returned (retry once if the connection was dead)
+        pool = self._read_pool()
+        retry = True
+        while True:
+            ldap_client = pool.get()
+            try:
+                page = PagedSearch(
+                    self, ldap_client, searchfilter, attrlist,
+                    self.userdn, '', self.page_size
+                    )
+            except ldap.SERVER_DOWN:
+                pool.broken(ldap_client)
+                if retry:
+                    retry = False
+                    continue
+                raise
+            except Exception:
+                pool.put(ldap_client)
+                raise
+            return (page, pool, offset, offset)
+
+    def search_stream(self, searchstring, cookie=None):
+        """Search users, one page at a time,
+        yielding the users as the directory returns them"""
+        searchfilter = self._search_filter(searchstring)
+        attrlist = self._attrlist(DISPLAYED_ATTRS)
+        page, pool, offset, skip = self._open_page(
+            cookie, searchfilter, attrlist
+            )
+        ldap_client = page.ldap_client
+        if self.max_results:
+            limit = max(self.max_results - offset, 0)
+        else:
+            limit = None
+        count = 0
+        truncated = False
+        try:
+            while True:
+                for entry in page:
+                    if skip:
+                        skip -= 1
+                        continue
+                    if limit is not None and count >= limit:
+                        truncated = True
+                        continue
+                    count += 1
+                    user = self._search_result(entry)
+                    if user is not None:
+                        yield user
+                # only skipped entries so far, get the next page
+                if count or truncated or page.cookie is None:
+                    break
+                page = PagedSearch(
+                    self, ldap_client, searchfilter, attrlist,
+                    self.userdn, page.cookie, self.page_size
+                    )
+            ldap_cookie = page.cookie
+            if limit is not None and count >= limit and \
+                    ldap_cookie is not None:
+                truncated = True
+            if truncated:
+                self._logger(
+                    severity=logging.WARNING,
+                    msg="%(backend)s: search results truncated to "
+                        "%(max)d entries, "
+                        "see '%(backend)s.search.max_results'" %
+                        {'backend': self.backend_name,
+                         'max': self.max_results}
+                )
+                if ldap_cookie is not None:
+                    self._abandon_page_s(ldap_client, searchfilter,
+                                         self.userdn, ldap_cookie)
+                ldap_cookie = None
+        except ldap.SERVER_DOWN:
+            pool.broken(ldap_client)
+            raise
+        except BaseException:
+            # including GeneratorExit if the caller stops iterating,
+            # the search may still be running on the connection
+            pool.discard(ldap_client)
+            raise
+
+        offset += count
+        if ldap_cookie is None:
+            # search over, the connection can be reused
+            pool.put(ldap_client)
+            yield (None, None)
+        else:
+            cursor_id = self._push_cursor(
+                searchfilter, pool, ldap_client, ldap_cookie, offset
+                )
+            yield (None, '%s:%d' % (cursor_id, offset))
 
+    def search_page(self, searchstring, cookie=None):
+        """Search users, one page at a time"""
         ret = {}
-        # search an process the result a little
-        for u in self._search(searchfilter, DISPLAYED_ATTRS, self.userdn):
-            attrs = {}
-            attrs_tmp = u[1]
-            for attr in attrs_tmp:
-                value_tmp = attrs_tmp[attr]
-                if len(value_tmp) == 1:
-                    attrs[attr] = value_tmp[0]
-                else:
-                    attrs[attr] = value_tmp
+        for user, attrs in self.search_stream(searchstring, cookie):
+            if user is None:
+                return (ret, attrs)
+            ret[user] = attrs
 
-            if self.key in attrs:
-                ret[attrs[self.key]] = attrs
-        return ret
+    def async_backend(self, executor=None):
+        """non blocking version of the backend (python 3 only)"""
+        if sys.version < '3':
+            return None
+        from ldapcherry.backend.aioLdap import AsyncBackend
+        return AsyncBackend(self, executor)
 
     def get_user(self, username):
         """Gest a specific user"""
-        ret = {}
-        tmp = self._get_user(self._byte_p2(username), ALL_ATTRS)
+        tmp = self._get_user(self._byte_p2(username), ALL_ATTRS, unwrap=True)
         if tmp is None:
             raise UserDoesntExist(username, self.backend_name)
-        attrs_tmp = tmp[1]
-        for attr in attrs_tmp:
-            value_tmp = attrs_tmp[attr]
-            if len(value_tmp) == 1:
-                ret[attr] = value_tmp[0]
-            else:
-                ret[attr] = value_tmp
+        return tmp[1]
+
+    def get_users(self, usernames):
+        """Get several users with one search
+        (the attributes of the searches)"""
+        if not usernames:
+            return {}
+        searchfilter = '(|%s)' % ''.join(
+            [self._user_filter(self._byte_p2(u)) for u in usernames]
+            )
+        r = self._search(
+            searchfilter,
+            DISPLAYED_ATTRS,
+            self.userdn,
+            self._read_pool(),
+            decode=False,
+            )
+        return self._search_results(r, {})
+
+    @staticmethod
+    def _memberof_values(attrs):
+        """get memberOf from the attributes of a user entry"""
+        for attr in attrs:
+            if attr.lower() == 'memberof':
+                return attrs[attr]
+        return []
+
+    def _memberof(self, username):
+        """get the dns of the groups of a user from its memberOf
+        attribute (from the request cache if already recovered)"""
+        tmp = self._get_user(self._byte_p2(username), MEMBEROF_ATTRS)
+        if tmp is None:
+            return []
+        return self._memberof_values(tmp[1])
+
+    def _groupdn_groups(self, dns):
+        """keep the groups of groupdn, like the groups search does"""
+        ret = []
+        for dn in dns:
+            if self._under_groupdn(self._normalize_dn(dn)):
+                ret.append(self._uni(dn))
         return ret
 
     def get_groups(self, username):
         """Get all groups of a user"""
-        username = ldap.filter.escape_filter_chars(self._byte_p2(username))
-        userdn = self._get_user(username, NO_ATTR)
+        if self.membership_mode == 'memberof':
+            return self._groupdn_groups(self._memberof(username))
+        # lookup with the raw username to reuse the dn
+        # already recovered during this request (by auth() for example)
+        userdn = self._get_user(self._byte_p2(username), NO_ATTR)
+        searchfilter = self._group_filter(username, userdn)
+        if searchfilter is None:
+            return []
 
-        searchfilter = self.group_filter_tmpl % {
-            'userdn': userdn,
-            'username': username
-        }
-
-        groups = self._search(searchfilter, NO_ATTR, self.groupdn)
+        groups = self._search(
+            searchfilter,
+            NO_ATTR,
+            self.groupdn,
+            self._read_pool(username),
+            )
         ret = []
         for entry in groups:
             ret.append(self._uni(entry[0]))
@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+# vim:set expandtab tabstop=4 shiftwidth=4:
+#
+# The MIT License (MIT)
+# LdapCherry
+# Copyright (c) 2014 Carpentier Pierre-Francois
+
+# Small LDAP filter (RFC 4515) parser and evaluator, used to filter
+# already fetched entries locally instead of asking the directory again,
+# and compiled filter templates.
+#
+# Parsed filters are tuples:
+#   ('&', [<filter>, ...]), ('|', [<filter>, ...]), ('!', <filter>)
+#   ('=', <attr>, <value>)                equality
+#   ('*', <attr>)                         presence
+#   ('sub', <attr>, [<initial>, <any>..., <final>])  substrings
+#   ('?', <attr>)                         approx, ordering, extensible
+#                                         (not evaluated)
+# Attribute names and values are lowered, matching is case insensitive.
+
+
+class FilterError(Exception):
+    def __init__(self, searchfilter):
+        self.searchfilter = searchfilter
+        self.log = \
+            "invalid ldap filter '%(filter)s'" % \
+            {'filter': searchfilter}
+
+
+# characters escaped in assertion values (RFC 4515),
+# '\\' first to not escape the escapes
+_ESCAPES = [
+    ('\\', '\\5c'),
+    ('*', '\\2a'),
+    ('(', '\\28'),
+    (')', '\\29'),
+    ('\x00', '\\00'),
+]
+
+
+def escape(value):
+    """escape a value for an assertion
+    (same as ldap.filter.escape_filter_chars())
+    """
+    for c, escaped in _ESCAPES:
+        if c in value:
+            value = value.replace(c, escaped)
+    return value
+
+
+def _unescape(value):
+    """decode the \\XX escapes of an assertion value"""
+    if '\\' not in value:
+        return value
+    data = value.encode('utf-8')
+    out = bytearray()
+    i = 0
+    while i < len(data):
+        if data[i:i + 1] == b'\\':
+            out.append(int(data[i + 1:i + 3], 16))
+            i += 3
+        else:
+            out += data[i:i + 1]
+            i += 1
+    return bytes(out).decode('utf-8', 'replace')
+
+
+def _parse(s, pos):
+    """parse the filter starting at **pos**,
+    return (<filter>, <position after the filter>)
+    """
+    if s[pos] != '(':
+        raise ValueError(pos)
+    pos += 1
+    op = s[pos]
+    if op in '&|':
+        children = []
+        pos += 1
+        while s[pos] == '(':
+            child, pos = _parse(s, pos)
+            children.append(child)
+        node = (op, children)
+    elif op == '!':
+        child, pos = _parse(s, pos + 1)
+        node = ('!', child)
+    else:
+        end = s.index(')', pos)
+        item = s[pos:end]
+        attr, sep, value = item.partition('=')
+        if not sep or not attr:
+            raise ValueError(pos)
+        pos = end
+        attr = attr.lower()
+        if attr[-1] in '~<>' or ':' in attr:
+            node = ('?', attr.rstrip('~<>'))
+        elif value == '*':
+            node = ('*', attr)
+        elif '*' in value:
+            comps = [_unescape(c).lower() for c in value.split('*')]
+            node = ('sub', attr, comps)
+        else:
+            node = ('=', attr, _unescape(value).lower())
+    if s[pos] != ')':
+        raise ValueError(pos)
+    return (node, pos + 1)
+
+
+def parse(searchfilter):
+    """parse a filter
+    @str searchfilter: the filter, as unicode
+    @rtype: the parsed filter (tuples, see above)
+    """
+    try:
+        node, pos = _parse(searchfilter, 0)
+    except (ValueError, IndexError):
+        raise FilterError(searchfilter)
+    if pos != len(searchfilter):
+        raise FilterError(searchfilter)
+    return node
+
+
+def _substrings(value, comps):
+    initial, final = comps[0], comps[-1]
+    if not value.startswith(initial):
+        return False
+    pos = len(initial)
+    for comp in comps[1:-1]:
+        pos = value.find(comp, pos)
+        if pos < 0:
+            return False
+        pos += len(comp)
+    return len(value) - pos >= len(final) and value.endswith(final)
+
+
+def evaluate(node, attrs):
+    """evaluate a parsed filter against an entry
+    @node: the parsed filter
+    @dict attrs: attributes of the entry, with lowered names
+        ({<attr>: <value or list of values>})
+    @rtype: True, False or None (undefined)
+    """
+    op = node[0]
+    if op == '&' or op == '|':
+        ret = op == '&'
+        for child in node[1]:
+            value = evaluate(child, attrs)
+            if value is (op == '|'):
+                return value
+            if value is None:
+                ret = None
+        return ret
+    if op == '!':
+        value = evaluate(node[1], attrs)
+        return None if value is None else not value
+    if op == '?':
+        return None
+    values = attrs.get(node[1])
+    if values is None:
+        return False
+    if op == '*':
+        return True
+    if not isinstance(values, list):
+        values = [values]
+    for value in values:
+        value = value.lower()
+        if op == '=' and value == node[2]:
+            return True
+        if op == 'sub' and _substrings(value, node[2]):
+            return True
+    return False
+
+
+def _contains(node, token):
+    op = node[0]
+    if op == '&' or op == '|':
+        return any(_contains(child, token) for child in node[1])
+    if op == '!':
+        return _contains(node[1], token)
+    if op == '=':
+        return token in node[2]
+    if op == 'sub':
+        return any(token in comp for comp in node[2])
+    return False
+
+
+def _narrows(node, token, attrs):
+    """check that appending characters to **token** can only narrow
+    the set of entries matching **node**, and that **node** can be
+    evaluated from **attrs**
+    """
+    op = node[0]
+    if op == '&' or op == '|':
+        return all(_narrows(child, token, attrs) for child in node[1])
+    if op == '!':
+        return not _contains(node[1], token) and \
+            _narrows(node[1], token, attrs)
+    if op == '?' or node[1] not in attrs:
+        return False
+    if op == '=':
+        return token not in node[2]
+    if op == 'sub':
+        # 'jo*' -> 'joh*' narrows, '*jo' -> '*joh' or 'jo' -> 'joh' don't
+        for comp in node[2][:-1]:
+            if token in comp and \
+                    (comp.count(token) != 1 or not comp.endswith(token)):
+                return False
+        return token not in node[2][-1]
+    return True
+
+
+class SearchRefiner(object):
+    """Tells if the results of a search filter template can be refined
+    locally when the search string grows, and builds the matchers
+    doing it
+
+    The results of '(|(uid=%(searchstring)s*)(sn=%(searchstring)s*))'
+    for 'jo' contain all the results for 'john': they just have
+    to be filtered with the filter for 'john'.
+    """
+
+    # stands for the search string while analysing the template
+    TOKEN = 'ldapcherrysearchstringtoken'
+
+    def __init__(self, tmpl, attrlist):
+        """
+        @str tmpl: the search filter template
+            (with a '%(searchstring)s' placeholder)
+        @list attrlist: the attributes returned by searches
+        """
+        self.refinable = False
+        # children of the top level '&' not depending on the search
+        # string, always true for entries returned by a previous search
+        self.constant = set([])
+        attrs = set([a.lower() for a in attrlist])
+        try:
+            node = parse(tmpl % {'searchstring': self.TOKEN})
+        except (FilterError, KeyError, TypeError, ValueError):
+            return
+        token = self.TOKEN.lower()
+        if node[0] == '&':
+            children = []
+            for i, child in enumerate(node[1]):
+                if _contains(child, token):
+                    children.append(child)
+                else:
+                    self.constant.add(i)
+            node = ('&', children)
+        self.refinable = _narrows(node, token, attrs)
+
+    def matcher(self, searchfilter):
+        """build a function telling if an entry returned by a previous,
+        broader search matches **searchfilter**
+        @str searchfilter: the template filled with the search string
+        @rtype: function ({<attr>: <value>}) -> bool, or None
+            if the template is not refinable
+        """
+        if not self.refinable:
+            return None
+        node = parse(searchfilter)
+        if node[0] == '&':
+            node = ('&', [child for i, child in enumerate(node[1])
+                          if i not in self.constant])
+
+        def match(attrs):
+            lowered = {}
+            for attr in attrs:
+                lowered[attr.lower()] = attrs[attr]
+            return evaluate(node, lowered) is True
+        return match
+
+
+def _compact(s, pos):
+    """rewrite the filter starting at **pos**, without the clauses
+    repeated in a '&' or a '|'
+    @rtype: tuple, (<filter>, <position after the filter>)
+    """
+    if s[pos] != '(':
+        raise ValueError(pos)
+    op = s[pos + 1]
+    if op in '&|':
+        children = []
+        pos += 2
+        while s[pos] == '(':
+            child, pos = _compact(s, pos)
+            if child not in children:
+                children.append(child)
+        ret = '(' + op + ''.join(children)
+    elif op == '!':
+        child, pos = _compact(s, pos + 2)
+        ret = '(!' + child
+    else:
+        end = s.index(')', pos)
+        ret = s[pos:end]
+        pos = end
+    if s[pos] != ')':
+        raise ValueError(pos)
+    return (ret + ')', pos + 1)
+
+
+class FilterTemplate(object):
+    """Filter template with '%(<key>)s' placeholders, compiled once
+
+    The template is checked, its repeated clauses are removed, and it
+    is split into its constant parts and its placeholders, so filling
+    it is just escaping the values (once) and joining the parts.
+    """
+
+    # placeholders while compiling the template
+    _MARK = '\x00'
+
+    def __init__(self, tmpl):
+        """
+        @str tmpl: the template, like '(uid=%(username)s)'
+        """
+
+        class Marks(object):
+            def __getitem__(s, key):
+                return self._MARK + key + self._MARK
+
+        try:
+            marked = tmpl % Marks()
+            # like libldap, accept a filter without its parentheses
+            if not marked.startswith('('):
+                marked = '(' + marked + ')'
+            compacted, pos = _compact(marked, 0)
+            if pos != len(marked):
+                raise ValueError(pos)
+            parse(compacted)
+        except (FilterError, ValueError, IndexError, KeyError, TypeError):
+            raise FilterError(tmpl)
+        # constant parts and keys of the placeholders, alternately
+        self._parts = compacted.split(self._MARK)
+        self._slots = [(i, self._parts[i])
+                       for i in range(1, len(self._parts), 2)]
+        self.keys = set(self._parts[1::2])
+        # compiled template, as a template
+        self.template = ''.join([
+            part.replace('%', '%%') if i % 2 == 0 else '%(' + part + ')s'
+            for i, part in enumerate(self._parts)
+            ])
+
+    def fill(self, values):
+        """ fill the template
+        @dict values: {<key>: <value>}, values are escaped
+        @rtype: str, the filter
+        """
+        # each value is escaped once, even if used several times
+        escaped = {}
+        for key in self.keys:
+            escaped[key] = escape(values[key])
+        parts = list(self._parts)
+        for i, key in self._slots:
+            parts[i] = escaped[key]
+        return ''.join(parts)
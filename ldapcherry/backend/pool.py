@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+# vim:set expandtab tabstop=4 shiftwidth=4:
+#
+# The MIT License (MIT)
+# LdapCherry
+# Copyright (c) 2014 Carpentier Pierre-Francois
+
+import threading
+import time
+from contextlib import contextmanager
+
+# maximum time (in second) a thread waits for a connection
+# when all the connections of a pool are busy
+WAIT_TIMEOUT = 30
+
+
+class PoolExhausted(Exception):
+    def __init__(self, name, max_size):
+        self.name = name
+        self.max_size = max_size
+        self.log = \
+            "connection pool of backend '%(name)s' exhausted" \
+            " (%(max_size)s connections busy)," \
+            " increase '%(name)s.pool.max_size'" % \
+            {'name': name, 'max_size': max_size}
+
+
+class ConnectionPool(object):
+    """Bounded and thread safe pool of connections
+
+    Connections are created lazily by **factory** and lent to one thread
+    at a time. Idle connections are retired after **idle_timeout** seconds,
+    and the ones idle for more than **check_interval** seconds are
+    verified with **check** before being lent again.
+    If one of the **broken** exceptions is raised while a connection is in
+    use, the connection is dropped along with all the idle ones (after
+    calling **on_broken** with it, if set).
+    """
+
+    def __init__(self, name, factory, check, close,
+                 max_size=10, idle_timeout=300, check_interval=30,
+                 broken=(), wait_timeout=WAIT_TIMEOUT, on_broken=None):
+        self.name = name
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.wait_timeout = wait_timeout
+        self._factory = factory
+        self._check = check
+        self._close = close
+        self._broken = tuple(broken)
+        self._on_broken = on_broken
+        # idle connections, as (<last use>, <connection>),
+        # most recently used at the end
+        self._idle = []
+        # number of connections opened (idle + lent)
+        self._size = 0
+        self._cond = threading.Condition()
+
+    def _reap(self, now):
+        """remove expired idle connections from the pool,
+        must be called with the lock held
+        """
+        expired = []
+        while self._idle and now - self._idle[0][0] > self.idle_timeout:
+            expired.append(self._idle.pop(0)[1])
+        self._size -= len(expired)
+        return expired
+
+    def _close_all(self, connections):
+        for conn in connections:
+            try:
+                self._close(conn)
+            except Exception:
+                pass
+
+    def get(self):
+        """get a connection from the pool, opening a new one if
+        none is available and the pool is not full
+        """
+        now = time.time()
+        deadline = now + self.wait_timeout
+        with self._cond:
+            expired = self._reap(now)
+            while not self._idle and self._size >= self.max_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self._close_all(expired)
+                    raise PoolExhausted(self.name, self.max_size)
+                self._cond.wait(remaining)
+            if self._idle:
+                last_use, conn = self._idle.pop()
+            else:
+                last_use, conn = None, None
+            # reserve the slot before releasing the lock
+            if conn is None:
+                self._size += 1
+        self._close_all(expired)
+
+        if conn is not None and \
+                time.time() - last_use > self.check_interval:
+            try:
+                healthy = self._check(conn)
+            except Exception:
+                healthy = False
+            if not healthy:
+                self._close_all([conn])
+                conn = None
+        if conn is None:
+            try:
+                conn = self._factory()
+            except Exception:
+                self._release_slot()
+                raise
+        return conn
+
+    def _release_slot(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def put(self, conn):
+        """give back a connection to the pool"""
+        with self._cond:
+            self._idle.append((time.time(), conn))
+            self._cond.notify()
+
+    def discard(self, conn):
+        """close a (broken) connection instead of giving it back"""
+        self._release_slot()
+        self._close_all([conn])
+
+    def detach(self, conn):
+        """take a lent connection out of the pool (to keep it open
+        for a long time), the other threads can open another one
+        The caller closes it, or gives it back with attach()
+        """
+        self._release_slot()
+
+    def attach(self, conn):
+        """count a connection taken out with detach() as lent again,
+        it's then given back or discarded like the other ones
+        (the pool may exceed max_size until then)
+        """
+        with self._cond:
+            self._size += 1
+
+    def broken(self, conn):
+        """drop a connection which raised one of the **broken**
+        exceptions, along with the idle ones (very likely dead too)"""
+        if self._on_broken is not None:
+            self._on_broken(conn)
+        self.discard(conn)
+        self.clear()
+
+    def clear(self):
+        """close all the idle connections"""
+        with self._cond:
+            idle = [conn for last_use, conn in self._idle]
+            self._idle = []
+            self._size -= len(idle)
+            self._cond.notify_all()
+        self._close_all(idle)
+
+    @contextmanager
+    def connection(self):
+        """lend a connection for the duration of a 'with' block"""
+        conn = self.get()
+        try:
+            yield conn
+        except self._broken:
+            # the server is probably gone
+            self.broken(conn)
+            raise
+        except BaseException:
+            self.put(conn)
+            raise
+        else:
+            self.put(conn)
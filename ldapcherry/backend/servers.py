@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+# vim:set expandtab tabstop=4 shiftwidth=4:
+#
+# The MIT License (MIT)
+# LdapCherry
+# Copyright (c) 2014 Carpentier Pierre-Francois
+
+import threading
+import time
+
+# weight of the last measure in the average latency of a server
+# (exponentially weighted moving average)
+LATENCY_WEIGHT = 0.3
+
+
+class Server(object):
+    """A server of a backend and its health"""
+
+    def __init__(self, uri):
+        self.uri = uri
+        # average latency (in second), None until measured
+        self.latency = None
+        # consecutive errors
+        self.failures = 0
+        self.ejected = False
+        # duration of the current ejection, and its end
+        self.backoff = 0
+        self.retry_at = 0
+
+    def __repr__(self):
+        return '<Server %s>' % self.uri
+
+
+class ServerSet(object):
+    """Servers of a backend, with health tracking
+
+    The servers are tried by increasing average latency. A server is
+    ejected after **max_failures** consecutive errors, for **backoff**
+    seconds, doubled at each new error (up to **max_backoff**).
+    If **probe** is set and there are several servers, a background
+    thread calls probe(<server>) on each server every **probe_interval**
+    seconds (ejected ones once their ejection is over), measuring the
+    latencies and bringing the servers back.
+    """
+
+    def __init__(self, name, uris, probe=None, max_failures=3,
+                 backoff=5, max_backoff=300, probe_interval=10):
+        self.name = name
+        self.servers = [Server(uri) for uri in uris]
+        self.max_failures = max_failures
+        self.base_backoff = backoff
+        self.max_backoff = max_backoff
+        self.probe_interval = probe_interval
+        self._probe = probe
+        self._lock = threading.Lock()
+        self._prober = None
+        self._stop = threading.Event()
+
+    def candidates(self):
+        """get the servers to try, in order: the healthy ones
+        by latency (not yet measured first, the ones which just
+        failed last), then the ejected ones by end of ejection
+        (as a last resort)
+        """
+        self._start_prober()
+        with self._lock:
+            healthy = [s for s in self.servers if not s.ejected]
+            ejected = [s for s in self.servers if s.ejected]
+            healthy.sort(key=lambda s: (s.failures > 0, s.latency or 0))
+            ejected.sort(key=lambda s: s.retry_at)
+        return healthy + ejected
+
+    def best(self):
+        """get the server to use"""
+        return self.candidates()[0]
+
+    def success(self, server, elapsed=None):
+        """record a success of **server**
+        @float elapsed: time (in second) the server took to answer
+        """
+        with self._lock:
+            server.failures = 0
+            server.ejected = False
+            server.backoff = 0
+            if elapsed is None:
+                return
+            if server.latency is None:
+                server.latency = elapsed
+            else:
+                server.latency = LATENCY_WEIGHT * elapsed + \
+                    (1 - LATENCY_WEIGHT) * server.latency
+
+    def failure(self, server):
+        """record an error of **server** (down, timeout...)"""
+        with self._lock:
+            server.failures += 1
+            if not server.ejected and server.failures < self.max_failures:
+                return
+            server.ejected = True
+            server.backoff = min(
+                server.backoff * 2 or self.base_backoff,
+                self.max_backoff,
+                )
+            server.retry_at = time.time() + server.backoff
+
+    def probe(self):
+        """probe the servers (healthy ones, and ejected ones
+        once their ejection is over)"""
+        for server in list(self.servers):
+            if server.ejected and time.time() < server.retry_at:
+                continue
+            start = time.time()
+            try:
+                self._probe(server)
+            except Exception:
+                self.failure(server)
+            else:
+                self.success(server, time.time() - start)
+
+    def _run_prober(self):
+        while not self._stop.wait(self.probe_interval):
+            self.probe()
+
+    def _start_prober(self):
+        """start the probes (on first use, not at initialization)"""
+        if self._prober is not None or self._probe is None or \
+                len(self.servers) < 2 or self.probe_interval <= 0:
+            return
+        with self._lock:
+            if self._prober is not None:
+                return
+            self._prober = threading.Thread(
+                target=self._run_prober,
+                name='ldapcherry-probe-' + self.name,
+                )
+            self._prober.daemon = True
+            self._prober.start()
+
+    def stop(self):
+        """stop the probes"""
+        self._stop.set()
@@ -0,0 +1,501 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:set expandtab tabstop=4 shiftwidth=4:
+# The MIT License (MIT)
+# LdapCherry
+# Copyright (c) 2014 Carpentier Pierre-Francois
+
+"""Bulk import and export of users."""
+
+import sys
+import os.path
+import io
+import csv
+import getpass
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import cherrypy
+from ldapcherry import LdapCherry
+from ldapcherry.cli import disable_interpolation
+from ldapcherry.exceptions import MissingUserKey, MissingRole, \
+    PPolicyError, BackendTimeout
+
+if sys.version < '3':
+    from sets import Set as set
+
+# column of the roles in csv files
+ROLES_COLUMN = 'roles'
+
+
+class ExportRestarted(Exception):
+    def __init__(self, user):
+        self.user = user
+        self.log = \
+            "user '" + user + "' found twice, the paged search" \
+            " started over (page expired)"
+
+
+class Checkpoint(object):
+    """File keeping the users already imported, one per line,
+    to resume an interrupted import
+
+    The steps done for users not fully imported yet (added in a backend,
+    added to the groups of a backend) are also kept, one per line
+    ("<user>\t<step>"), so they are not done again.
+    """
+
+    def __init__(self, path=None):
+        self.done = set([])
+        self.steps = set([])
+        self._file = None
+        self._lock = threading.Lock()
+        if path is None:
+            return
+        if os.path.exists(path):
+            with io.open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    username, sep, step = line.rstrip('\n').partition('\t')
+                    if step:
+                        self.steps.add((username, step))
+                    else:
+                        self.done.add(username)
+        self._file = io.open(path, 'a', encoding='utf-8')
+
+    def _write(self, line):
+        if self._file is not None:
+            self._file.write(line + u'\n')
+            self._file.flush()
+
+    def add(self, username):
+        """record a user fully imported"""
+        with self._lock:
+            self.done.add(username)
+            self._write(username)
+
+    def add_step(self, username, step):
+        """record a step of the import of a user"""
+        with self._lock:
+            self.steps.add((username, step))
+            self._write(username + u'\t' + step)
+
+    def has_step(self, username, step):
+        return (username, step) in self.steps
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+if sys.version < '3':
+    def _open_csv(path, mode):
+        return open(path, mode + 'b')
+
+    def _csv_decode(value):
+        return value.decode('utf-8')
+
+    def _csv_encode(value):
+        return value.encode('utf-8')
+else:
+    def _open_csv(path, mode):
+        return io.open(path, mode, encoding='utf-8', newline='')
+
+    def _csv_decode(value):
+        return value
+
+    def _csv_encode(value):
+        return value
+
+
+def read_csv(f):
+    """read users from a csv file, the first line gives the attributes
+    ids (and the roles column, roles separated by ',')
+    @rtype: iterator of (<line number>, {'attrs': {}, 'roles': []})
+    """
+    reader = csv.DictReader(f)
+    for row in reader:
+        attrs = {}
+        roles = []
+        for column in row:
+            value = row[column]
+            if column is None or value is None or value == '':
+                continue
+            column = _csv_decode(column)
+            value = _csv_decode(value)
+            if column == ROLES_COLUMN:
+                roles = [r.strip() for r in value.split(',') if r.strip()]
+            else:
+                attrs[column] = value
+        yield (reader.line_num, {'attrs': attrs, 'roles': roles})
+
+
+def read_jsonl(f):
+    """read users from a json lines file
+    ({"attrs": {<attr id>: <value>}, "roles": [<role id>]} per line)
+    @rtype: iterator of (<line number>, {'attrs': {}, 'roles': []})
+    """
+    for num, line in enumerate(f, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError:
+            item = None
+        if not isinstance(item, dict) or \
+                not isinstance(item.get('attrs', {}), dict) or \
+                not isinstance(item.get('roles', []), list):
+            item = {'attrs': {}, 'roles': [], 'invalid': True}
+        yield (num, item)
+
+
+class Bulk(object):
+    """Bulk operations on the users, through the backends
+    of a LdapCherry instance"""
+
+    def __init__(self, app, out=sys.stdout, err=sys.stderr,
+                 admin='ldapcherry-bulk'):
+        """
+        @app: LdapCherry instance, with configuration loaded
+        @out: stream receiving the exported users
+        @err: stream receiving the errors and warnings
+        @str admin: name of the administrator in the logs
+        """
+        self.app = app
+        self.out = out
+        self.err = err
+        self.admin = admin
+        self._err_lock = threading.Lock()
+        # notifications can't be shown in a browser, print them
+        app._add_notification = self._warn
+
+    def _warn(self, message):
+        with self._err_lock:
+            self.err.write(message + u'\n')
+            self.err.flush()
+
+    def check(self, item):
+        """ check a user before importing it
+        @dict item: {'attrs': {<attr id>: <value>}, 'roles': [<role id>]}
+        @rtype: tuple (<username>, {<backend>: {<attr>: <value>}},
+            [<roles>])
+        """
+        attributes = self.app.attributes
+        attrs = item.get('attrs', {})
+        key = attributes.get_key()
+        if item.get('invalid') or key not in attrs:
+            raise MissingUserKey()
+        badd = {}
+        for attr in attrs:
+            attributes.check_attr(attr, attrs[attr])
+            if attributes.attributes[attr]['type'] == 'password':
+                if not self.app._checkppolicy(attrs[attr])['match']:
+                    raise PPolicyError()
+            backends = attributes.get_backends_attributes(attr)
+            for b in backends:
+                if b not in badd:
+                    badd[b] = {}
+                badd[b][backends[b]] = attrs[attr]
+        roles = item.get('roles', [])
+        allroles = self.app.roles.get_allroles()
+        for r in roles:
+            if r not in allroles:
+                raise MissingRole(r)
+        return (attrs[key], badd, roles)
+
+    def add(self, username, badd, roles, checkpoint=None):
+        """add a checked user in the backends
+        @checkpoint: Checkpoint, the steps already done (see
+            Checkpoint.add_step()) are skipped, a user already existing
+            in a backend is an error otherwise
+        """
+        if checkpoint is None:
+            checkpoint = Checkpoint()
+        for b in badd:
+            step = u'user:' + b
+            if checkpoint.has_step(username, step):
+                continue
+            self.app.backends[b].add_user(badd[b])
+            checkpoint.add_step(username, step)
+        cherrypy.log.error(
+            msg="user '" + username + "' added by '" + self.admin + "'",
+            severity=logging.INFO
+        )
+        cherrypy.log.error(
+            msg="user '" + username + "' attributes: " + str(badd),
+            severity=logging.DEBUG
+        )
+        groups = self.app.roles.get_groups(roles)
+        try:
+            for b in groups:
+                step = u'groups:' + b
+                if checkpoint.has_step(username, step):
+                    continue
+                self.app.backends[b].add_to_groups(username, set(groups[b]))
+                checkpoint.add_step(username, step)
+        finally:
+            self.app._invalidate_user(username)
+        cherrypy.log.error(
+            msg="user '" + username + "' made member of " +
+                str(roles) + " by '" + self.admin + "'",
+            severity=logging.INFO
+        )
+        cherrypy.log.error(
+            msg="user '" + username + "' groups: " + str(groups),
+            severity=logging.DEBUG
+        )
+
+    def _import_one(self, num, item, checkpoint, dry_run):
+        try:
+            username, badd, roles = self.check(item)
+            if not dry_run:
+                self.add(username, badd, roles, checkpoint)
+                checkpoint.add(username)
+            return True
+        except Exception as e:
+            if hasattr(e, 'log'):
+                message = e.log
+            else:
+                message = 'unexpected error: ' + repr(e)
+            self._warn(u'line ' + str(num) + u': ' + message)
+            return False
+
+    def import_users(self, items, jobs=4, checkpoint=None, dry_run=False):
+        """ import users, **jobs** at a time
+        @items: iterator of (<line number>, <user>) (see read_csv())
+        @int jobs: number of users added concurrently
+        @checkpoint: Checkpoint, users already in it are skipped
+        @boolean dry_run: only check the users
+        @rtype: dict, {'imported': <n>, 'skipped': <n>, 'errors': <n>}
+        """
+        if checkpoint is None:
+            checkpoint = Checkpoint()
+        key = self.app.attributes.get_key()
+        stats = {'imported': 0, 'skipped': 0, 'errors': 0}
+
+        def collect(futures):
+            for future in futures:
+                if future.result():
+                    stats['imported'] += 1
+                else:
+                    stats['errors'] += 1
+
+        executor = ThreadPoolExecutor(max_workers=jobs)
+        pending = set([])
+        try:
+            for num, item in items:
+                if item.get('attrs', {}).get(key) in checkpoint.done:
+                    stats['skipped'] += 1
+                    continue
+                # don't read the whole file in advance
+                if len(pending) >= 2 * jobs:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                pending.add(executor.submit(
+                    self._import_one, num, item, checkpoint, dry_run
+                ))
+            collect(wait(pending)[0])
+        finally:
+            executor.shutdown()
+        return stats
+
+    def _columns(self):
+        """attributes exported (no passwords), by weight"""
+        attributes = self.app.attributes.attributes
+        columns = [a for a in attributes
+                   if attributes[a]['type'] != 'password']
+        return sorted(columns, key=lambda a: attributes[a]['weight'])
+
+    def _set_search_attrs(self, columns=None):
+        """make the searches return the attributes of **columns**
+        (None: back to the displayed attributes)"""
+        attributes = self.app.attributes
+        for b in self.app.backends:
+            if columns is None:
+                attrs = attributes.get_backend_displayed_attributes(b)
+            else:
+                attrs = [attributes.get_backend_key(b)]
+                for c in columns:
+                    backends = attributes.get_backends_attributes(c)
+                    if b in backends:
+                        attrs.append(backends[b])
+            self.app.backends[b].set_displayed_attrs(attrs)
+        # cached searches have the other attributes
+        self.app.search_cache.clear()
+
+    def export_users(self, fmt='jsonl', jobs=4):
+        """ export all the users with their roles, page by page
+        @str fmt: 'csv' or 'jsonl' (see read_csv() and read_jsonl())
+        @int jobs: number of users whose roles are recovered concurrently
+        @rtype: int, number of users exported
+
+        .. warning:: raise BackendTimeout if a backend doesn't answer
+            in time, and ExportRestarted if the paged search starts
+            over (the export is incomplete)
+        """
+        columns = self._columns()
+        # the attributes come with the search results,
+        # no lookup of each user
+        self._set_search_attrs(columns)
+        executor = ThreadPoolExecutor(max_workers=jobs)
+        try:
+            return self._export(fmt, columns, executor)
+        finally:
+            executor.shutdown()
+            self._set_search_attrs()
+
+    def _export(self, fmt, columns, executor):
+        if fmt == 'csv':
+            writer = csv.writer(self.out)
+            writer.writerow([_csv_encode(c) for c in columns + [ROLES_COLUMN]])
+
+        def get_roles(user):
+            return sorted(self.app._get_roles(user)['roles'])
+
+        count = 0
+        page = None
+        # users already exported, a search starting over would
+        # export them again (and maybe never end)
+        exported = set([])
+        while True:
+            # no partial page, a missing backend fails the export
+            users, page = self.app._search_page(u'', page, partial=False)
+            users_sorted = sorted(users)
+            for user in users_sorted:
+                if user in exported:
+                    raise ExportRestarted(user)
+                exported.add(user)
+            # the roles of the users of the page are recovered concurrently
+            users_roles = executor.map(get_roles, users_sorted)
+            for user, roles in zip(users_sorted, users_roles):
+                found = users[user]
+                attrs = {}
+                for c in columns:
+                    if c in found:
+                        attrs[c] = found[c]
+                if fmt == 'csv':
+                    row = []
+                    for c in columns:
+                        value = attrs.get(c, u'')
+                        if isinstance(value, list):
+                            value = u','.join(value)
+                        row.append(_csv_encode(value))
+                    row.append(_csv_encode(u','.join(roles)))
+                    writer.writerow(row)
+                else:
+                    line = json.dumps(
+                        {'attrs': attrs, 'roles': roles},
+                        sort_keys=True,
+                    )
+                    self.out.write(line + u'\n')
+                count += 1
+            if page is None:
+                return count
+
+
+def load(configfile):
+    """ load a LdapCherry instance from its configuration file """
+    disable_interpolation()
+    config = cherrypy.lib.reprconf.Parser().dict_from_file(configfile)
+    instance = LdapCherry()
+    instance.reload(config)
+    return instance
+
+
+def main():
+    from optparse import OptionParser
+
+    p = OptionParser(
+        usage="%prog -c <config> import [options] <file>\n"
+              "       %prog -c <config> export [options]",
+    )
+    p.add_option('-c', '--config', dest='config',
+                 help="specify config file")
+    p.add_option('-f', '--format', dest='format', default=None,
+                 help="file format, 'csv' or 'jsonl' (default: guessed from"
+                 " the file extension for import, 'jsonl' for export)")
+    p.add_option('-j', '--jobs', dest='jobs', type='int', default=4,
+                 help="number of users imported (or whose roles are"
+                 " exported) concurrently (default: 4)")
+    p.add_option('-k', '--checkpoint', dest='checkpoint', default=None,
+                 help="file keeping the imported users, users already in it"
+                 " are skipped (to resume an interrupted import)")
+    p.add_option('-n', '--dry-run', action="store_true", dest='dry_run',
+                 help="only check the users to import")
+    p.add_option('-o', '--output', dest='output', default=None,
+                 help="export to the given file instead of stdout")
+    options, args = p.parse_args()
+
+    if options.config is None:
+        print('-c|--config <path/to/config/file> is mandatory')
+        exit(1)
+
+    if not os.path.isfile(options.config):
+        print('configuration file "' + options.config + '" doesn\'t exist')
+        exit(1)
+
+    if not args or args[0] not in ['import', 'export'] or \
+            (args[0] == 'import' and len(args) != 2):
+        p.print_usage()
+        exit(1)
+
+    fmt = options.format
+    if args[0] == 'import' and fmt is None:
+        fmt = 'csv' if args[1].endswith('.csv') else 'jsonl'
+    if fmt not in [None, 'csv', 'jsonl']:
+        print('format must be "csv" or "jsonl"')
+        exit(1)
+
+    app = load(options.config)
+    try:
+        admin = 'ldapcherry-bulk (' + getpass.getuser() + ')'
+    except Exception:
+        admin = 'ldapcherry-bulk'
+
+    if args[0] == 'export':
+        if options.output is None:
+            out = sys.stdout
+        elif fmt == 'csv':
+            out = _open_csv(options.output, 'w')
+        else:
+            out = io.open(options.output, 'w', encoding='utf-8')
+        try:
+            Bulk(app, out).export_users(
+                fmt or 'jsonl',
+                max(1, options.jobs),
+            )
+        except (BackendTimeout, ExportRestarted) as e:
+            sys.stderr.write('export failed, ' + e.log + '\n')
+            exit(1)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        return
+
+    if fmt == 'csv':
+        f = _open_csv(args[1], 'r')
+        items = read_csv(f)
+    else:
+        f = io.open(args[1], 'r', encoding='utf-8')
+        items = read_jsonl(f)
+    checkpoint = Checkpoint(options.checkpoint)
+    try:
+        stats = Bulk(app, admin=admin).import_users(
+            items,
+            max(1, options.jobs),
+            checkpoint,
+            options.dry_run,
+        )
+    finally:
+        checkpoint.close()
+        f.close()
+    print('imported: %(imported)d, skipped: %(skipped)d,'
+          ' errors: %(errors)d' % stats)
+    if stats['errors']:
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
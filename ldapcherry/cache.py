@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+# vim:set expandtab tabstop=4 shiftwidth=4:
+#
+# The MIT License (MIT)
+# LdapCherry
+# Copyright (c) 2014 Carpentier Pierre-Francois
+
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    """Thread safe LRU cache with a time to live
+
+    At most **max_size** entries are kept (least recently used entries
+    are evicted first), and entries expire **ttl** seconds after being
+    set. A **ttl** of 0 disables the cache.
+    Values are deep copied in and out, so callers can modify them freely.
+    """
+
+    def __init__(self, max_size=1000, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key, now):
+        # lookup without counting, self._lock must be held
+        try:
+            expire, value = self._entries.pop(key)
+        except KeyError:
+            return None
+        if expire < now:
+            return None
+        # reinsert to mark it as the most recently used
+        self._entries[key] = (expire, value)
+        return (value, expire)
+
+    def _set(self, key, value, expire):
+        # insertion without copy, self._lock must be held
+        self._entries.pop(key, None)
+        self._entries[key] = (expire, value)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def get(self, key, default=None):
+        """get an entry, **default** if missing or expired"""
+        with self._lock:
+            entry = self._get(key, time.time())
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+        return copy.deepcopy(entry[0])
+
+    def set(self, key, value):
+        """add or replace an entry"""
+        if self.ttl <= 0 or self.max_size <= 0:
+            return
+        value = copy.deepcopy(value)
+        with self._lock:
+            self._set(key, value, time.time() + self.ttl)
+
+    def invalidate(self, key):
+        """remove an entry"""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """remove all the entries"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """get usage counters
+        @rtype: dict, {'size', 'max_size', 'ttl', 'hits', 'misses',
+            'hit_rate'}, hit_rate is None until the first lookup
+        """
+        with self._lock:
+            return self._stats()
+
+    def _stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / lookups if lookups else None,
+            }
+
+
+class SearchCache(TTLCache):
+    """Cache of search results, refining cached results for longer
+    search strings
+
+    Entries are keyed by (**key**, normalized search string), **key**
+    identifying what was searched (backend, attributes...).
+    When someone types 'jo', then 'joh', then 'john', the results for
+    'joh' and 'john' can be computed from the complete results of 'jo'
+    as long as the search filter only gets narrower when the search string
+    grows. Backends tell how to do it through a **matcher**, a function
+    telling if a cached user (its attributes) matches the new search string.
+    """
+
+    def __init__(self, max_size=100, ttl=30):
+        super(SearchCache, self).__init__(max_size, ttl)
+        self.refined = 0
+
+    @staticmethod
+    def normalize(searchstring):
+        """normalize a search string (searches are case insensitive)"""
+        return searchstring.lower()
+
+    def get_refined(self, key, searchstring, matcher=None):
+        """get the results of a search, directly or by refining
+        the results of a shorter search string
+
+        @key: what was searched
+        @str searchstring: the search string
+        @matcher: function taking the attributes of a user and returning
+            True if it matches **searchstring**, or None if results
+            cannot be refined
+        @rtype: dict of users ({<key>: <attrs>}) or None if not cached
+        """
+        searchstring = self.normalize(searchstring)
+        if self.ttl <= 0 or self.max_size <= 0:
+            return None
+        now = time.time()
+        with self._lock:
+            entry = self._get((key, searchstring), now)
+            if entry is not None:
+                self.hits += 1
+                return copy.deepcopy(entry[0])
+            if matcher is not None:
+                # the longest prefix gives the smallest set to filter
+                for i in range(len(searchstring) - 1, 0, -1):
+                    entry = self._get((key, searchstring[:i]), now)
+                    if entry is None:
+                        continue
+                    users = {}
+                    for user, attrs in entry[0].items():
+                        if matcher(attrs):
+                            users[user] = attrs
+                    self.refined += 1
+                    # refined results are not fresher than their source
+                    self._set((key, searchstring), users, entry[1])
+                    return copy.deepcopy(users)
+            self.misses += 1
+            return None
+
+    def set_results(self, key, searchstring, users):
+        """store the complete results of a search
+
+        @key: what was searched
+        @str searchstring: the search string
+        @dict users: the results ({<key>: <attrs>})
+        """
+        self.set((key, self.normalize(searchstring)), users)
+
+    def _stats(self):
+        ret = super(SearchCache, self)._stats()
+        lookups = self.hits + self.refined + self.misses
+        ret['refined'] = self.refined
+        if lookups:
+            ret['hit_rate'] = float(self.hits + self.refined) / lookups
+        return ret
@@ -16,13 +16,8 @@ from cherrypy import Application
 from ldapcherry import LdapCherry
 
 
-def start(configfile=None, daemonize=False, environment=None,
-          fastcgi=False, scgi=False, pidfile=None,
-          cgi=False, debug=False):
-    """Subscribe all engine plugins and start the engine."""
-    sys.path = [''] + sys.path
-
-    # monkey patching cherrypy to disable config interpolation
+def disable_interpolation():
+    """monkey patch cherrypy to disable config interpolation"""
     def new_as_dict(self, raw=True, vars=None):
         """Convert an INI file to a dictionary"""
         # Load INI file into a dict
@@ -44,6 +39,15 @@ def start(configfile=None, daemonize=False, environment=None,
         return result
     cherrypy.lib.reprconf.Parser.as_dict = new_as_dict
 
+
+def start(configfile=None, daemonize=False, environment=None,
+          fastcgi=False, scgi=False, pidfile=None,
+          cgi=False, debug=False):
+    """Subscribe all engine plugins and start the engine."""
+    sys.path = [''] + sys.path
+
+    disable_interpolation()
+
     instance = LdapCherry()
     app = cherrypy.tree.mount(instance, '/', configfile)
     cherrypy.config.update(configfile)
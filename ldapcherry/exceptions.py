@@ -5,7 +5,6 @@
 # LdapCherry
 # Copyright (c) 2014 Carpentier Pierre-Francois
 
-import string
 import cherrypy
 
 
@@ -126,7 +125,7 @@ class WrongParamValue(Exception):
         self.possible_values = possible_values
         self.section = section
         self.param = param
-        possible_values_str = string.join(possible_values, ', ')
+        possible_values_str = ', '.join(possible_values)
         self.log = \
             "wrong value for param '%(param)s' in section '%(section)s'" \
             ", possible values are [%(values)s]" % \
@@ -218,6 +217,15 @@ class GroupDoesntExist(Exception):
             " in backend '" + backend + "'"
 
 
+class BackendTimeout(Exception):
+    def __init__(self, backend, timeout):
+        self.backend = backend
+        self.timeout = timeout
+        self.log = \
+            "backend '" + backend + "'" \
+            " did not answer within " + str(timeout) + " second(s)"
+
+
 class TemplateRenderError(Exception):
     def __init__(self, error):
         self.log = "Template Render Error: " + error
@@ -261,6 +269,14 @@ def exception_decorator(func):
                     alert='danger',
                     message="Missing group, please check logs for details"
                     )
+            elif et is BackendTimeout:
+                cherrypy.response.status = 504
+                return self.temp['error.tmpl'].render(
+                    is_admin=is_admin,
+                    alert='warning',
+                    message="Backend '" + e.backend + "' did not answer "
+                            "in time, please retry"
+                    )
             else:
                 return self.temp['error.tmpl'].render(
                     is_admin=is_admin,
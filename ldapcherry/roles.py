@@ -44,6 +44,7 @@ class Roles:
         self.roles = {}
         self.flatten = {}
         self.group2roles = {}
+        self.role2groups = {}
         self.admin_roles = []
         self._nest()
 
@@ -89,36 +90,82 @@ class Roles:
 
     def _is_parent(self, roleid1, roleid2):
         """Test if roleid1 is contained inside roleid2"""
-
-        role2 = copy.deepcopy(self.flatten[roleid2])
-        role1 = copy.deepcopy(self.flatten[roleid1])
-
-        if role1 == role2:
+        if roleid1 == roleid2:
             return False
+        backends1, groups1 = self.role2content[roleid1]
+        backends2, groups2 = self.role2content[roleid2]
 
         # Check if role1 is contained by role2
-        for b1 in role1['backends_groups']:
-            if b1 not in role2['backends_groups']:
-                return False
-            for group in role1['backends_groups'][b1]:
-                if group not in role2['backends_groups'][b1]:
-                    return False
+        if not (backends1 <= backends2 and groups1 <= groups2):
+            return False
 
         # If role2 is inside role1, roles are equal, throw exception
-        for b2 in role2['backends_groups']:
-            if b2 not in role1['backends_groups']:
-                return True
-            for group in role2['backends_groups'][b2]:
-                if group not in role1['backends_groups'][b2]:
-                    return True
+        if backends1 != backends2 or groups1 != groups2:
+            return True
+        # (unless they are strictly the same definition)
+        if self.flatten[roleid1] == self.flatten[roleid2]:
+            return False
         raise DumplicateRoleContent(roleid1, roleid2)
 
+    def _index(self):
+        """precompute the content of each role, as frozensets of
+        backends and of (backend, group), and the reverse groups 2 roles
+        """
+        self.always_roles = set([])
+        self.role2content = {}
+        for roleid in self.flatten:
+            backends_groups = self.flatten[roleid]['backends_groups']
+            required = frozenset(
+                (b, g) for b in backends_groups for g in backends_groups[b]
+                )
+            self.role2groups[roleid] = required
+            self.role2content[roleid] = (frozenset(backends_groups), required)
+            # role without any group, every user is member of it
+            if not required:
+                self.always_roles.add(roleid)
+            for b, g in required:
+                if b not in self.group2roles:
+                    self.group2roles[b] = {}
+                if g not in self.group2roles[b]:
+                    self.group2roles[b][g] = set([])
+                self.group2roles[b][g].add(roleid)
+
+        # index each role by its least shared group, get_roles only
+        # has to check the roles indexed by one of the groups of the user
+        self.role_keys = {}
+        for roleid in self.role2groups:
+            if not self.role2groups[roleid]:
+                continue
+            key = min(
+                self.role2groups[roleid],
+                key=lambda bg: (len(self.group2roles[bg[0]][bg[1]]), bg),
+                )
+            if key not in self.role_keys:
+                self.role_keys[key] = []
+            self.role_keys[key].append(roleid)
+
+    def _get_containers(self, roleid):
+        """get the roles containing at least all the groups of roleid"""
+        groups = self.role2groups[roleid]
+        if not groups:
+            return set(self.flatten)
+        # intersect the roles of each group, smallest first
+        candidates = sorted(
+            (self.group2roles[b][g] for b, g in groups),
+            key=len,
+            )
+        ret = set(candidates[0])
+        for roles in candidates[1:]:
+            ret.intersection_update(roles)
+            if not ret:
+                break
+        return ret
+
     def _nest(self):
         """nests the roles (creates roles hierarchy)"""
         self._flatten()
-        parent_roles = {}
         for roleid in self.flatten:
-            role = copy.deepcopy(self.flatten[roleid])
+            role = self.flatten[roleid]
 
             # Display name is mandatory
             if 'display_name' not in role:
@@ -135,52 +182,50 @@ class Roles:
             for backend in role['backends_groups']:
                 self.backends.add(backend)
 
-            if roleid not in self.graph:
-                self.graph[roleid] = {
-                    'parent_roles': set([]),
-                    'sub_roles': set([])
-                    }
+            self.graph[roleid] = {
+                'parent_roles': set([]),
+                'sub_roles': set([])
+                }
+
+        self._index()
+
+        # roles are ordered like in self.flatten
+        order = {}
+        for roleid in self.flatten:
+            order[roleid] = len(order)
 
         # Create the nested groups
+        # (only the roles sharing all the groups of a role are candidates)
+        parent_roles = {}
+        for roleid in self.flatten:
+            candidates = sorted(self._get_containers(roleid), key=order.get)
+            parents = [
+                roleid2 for roleid2 in candidates
+                if self._is_parent(roleid, roleid2)
+                ]
+            parent_roles[roleid] = parents
+            for roleid2 in parents:
+                self.graph[roleid2]['parent_roles'].add(roleid)
+                self.graph[roleid]['sub_roles'].add(roleid2)
+
+        # transitive reduction, only keep the direct parents
+        # (the ones which are not parent of another parent)
+        direct_parents = {}
+        for roleid in parent_roles:
+            indirect = set([])
+            for p in parent_roles[roleid]:
+                indirect.update(parent_roles[p])
+            direct_parents[roleid] = [
+                p for p in parent_roles[roleid] if p not in indirect
+                ]
+
+        # build each node once, sub trees are shared between nodes
+        for roleid in self.flatten:
+            self.roles[roleid] = dict(self.flatten[roleid])
         for roleid in self.flatten:
-            role = copy.deepcopy(self.flatten[roleid])
-            # create reverse groups 2 roles
-            for b in role['backends_groups']:
-                for g in role['backends_groups'][b]:
-                    if b not in self.group2roles:
-                        self.group2roles[b] = {}
-                    if g not in self.group2roles[b]:
-                        self.group2roles[b][g] = set([])
-                    self.group2roles[b][g].add(roleid)
-
-            parent_roles[roleid] = []
-            for roleid2 in self.flatten:
-                role2 = copy.deepcopy(self.flatten[roleid2])
-                if self._is_parent(roleid, roleid2):
-                    parent_roles[roleid].append(roleid2)
-                    self.graph[roleid2]['parent_roles'].add(roleid)
-                    self.graph[roleid]['sub_roles'].add(roleid2)
-
-        for r in parent_roles:
-            for p in parent_roles[r]:
-                for p2 in parent_roles[r]:
-                    if p != p2 and p in parent_roles[p2]:
-                        parent_roles[r].remove(p)
-
-        def nest(p):
-            ret = copy.deepcopy(self.flatten[p])
-            ret['subroles'] = {}
-            if len(parent_roles[p]) == 0:
-                return ret
-            else:
-                for i in parent_roles[p]:
-                    sub = nest(i)
-                    ret['subroles'][i] = sub
-                return ret
-
-        for p in parent_roles.keys():
-            if p in parent_roles:
-                self.roles[p] = nest(p)
+            self.roles[roleid]['subroles'] = dict(
+                (p, self.roles[p]) for p in direct_parents[roleid]
+                )
 
         for roleid in self.roles:
             role = self.roles[roleid]
@@ -200,59 +245,6 @@ class Roles:
         """dump the nested role hierarchy"""
         return yaml.dump(self.flatten, Dumper=CustomDumper)
 
-    def _check_member(
-            self, role, groups, notroles,
-            roles, parentroles, usedgroups):
-
-        # if we have already calculate user is not member of role
-        # return False
-        if role in notroles:
-            return False
-
-        # if we have already calculate that user is already member, skip
-        # role membership calculation
-        # (parentroles is a list of roles that the user is member of by
-        # being member of one of their subroles)
-        if not (role in parentroles or role in roles):
-            for b in self.roles[role]['backends_groups']:
-                for g in self.roles[role]['backends_groups'][b]:
-                    if b not in groups:
-                        notroles.add(role)
-                        return False
-                    if g not in groups[b]:
-                        notroles.add(role)
-                        return False
-
-        # add groups of the role to usedgroups
-        for b in self.roles[role]['backends_groups']:
-            if b not in usedgroups:
-                usedgroups[b] = set([])
-            for g in self.roles[role]['backends_groups'][b]:
-                usedgroups[b].add(g)
-
-        flag = True
-        # recursively determine if user is member of any subrole
-        for subrole in self.roles[role]['subroles']:
-            flag = flag and not \
-                self._check_member(
-                    subrole,
-                    groups,
-                    notroles,
-                    roles,
-                    parentroles,
-                    usedgroups,
-                    )
-        # if not, add role to the list of roles
-        if flag:
-            roles.add(role)
-        # else remove it from the list of roles and add
-        # it to the list of parentroles
-        else:
-            if role in roles:
-                roles.remove(role)
-            parentroles.add(role)
-        return True
-
     def get_groups_to_remove(self, current_roles, roles_to_remove):
         """get groups to remove from list of
         roles to remove and current roles
@@ -301,27 +293,28 @@ class Roles:
 
     def get_roles(self, groups):
         """get list of roles and list of standalone groups"""
-        roles = set([])
-        parentroles = set([])
-        notroles = set([])
-        tmp = set([])
-        usedgroups = {}
-        unusedgroups = {}
-        ret = {}
-        # determine roles membership
-        for role in self.roles:
-            if self._check_member(
-                    role, groups, notroles,
-                    tmp, parentroles, usedgroups):
-                roles.add(role)
-        # determine standalone groups not matching any roles
+        user_groups = set([])
         for b in groups:
             for g in groups[b]:
-                if b not in usedgroups or g not in usedgroups[b]:
-                    if b not in unusedgroups:
-                        unusedgroups[b] = set([])
-                    unusedgroups[b].add(g)
+                user_groups.add((b, g))
+
+        # the user is member of a role if all its groups are present
+        roles = set(self.always_roles)
+        usedgroups = set([])
+        for key in user_groups:
+            for role in self.role_keys.get(key, []):
+                if self.role2groups[role].issubset(user_groups):
+                    roles.add(role)
+                    usedgroups.update(self.role2groups[role])
 
+        # determine standalone groups not matching any roles
+        unusedgroups = {}
+        for b, g in user_groups.difference(usedgroups):
+            if b not in unusedgroups:
+                unusedgroups[b] = set([])
+            unusedgroups[b].add(g)
+
+        ret = {}
         ret['roles'] = roles
         ret['unusedgroups'] = unusedgroups
         return ret
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Benchmark of the attributes recovered by the membership lookups
+# (authentication, get_groups()) on a synthetic directory with large
+# groups: all the user attributes (empty attribute list, as done before)
+# against no attribute at all ('1.1').
+# The directory is simulated, the bytes of the returned values stand
+# for the bytes on the wire.
+#
+# usage: PYTHONPATH=. python misc/benchmark_attrlists.py \
+#     [<members per group> [<groups>]]
+
+from __future__ import print_function
+
+import sys
+import timeit
+from contextlib import contextmanager
+
+from ldapcherry.backend.backendLdap import Backend, NO_ATTR
+
+CONFIG = {
+    'display_name': 'ldap',
+    'uri': 'ldap://ldap.ldapcherry.org',
+    'binddn': 'cn=ldapcherry,dc=example,dc=org',
+    'password': 'password',
+    'userdn': 'ou=People,dc=example,dc=org',
+    'groupdn': 'ou=Groups,dc=example,dc=org',
+    'user_filter_tmpl': '(uid=%(username)s)',
+    'group_filter_tmpl': '(member=%(userdn)s)',
+    'search_filter_tmpl': '(|(uid=%(searchstring)s*)(sn=%(searchstring)s*))',
+    'objectclasses': 'top, person',
+    'dn_user_attr': 'uid',
+    'group_attr.member': '%(dn)s',
+}
+ATTRS = ['cn', 'sn', 'uid', 'mail', 'userPassword']
+ITERATIONS = 20
+
+
+class Directory(object):
+    """ldap client answering from a synthetic directory,
+    with every user member of every group"""
+
+    def __init__(self, members, groups):
+        self.transferred = 0
+        self.user = (
+            b'uid=user0,ou=People,dc=example,dc=org',
+            {
+                'cn': [b'User 0'],
+                'sn': [b'User'],
+                'uid': [b'user0'],
+                'mail': [b'user0@example.org'],
+                'userPassword': [b'{SSHA}' + b'x' * 32],
+            },
+        )
+        member = [
+            ('uid=user%d,ou=People,dc=example,dc=org' % i).encode('ascii')
+            for i in range(members)
+        ]
+        self.groups = [
+            (
+                ('cn=group%d,ou=Groups,dc=example,dc=org' % i).encode('ascii'),
+                {
+                    'cn': [('group%d' % i).encode('ascii')],
+                    'objectClass': [b'top', b'groupOfNames'],
+                    'member': member,
+                },
+            )
+            for i in range(groups)
+        ]
+
+    def _project(self, entry, attrlist):
+        """the entry as returned for **attrlist**"""
+        if attrlist == ['1.1']:
+            attrs = {}
+        elif not attrlist or '*' in attrlist:
+            attrs = entry[1]
+        else:
+            attrs = dict([(a, entry[1][a]) for a in attrlist
+                          if a in entry[1]])
+        for values in attrs.values():
+            self.transferred += sum([len(v) for v in values])
+        return (entry[0], attrs)
+
+    def search_s(self, basedn, scope, searchfilter, attrlist=None):
+        if basedn == CONFIG['userdn']:
+            entries = [self.user]
+        else:
+            entries = self.groups
+        return [self._project(entry, attrlist) for entry in entries]
+
+
+class FakePool(object):
+
+    def __init__(self, client):
+        self.client = client
+
+    @contextmanager
+    def connection(self):
+        yield self.client
+
+
+def bench(name, backend, client):
+    start = timeit.default_timer()
+    for i in range(ITERATIONS):
+        backend.get_groups('user0')
+    elapsed = timeit.default_timer() - start
+    print('%-30s %10.3f ms/call %12d bytes/call' % (
+        name,
+        elapsed * 1000 / ITERATIONS,
+        client.transferred / ITERATIONS,
+    ))
+
+
+def main():
+    args = [int(a) for a in sys.argv[1:]]
+    members = (args[0:1] or [20000])[0]
+    groups = (args[1:2] or [10])[0]
+    print('%d groups of %d members' % (groups, members))
+    for name, attrlist in [('all attributes (legacy)', []),
+                           ('no attribute (1.1)', None)]:
+        backend = Backend(CONFIG, None, 'ldap', ATTRS, 'uid')
+        # disable the logging
+        backend._logger = lambda **kwargs: None
+        if attrlist is not None:
+            backend._attrlists[NO_ATTR] = attrlist
+        client = Directory(members, groups)
+        backend.pool = FakePool(client)
+        bench(name, backend, client)
+
+
+if __name__ == '__main__':
+    main()
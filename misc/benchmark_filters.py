@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Benchmark of the search filters generation (formatting and escaping
+# of the filter templates on each call against compiled templates),
+# and of the encode/decode round trip of a search.
+#
+# usage: PYTHONPATH=. python misc/benchmark_filters.py [<iterations>]
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import sys
+import timeit
+import ldap.filter
+
+from ldapcherry.backend.backendAD import Backend as ADBackend
+from ldapcherry.backend.ldapfilter import FilterTemplate
+
+AD_CONFIG = {
+    'display_name': 'AD',
+    'domain': 'dc.ldapcherry.org',
+    'login': 'administrator',
+    'password': 'password',
+    'uri': 'ldap://ad.ldapcherry.org',
+}
+ATTRS = ['cn', 'sn', 'givenName', 'sAMAccountName', 'mail', 'unicodePwd']
+SEARCHSTRINGS = ['jo', 'john', 'j*(w)', 'smith\\', 'Jérôme']
+ENTRY = (
+    b'CN=John Watson,OU=Users,OU=dc,DC=dc,DC=ldapcherry,DC=org',
+    {
+        'cn': [b'John Watson'],
+        'sn': [b'Watson'],
+        'givenName': [b'John'],
+        'sAMAccountName': [b'jwatson'],
+        'mail': [b'jwatson@ldapcherry.org'],
+    },
+)
+
+
+def legacy(tmpl, searchstring):
+    """filter generation as done before compiled templates"""
+    searchstring = ldap.filter.escape_filter_chars(searchstring)
+    return tmpl % {'searchstring': searchstring}
+
+
+def bench(name, func, iterations):
+    start = timeit.default_timer()
+    for i in range(iterations):
+        for searchstring in SEARCHSTRINGS:
+            func(searchstring)
+    elapsed = timeit.default_timer() - start
+    print('%-40s %8.3f us/call' %
+          (name, elapsed * 1000000 / (iterations * len(SEARCHSTRINGS))))
+
+
+def main():
+    iterations = int((sys.argv[1:] or [20000])[0])
+    backend = ADBackend(AD_CONFIG, None, 'ad', ATTRS, 'sAMAccountName')
+    tmpl = backend.search_filter_tmpl
+    compiled = FilterTemplate(tmpl)
+    print('template: %d characters, compiled: %d characters' %
+          (len(tmpl), len(compiled.template)))
+
+    bench('format + escape_filter_chars',
+          lambda s: legacy(tmpl, s), iterations)
+    bench('compiled template',
+          lambda s: compiled.fill({'searchstring': s}), iterations)
+    bench('backend _search_filter()',
+          backend._search_filter, iterations)
+
+    def round_trip(searchstring):
+        backend._byte_p3(backend._search_filter(searchstring))
+        backend._search_results([ENTRY], {})
+    bench('filter encode + results decode', round_trip, iterations)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Benchmark of the roles file loading (Roles()) and of the roles
+# computation (Roles.get_roles()) on synthetic role files.
+#
+# usage: PYTHONPATH=. python misc/benchmark_roles.py [<number of roles> ...]
+
+from __future__ import print_function
+
+import os
+import sys
+import random
+import shutil
+import tempfile
+import timeit
+import yaml
+
+from ldapcherry.roles import Roles
+
+BACKENDS = ['ad', 'ldap']
+FANOUT = 5
+
+
+class TimedRoles(Roles):
+    """Roles measuring the time spent building the hierarchy"""
+
+    def _nest(self):
+        start = timeit.default_timer()
+        Roles._nest(self)
+        self.nest_time = timeit.default_timer() - start
+
+
+def generate(nb_roles):
+    """generate a hierarchy of roles, each role has the groups of its
+    parent plus one group per backend"""
+    roles = {}
+    for i in range(nb_roles):
+        parent = (i - 1) // FANOUT if i else None
+        backends_groups = {}
+        for b in BACKENDS:
+            groups = []
+            if parent is not None:
+                groups = list(roles['role%d' % parent]['backends_groups'][b])
+            groups.append('cn=group%d,ou=%s' % (i, b))
+            backends_groups[b] = groups
+        roles['role%d' % i] = {
+            'display_name': 'Role %d' % i,
+            'description': 'synthetic role',
+            'backends_groups': backends_groups,
+            }
+        if i and i % 100 == 0:
+            roles['role%d' % i]['LC_admins'] = True
+    return roles
+
+
+def bench(nb_roles, tmpdir):
+    roles = generate(nb_roles)
+    role_file = os.path.join(tmpdir, 'roles_%d.yml' % nb_roles)
+    with open(role_file, 'w') as f:
+        yaml.dump(roles, f)
+
+    start = timeit.default_timer()
+    inv = TimedRoles(role_file)
+    load_time = timeit.default_timer() - start
+
+    rand = random.Random(nb_roles)
+    users = []
+    for i in range(100):
+        role = roles['role%d' % rand.randrange(nb_roles)]
+        groups = dict(
+            (b, role['backends_groups'][b] + ['not a role group'])
+            for b in BACKENDS
+            )
+        users.append(groups)
+    start = timeit.default_timer()
+    for groups in users:
+        inv.get_roles(groups)
+    roles_time = (timeit.default_timer() - start) / len(users)
+
+    print('%6d roles: load %8.3f s (nesting %8.3f s),'
+          ' get_roles %8.3f ms' %
+          (nb_roles, load_time, inv.nest_time, roles_time * 1000))
+
+
+def main():
+    sizes = [int(s) for s in sys.argv[1:]] or [100, 1000, 5000]
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for nb_roles in sizes:
+            bench(nb_roles, tmpdir)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -26,7 +26,8 @@ if sys.version_info[0] == 2:
         'CherryPy >= 3.0.0,< 18.0.0',
         'python-ldap',
         'PyYAML',
-        'Mako'
+        'Mako',
+        'futures'
         ],
 elif sys.version_info[0] == 3:
     install_requires = [
@@ -125,7 +126,10 @@ setup(
         ],
     data_files=resources_files,
     entry_points = {
-        'console_scripts': ['ldapcherryd = ldapcherry.cli:main']
+        'console_scripts': [
+            'ldapcherryd = ldapcherry.cli:main',
+            'ldapcherry-bulk = ldapcherry.bulk:main',
+        ]
     },
     url='https://github.com/kakwa/ldapcherry',
     license=license,
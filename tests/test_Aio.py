@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import with_statement
+from __future__ import unicode_literals
+
+import pytest
+import sys
+import cherrypy
+import logging
+
+if sys.version < '3':
+    pytest.skip("asyncio backends are python 3 only", allow_module_level=True)
+
+import asyncio
+import ldap
+from ldapcherry.backend.aio import get_async_backend, SyncBackendAdapter
+from ldapcherry.backend.aioLdap import AsyncBackend
+from ldapcherry.backend.backendDemo import Backend as DemoBackend
+from ldapcherry.backend.backendLdap import Backend as LdapBackend
+from ldapcherry.exceptions import *
+
+cfg_demo = {
+    'display_name': 'test',
+    'admin.groups': 'grp1, grp2',
+    'basic.groups': 'grp1, grp2, grp3',
+    'pwd_attr': 'userPassword',
+    'search_attributes': 'uid',
+}
+
+cfg_ldap = {
+    'module': 'ldapcherry.backend.ldap',
+    'groupdn': 'ou=groups,dc=example,dc=org',
+    'userdn': 'ou=People,dc=example,dc=org',
+    'binddn': 'cn=dnscherry,dc=example,dc=org',
+    'password': 'password',
+    'uri': 'ldap://ldap.dnscherry.org:390',
+    'starttls': 'off',
+    'checkcert': 'off',
+    'user_filter_tmpl': '(uid=%(username)s)',
+    'group_filter_tmpl': '(member=%(userdn)s)',
+    'search_filter_tmpl': '(|(uid=%(searchstring)s*)(sn=%(searchstring)s*))',
+    'objectclasses': 'top, person',
+    'dn_user_attr': 'uid',
+    'group_attr.member': "%(dn)s",
+    'display_name': 'My Test Ldap',
+}
+
+
+def syslog_error(msg='', context='',
+        severity=logging.INFO, traceback=False):
+    pass
+
+cherrypy.log.error = syslog_error
+attr = ['cn', 'uid', 'sn', 'userPassword']
+
+
+class AsyncClient(object):
+    """fake ldap client answering the asynchronous requests
+    on the second poll"""
+
+    def __init__(self):
+        self.requests = []
+        self._answers = {}
+        self._polled = set([])
+
+    def _answer(self, ret):
+        self.requests.append(ret)
+        msgid = len(self.requests)
+        self._answers[msgid] = ret
+        return msgid
+
+    def search_ext(self, basedn, scope, searchfilter, attrlist=None,
+                   serverctrls=None):
+        if basedn == cfg_ldap['userdn']:
+            data = [
+                ('uid=jwatson,ou=People,dc=example,dc=org',
+                 {'uid': [b'jwatson'], 'sn': [b'watson']}),
+                (None, ['ldap://other.example.org/']),
+            ]
+        else:
+            data = [('cn=itpeople,ou=Groups,dc=example,dc=org', {})]
+        return self._answer((ldap.RES_SEARCH_RESULT, data, None, []))
+
+    def simple_bind(self, who, cred):
+        if cred != 'secret':
+            return self._answer(ldap.INVALID_CREDENTIALS({}))
+        return self._answer((97, [], None, []))
+
+    def result3(self, msgid, all=1, timeout=None):
+        if msgid not in self._polled:
+            self._polled.add(msgid)
+            return (None, None, None, None)
+        ret = self._answers.pop(msgid)
+        if isinstance(ret, Exception):
+            raise ret
+        return ret
+
+    def fileno(self):
+        # no socket, the connection is polled
+        raise ValueError()
+
+    def unbind_s(self):
+        pass
+
+
+class DownClient(AsyncClient):
+    """fake ldap client of a server down"""
+
+    def simple_bind(self, who, cred):
+        raise ldap.SERVER_DOWN({'desc': "Can't contact LDAP server"})
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class TestError(object):
+
+    def testAdapter(self):
+        inv = DemoBackend(cfg_demo, cherrypy.log, 'demo', attr, 'uid')
+        backend = get_async_backend(inv)
+        assert isinstance(backend, SyncBackendAdapter)
+
+        async def scenario():
+            assert await backend.auth('admin', 'admin')
+            assert not await backend.auth('admin', 'notapassword')
+            user = await backend.get_user('admin')
+            users = await backend.search('admin')
+            return user, users
+        user, users = run(scenario())
+        assert user['uid'] == 'admin'
+        assert 'admin' in users
+
+    def testAdapterErrors(self):
+        inv = DemoBackend(cfg_demo, cherrypy.log, 'demo', attr, 'uid')
+        backend = get_async_backend(inv)
+        with pytest.raises(UserDoesntExist):
+            run(backend.get_user('notauser'))
+
+    def testLdapConcurrent(self):
+        inv = LdapBackend(cfg_ldap, cherrypy.log, 'ldap', attr, 'uid')
+        binds = []
+        client = AsyncClient()
+
+        def bind(servers=None):
+            binds.append(client)
+            return client
+        inv._bind = bind
+        backend = get_async_backend(inv)
+        assert isinstance(backend, AsyncBackend)
+
+        async def scenario():
+            return await asyncio.gather(*(
+                [backend.get_user('jwatson') for i in range(50)] +
+                [backend.get_groups('jwatson'), backend.search('jwat')]
+            ))
+        ret = run(scenario())
+        # a single connection carries all the requests
+        assert len(binds) == 1
+        assert ret[0] == {'uid': 'jwatson', 'sn': 'watson'}
+        assert ret[50] == ['cn=itpeople,ou=Groups,dc=example,dc=org']
+        assert list(ret[51]) == ['jwatson']
+
+    def testLdapAuth(self):
+        inv = LdapBackend(cfg_ldap, cherrypy.log, 'ldap', attr, 'uid')
+        inv._bind = lambda servers=None: AsyncClient()
+        inv._connect = lambda server=None: AsyncClient()
+        backend = get_async_backend(inv)
+        assert run(backend.auth('jwatson', 'secret'))
+        assert not run(AsyncBackend(inv).auth('jwatson', 'wrong'))
+
+    def testLdapAuthFailover(self):
+        cfg2 = dict(cfg_ldap)
+        cfg2['uri'] = 'ldap://ldap1.example.org ldap://ldap2.example.org'
+        cfg2['servers.probe_interval'] = 0
+        inv = LdapBackend(cfg2, cherrypy.log, 'ldap', attr, 'uid')
+        ldap1, ldap2 = inv.servers.servers
+        inv._bind = lambda servers=None: AsyncClient()
+
+        def connect(server=None):
+            if server is ldap1:
+                return DownClient()
+            return AsyncClient()
+        inv._connect = connect
+        backend = AsyncBackend(inv)
+        assert run(backend.auth('jwatson', 'secret'))
+        assert ldap1.failures == 1 and ldap2.latency is not None
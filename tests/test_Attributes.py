@@ -45,6 +45,12 @@ class TestError(object):
         expected.sort()
         assert ret == expected
 
+    def testGetBackendDisplayedAttributes(self):
+        inv = Attributes('./tests/cfg/attributes.yml')
+        ret = inv.get_backend_displayed_attributes('ldap')
+        expected = ['cn', 'givenName', 'sn', 'uid']
+        assert ret == expected
+
     def testGetKey(self):
         inv = Attributes('./tests/cfg/attributes.yml')
         ret = inv.get_key()
@@ -11,6 +11,8 @@ from ldapcherry.exceptions import *
 from disable import travis_disabled
 import cherrypy
 import logging
+import ldap
+from contextlib import contextmanager
 if sys.version < '3':
     from sets import Set as set
 
@@ -55,6 +57,59 @@ default_user2 = {
 
 default_groups = ['Domain Admins', 'Backup Operators']
 
+basedn = 'dc=DC,DC=LDAPCHERRY,DC=ORG'
+userdn = 'CN=jwatson,OU=Users,OU=DC,' + basedn
+groups_entries = {
+    b'\x01\x02': ('CN=itpeople,OU=Users,OU=DC,' + basedn,
+                  {'cn': [b'itpeople']}),
+    b'\x03\x04': ('CN=Backup Operators,CN=Builtin,' + basedn,
+                  {'cn': [b'Backup Operators']}),
+}
+
+
+class FakeClient(object):
+    """fake ad client, recording the searches"""
+
+    def __init__(self):
+        self.searches = []
+        self.answers = {}
+
+    def search_s(self, base, scope, searchfilter, attrlist=None):
+        self.searches.append((base, searchfilter, attrlist))
+        if base == userdn:
+            return [(userdn, {'tokenGroups': list(groups_entries)})]
+        return [(userdn, {
+            'sAMAccountName': [b'jwatson'],
+            'cn': [b'jwatson'],
+            'memberOf': [
+                groups_entries[b'\x01\x02'][0],
+                groups_entries[b'\x03\x04'][0],
+                'CN=other,OU=Groups,' + basedn,
+            ],
+        })]
+
+    def search_ext(self, base, scope, searchfilter, attrlist=None):
+        self.searches.append((base, searchfilter, attrlist))
+        msgid = len(self.searches)
+        self.answers[msgid] = [
+            entry for entry in groups_entries.values()
+            if entry[0].endswith(base)
+        ] + [(None, ['ldap://other.example.org/'])]
+        return msgid
+
+    def result3(self, msgid):
+        return (101, self.answers.pop(msgid), msgid, [])
+
+
+class FakePool(object):
+
+    def __init__(self, client):
+        self.client = client
+
+    @contextmanager
+    def connection(self):
+        yield self.client
+
 
 class TestError(object):
 
@@ -202,3 +257,74 @@ class TestError(object):
             return
         else:
             raise AssertionError("expected an exception")
+
+    def testGetGroupsModes(self):
+        expected = ['Backup Operators', 'itpeople']
+        for mode, searches in [('search', 3), ('memberof', 1),
+                               ('tokengroups', 4)]:
+            cfg2 = cfg.copy()
+            cfg2['membership_mode'] = mode
+            inv = Backend(cfg2, cherrypy.log, 'ad', attr, 'sAMAccountName')
+            client = FakeClient()
+            inv.pool = FakePool(client)
+            assert sorted(inv.get_groups('jwatson')) == expected
+            assert len(client.searches) == searches
+            # both group searches are in flight at once
+            assert client.answers == {}
+        # tokenGroups sids are escaped byte by byte
+        assert client.searches[-1][1] == \
+            '(|(objectSid=\\01\\02)(objectSid=\\03\\04))'
+
+    def testWrongMembershipMode(self):
+        cfg2 = cfg.copy()
+        cfg2['membership_mode'] = 'notamode'
+        with pytest.raises(WrongParamValue):
+            Backend(cfg2, cherrypy.log, 'ad', attr, 'sAMAccountName')
+
+    def testGetGroupsInChain(self):
+        cfg2 = cfg.copy()
+        cfg2['membership_mode'] = 'inchain'
+        inv = Backend(cfg2, cherrypy.log, 'ad', attr, 'sAMAccountName')
+        client = FakeClient()
+        inv.pool = FakePool(client)
+        expected = ['Backup Operators', 'itpeople']
+        assert sorted(inv.get_groups('jwatson')) == expected
+        assert client.searches[-1][1] == \
+            '(member:1.2.840.113556.1.4.1941:=' + userdn + ')'
+        assert len(client.searches) == 3
+        # expanded membership is cached...
+        assert sorted(inv.get_groups('jwatson')) == expected
+        assert len(client.searches) == 3
+        # ...until the groups of the user change
+        inv.del_from_groups('jwatson', [])
+        client.searches = []
+        assert sorted(inv.get_groups('jwatson')) == expected
+        assert len(client.searches) == 3
+
+    def testAuthFailover(self):
+        cfg2 = cfg.copy()
+        cfg2['uri'] = 'ldaps://ad1.ldapcherry.org ldaps://ad2.ldapcherry.org'
+        cfg2['servers.probe_interval'] = 0
+        inv = Backend(cfg2, cherrypy.log, 'ad', attr, 'sAMAccountName')
+        ad1, ad2 = inv.servers.servers
+        binds = []
+
+        class BindClient(object):
+            def __init__(self, server):
+                self.server = server
+
+            def simple_bind_s(self, who, cred):
+                binds.append(self.server)
+                if self.server is ad1:
+                    raise ldap.SERVER_DOWN({'desc': "Can't contact server"})
+                if cred != 'secret':
+                    raise ldap.INVALID_CREDENTIALS({})
+
+            def unbind_s(self):
+                pass
+        inv._connect = lambda server=None: BindClient(server)
+        assert inv.auth('jwatson', 'secret')
+        # the server down is tried last
+        assert not inv.auth('jwatson', 'wrong')
+        assert binds == [ad1, ad2, ad2]
+        assert ad1.failures == 1 and ad2.failures == 0
@@ -95,6 +95,18 @@ class TestError(object):
         expected = ['default_user', 'default_user2']
         assert set(ret.keys()) == set(expected)
 
+    def testSearchUserPaged(self):
+        cfg2 = cfg.copy()
+        cfg2['search.page_size'] = 1
+        inv = Backend(cfg2, cherrypy.log, 'test', attr, 'uid')
+        inv.add_user(default_user)
+        inv.add_user(default_user2)
+        page, cookie = inv.search_page('default')
+        assert list(page.keys()) == ['default_user']
+        page, cookie = inv.search_page('default', cookie)
+        assert list(page.keys()) == ['default_user2']
+        assert cookie is None
+
     def testAddUser(self):
         try:
             inv.del_user(u'test☭')
@@ -6,12 +6,17 @@ from __future__ import unicode_literals
 
 import pytest
 import sys
-from ldapcherry.backend.backendLdap import Backend, CaFileDontExist
+import time
+from ldapcherry.backend.backendLdap import Backend, CaFileDontExist, \
+    DISPLAYED_ATTRS, ALL_ATTRS, NO_ATTR, MEMBERSHIP_ATTRS, MAX_CURSORS, \
+    MAX_SKIP
 from ldapcherry.exceptions import *
 from disable import travis_disabled
 import cherrypy
 import logging
 import ldap
+from contextlib import contextmanager
+from ldap.controls import SimplePagedResultsControl
 if sys.version < '3':
     from sets import Set as set
 
@@ -42,6 +47,139 @@ def syslog_error(msg='', context='',
 cherrypy.log.error = syslog_error
 attr = ['shéll', 'shell', 'cn', 'uid', 'uidNumber', 'gidNumber', 'home', 'userPassword', 'givenName', 'email', 'sn']
 
+class CountingClient(object):
+    """fake ldap client counting the searches"""
+
+    def __init__(self):
+        self.searches = []
+        self.attrlists = []
+        self.modifications = []
+        self.modified = []
+        self.renamed = []
+
+    def search_s(self, basedn, scope, searchfilter, attrlist=None):
+        self.searches.append((basedn, searchfilter))
+        self.attrlists.append(attrlist)
+        if basedn == cfg['userdn']:
+            return [(
+                'uid=jwatson,ou=People,dc=example,dc=org',
+                {'uid': [b'jwatson'], 'sn': [b'watson'], 'cn': [b'John']},
+            )]
+        return [('cn=itpeople,ou=Groups,dc=example,dc=org', {})]
+
+    def modify_s(self, dn, ldif):
+        self.modified.append((dn, ldif))
+
+    def rename_s(self, dn, newrdn):
+        self.renamed.append((dn, newrdn))
+
+    def modify_ext(self, dn, ldif):
+        self.modifications.append((dn, ldif))
+        return len(self.modifications)
+
+    def result3(self, msgid):
+        return (ldap.RES_MODIFY, [], msgid, [])
+
+
+class MemberOfClient(CountingClient):
+    """fake ldap client of a directory with the memberof overlay"""
+
+    def search_s(self, basedn, scope, searchfilter, attrlist=None):
+        r = CountingClient.search_s(self, basedn, scope, searchfilter,
+                                    attrlist)
+        if basedn == cfg['userdn']:
+            r[0][1]['memberOf'] = [
+                b'cn=itpeople,ou=Groups,dc=example,dc=org',
+                b'cn=app,ou=Apps,dc=example,dc=org',
+            ]
+        return r
+
+
+class ReplicaClient(CountingClient):
+    """fake ldap client of one of several servers"""
+
+    def __init__(self, server, down):
+        CountingClient.__init__(self)
+        self.ldapcherry_server = server
+        self.down = down
+
+    def _check(self):
+        if self.ldapcherry_server.uri in self.down:
+            raise ldap.SERVER_DOWN({'desc': "Can't contact LDAP server"})
+
+    def simple_bind_s(self, who, cred):
+        self._check()
+
+    def search_s(self, basedn, scope, searchfilter, attrlist=None):
+        self._check()
+        return CountingClient.search_s(self, basedn, scope, searchfilter,
+                                       attrlist)
+
+    def unbind_s(self):
+        pass
+
+
+class PagedClient(CountingClient):
+    """fake ldap client answering paged searches"""
+
+    def __init__(self, users):
+        CountingClient.__init__(self)
+        self.users = users
+        self.answers = {}
+        self.unbound = False
+
+    def search_ext(self, basedn, scope, searchfilter, attrlist=None,
+                   serverctrls=None):
+        control = serverctrls[0]
+        start = int(control.cookie or 0)
+        end = start + control.size
+        entries = [
+            ('uid=%s,ou=People,dc=example,dc=org' % u,
+             {'uid': [u.encode('utf-8')], 'sn': [b'Smith']})
+            for u in self.users[start:end]
+        ]
+        cookie = str(end) if end < len(self.users) else ''
+        msgid = len(self.answers) + 1
+        self.answers[msgid] = [
+            (ldap.RES_SEARCH_ENTRY, entries, msgid, []),
+            (ldap.RES_SEARCH_RESULT, [], msgid, [
+                SimplePagedResultsControl(True, size=0, cookie=cookie)
+            ]),
+        ]
+        return msgid
+
+    def result3(self, msgid, all=1, timeout=None):
+        if msgid in self.answers:
+            return self.answers[msgid].pop(0)
+        return CountingClient.result3(self, msgid)
+
+    def simple_bind_s(self, who, cred):
+        pass
+
+    def unbind_s(self):
+        self.unbound = True
+
+
+class FakePool(object):
+
+    def __init__(self, client):
+        self.client = client
+
+    @contextmanager
+    def connection(self):
+        yield self.client
+
+
+@contextmanager
+def fake_request():
+    request = cherrypy._cprequest.Request(None, None)
+    request.app = True
+    cherrypy.serving.load(request, None)
+    try:
+        yield request
+    finally:
+        cherrypy.serving.clear()
+
 class TestError(object):
 
     def testNominal(self):
@@ -154,12 +292,59 @@ class TestError(object):
         inv.del_from_groups(u'jwatsoné', ['cn=hrpeople,ou=Groups,dc=example,dc=org'])
         assert ret == ['cn=itpeople,ou=Groups,dc=example,dc=org', 'cn=hrpeople,ou=Groups,dc=example,dc=org']
 
+    def testAddDeleteGroupsCheckMembership(self):
+        cfg2 = cfg.copy()
+        cfg2['groups.check_membership'] = 'on'
+        inv = Backend(cfg2, cherrypy.log, 'ldap', attr, 'uid')
+        groups = [
+           'cn=hrpeople,ou=Groups,dc=example,dc=org',
+           'cn=itpeople,ou=Groups,dc=example,dc=org',
+        ]
+        inv.add_to_groups(u'jwatsoné', groups)
+        ret = inv.get_groups(u'jwatsoné')
+        inv.del_from_groups(u'jwatsoné', ['cn=hrpeople,ou=Groups,dc=example,dc=org'])
+        inv.del_from_groups(u'jwatsoné', ['cn=hrpeople,ou=Groups,dc=example,dc=org'])
+        assert ret == ['cn=itpeople,ou=Groups,dc=example,dc=org', 'cn=hrpeople,ou=Groups,dc=example,dc=org']
+        assert inv.get_groups(u'jwatsoné') == ['cn=itpeople,ou=Groups,dc=example,dc=org']
+
     def testSearchUser(self):
         inv = Backend(cfg, cherrypy.log, 'ldap', attr, 'uid')
         ret = inv.search('smith')
         expected = {'ssmith': {'sn': 'smith', 'uid': 'ssmith', 'cn': 'Sheri Smith', 'userPassword': 'passwordsmith'}, 'jsmith': {'sn': 'Smith', 'uid': 'jsmith', 'cn': 'John Smith', 'userPassword': 'passwordsmith'}}
         assert ret == expected
 
+    def testSearchUserPaged(self):
+        cfg2 = cfg.copy()
+        cfg2['search.page_size'] = 1
+        inv = Backend(cfg2, cherrypy.log, 'ldap', attr, 'uid')
+        ret = {}
+        pages = 0
+        cookie = None
+        while True:
+            page, cookie = inv.search_page('smith', cookie)
+            assert len(page) <= 1
+            ret.update(page)
+            pages += 1
+            if cookie is None:
+                break
+        assert pages == 2
+        assert ret == inv.search('smith')
+
+    def testSearchUserStream(self):
+        inv = Backend(cfg, cherrypy.log, 'ldap', attr, 'uid')
+        ret = list(inv.search_stream('smith'))
+        assert ret[-1] == (None, None)
+        assert dict(ret[:-1]) == inv.search('smith')
+
+    def testSearchUserMaxResults(self):
+        cfg2 = cfg.copy()
+        cfg2['search.page_size'] = 1
+        cfg2['search.max_results'] = 1
+        inv = Backend(cfg2, cherrypy.log, 'ldap', attr, 'uid')
+        assert len(inv.search('smith')) == 1
+        page, cookie = inv.search_page('smith')
+        assert len(page) == 1 and cookie is None
+
     def testAddUser(self):
         try:
             inv.del_user(u'test☭,cn=')
@@ -247,3 +432,312 @@ class TestError(object):
         else:
             inv.del_user(u'test☭')
             raise AssertionError("expected an exception")
+
+    def testUserLookupOncePerRequest(self):
+        inv = Backend(cfg, cherrypy.log, 'ldap', attr, 'uid')
+        client = CountingClient()
+        inv.pool = FakePool(client)
+        groups = ['cn=hrpeople,ou=Groups,dc=example,dc=org']
+        with fake_request():
+            inv.set_attrs(u'jwatson', {'sn': u'Watson'})
+            inv.get_groups(u'jwatson')
+            inv.add_to_groups(u'jwatson', groups)
+            inv.del_from_groups(u'jwatson', groups)
+        user_searches = [s for s in client.searches if s[0] == cfg['userdn']]
+        assert len(user_searches) == 1
+
+    def testFullLookupAfterPartialLookup(self):
+        inv = Backend(cfg, cherrypy.log, 'ldap', attr, 'uid')
+        client = CountingClient()
+        inv.pool = FakePool(client)
+        with fake_request():
+            inv._get_user(u'jwatson', NO_ATTR)
+            assert inv.get_user(u'jwatson')['sn'] == u'watson'
+            inv.add_to_groups(u'jwatson', [])
+            inv.set_attrs(u'jwatson', {'sn': u'Watson'})
+        # the dn only entry doesn't have the attributes
+        assert client.attrlists[:2] == [['1.1'], None]
+
+    def testGetUserUnwrapped(self):
+        inv = Backend(cfg, cherrypy.log, 'ldap', attr, 'uid')
+        client = CountingClient()
+        inv.pool = FakePool(client)
+        expected = {u'uid': u'jwatson', u'sn': u'watson', u'cn': u'John'}
+        with fake_request():
+            assert inv.get_user(u'jwatson') == expected
+            inv.set_attrs(u'jwatson', {u'cn': u'Johnny'})
+            # from the request cache, updated by set_attrs()
+            expected[u'cn'] = u'Johnny'
+            assert inv.get_user(u'jwatson') == expected
+        assert len(client.searches) == 1
+
+    def testGetUsers(self):
+        inv = Backend(cfg, cherrypy.log, 'ldap', attr, 'uid')
+        client = CountingClient()
+        inv.pool = FakePool(client)
+        ret = inv.get_users([u'jwatson', u'jsmith'])
+        assert ret == {u'jwatson': {
+            u'uid': u'jwatson', u'sn': u'watson', u'cn': u'John'}}
+        # one search for all the users
+        assert len(client.searches) == 1
+        assert client.searches[0][1].startswith('(|(')
+        assert inv.get_users([]) == {}
+
+    def testGroupsCheckMembership(self):
+        cfg2 = cfg.copy()
+        cfg2['groups.check_membership'] = 'on'
+        inv = Backend(cfg2, cherrypy.log, 'ldap', attr, 'uid')
+        client = CountingClient()
+        inv.pool = FakePool(client)
+        groups = [
+           'cn=hrpeople,ou=Groups,dc=example,dc=org',
+           'cn=itpeople,ou=Groups,dc=example,dc=org',
+        ]
+        with fake_request():
+            # already member of itpeople
+            inv.add_to_groups(u'jwatson', groups)
+            assert [m[0] for m in client.modifications] == groups[:1]
+            client.modifications = []
+            # not member of hrpeople
+            inv.del_from_groups(u'jwatson', groups)
+            assert [m[0] for m in client.modifications] == groups[1:]
+        group_searches = [s for s in client.searches
+                          if s[0] == cfg['groupdn']]
+        assert len(group_searches) == 2
+
+    def testSetAttrsSingleModify(self):
+        inv = Backend(cfg, cherrypy.log, 'ldap', attr, 'uid')
+        client = CountingClient()
+        inv.pool = FakePool(client)
+        with fake_request():
+            # unchanged attributes are not sent
+            inv.set_attrs(u'jwatson', {u'uid': u'jwatson', u'cn': u'John'})
+            assert client.modified == []
+            assert client.renamed == []
+            inv.set_attrs(u'jwatson', {
+                u'uid': u'jwatson',
+                u'cn': u'Johnny',
+                u'sn': u'Watson',
+                u'mail': u'jwatson@example.org',
+                })
+        assert client.renamed == []
+        assert len(client.modified) == 1
+        attrs = sorted(set([m[1] for m in client.modified[0][1]]))
+        assert attrs == ['cn', 'mail', 'sn']
+
+    def testFilterEscapedOnce(self):
+        cfg2 = cfg.copy()
+        cfg2['group_filter_tmpl'] = \
+            '(|(member=%(userdn)s)(memberUid=%(username)s))'
+        inv = Backend(cfg2, cherrypy.log, 'ldap', attr, 'uid')
+        client = CountingClient()
+        inv.pool = FakePool(client)
+        inv.get_groups('j*(w)')
+        assert [s[1] for s in client.searches] == [
+            '(uid=j\\2a\\28w\\29)',
+            '(|(member=uid=jwatson,ou=People,dc=example,dc=org)'
+            '(memberUid=j\\2a\\28w\\29))',
+            ]
+
+    def testDecodeEntry(self):
+        inv = Backend(cfg, cherrypy.log, 'ldap', attr, 'uid')
+        photo = b'\xff\xd8\xff\xe0'
+        entry = ('uid=jwatson,ou=People,dc=example,dc=org', {
+            'uid': [b'jwatson'],
+            'cn': [b'John Watson', b'J. Watson'],
+            'sn': [b'Wats\xc3\xb6n'],
+            'jpegPhoto': [photo],
+            })
+        user, attrs = inv._search_result(entry)
+        assert user == 'jwatson'
+        assert attrs['sn'] == 'Watsön'
+        assert attrs['cn'] == ['John Watson', 'J. Watson']
+        # attributes not in attributes.yml are left as they are
+        assert attrs['jpegPhoto'] is photo
+
+    def testDisplayedAttrs(self):
+        inv = Backend(cfg, cherrypy.log, 'ldap', attr, 'uid')
+        assert inv._attrlist(DISPLAYED_ATTRS) == inv.attrlist
+        inv.set_displayed_attrs(['sn', 'cn'])
+        assert inv._attrlist(DISPLAYED_ATTRS) == ['sn', 'cn', 'uid']
+        assert inv._attrlist(ALL_ATTRS) is None
+        # uid and sn of the search filter are still returned
+        assert inv.search_refiner.refinable
+        inv.set_displayed_attrs(['cn'])
+        assert not inv.search_refiner.refinable
+
+    def testAttrlists(self):
+        inv = Backend(cfg, cherrypy.log, 'ldap', attr, 'uid')
+        client = CountingClient()
+        inv.pool = FakePool(client)
+        inv.get_groups('jwatson')
+        # neither the user nor the groups attributes are transferred
+        assert client.attrlists == [['1.1'], ['1.1']]
+        assert inv._attrlist(MEMBERSHIP_ATTRS) == ['1.1']
+        cfg2 = cfg.copy()
+        cfg2['group_attr.memberUid'] = '%(uid)s'
+        inv = Backend(cfg2, cherrypy.log, 'ldap', attr, 'uid')
+        assert inv._attrlist(MEMBERSHIP_ATTRS) == ['uid']
+        assert inv._attrlist(ALL_ATTRS) is None
+
+    def testGetGroupsMemberOf(self):
+        cfg2 = cfg.copy()
+        cfg2['membership_mode'] = 'memberof'
+        inv = Backend(cfg2, cherrypy.log, 'ldap', attr, 'uid')
+        client = MemberOfClient()
+        inv.pool = FakePool(client)
+        with fake_request():
+            # the dn lookup of auth() recovers memberOf
+            inv._get_user(u'jwatson', NO_ATTR)
+            ret = inv.get_groups(u'jwatson')
+        assert ret == ['cn=itpeople,ou=Groups,dc=example,dc=org']
+        assert client.attrlists == [['memberOf']]
+        # outside of a request
+        assert inv.get_groups(u'jwatson') == ret
+        assert inv._attrlist(ALL_ATTRS) == ['*', 'memberOf']
+
+    def testWrongMembershipMode(self):
+        cfg2 = cfg.copy()
+        cfg2['membership_mode'] = 'tokengroups'
+        with pytest.raises(WrongParamValue):
+            Backend(cfg2, cherrypy.log, 'ldap', attr, 'uid')
+
+    def testConnectionOptions(self):
+        inv = Backend(cfg, cherrypy.log, 'ldap', attr, 'uid')
+        assert inv.options == [
+            (ldap.OPT_REFERRALS, 0),
+            (ldap.OPT_TIMEOUT, 10),
+            (ldap.OPT_NETWORK_TIMEOUT, 10),
+            ]
+        cfg2 = cfg.copy()
+        cfg2['uri'] = 'ldaps://ldap.ldapcherry.org:637'
+        cfg2['checkcert'] = 'on'
+        cfg2['network_timeout'] = 2
+        inv = Backend(cfg2, cherrypy.log, 'ldap', attr, 'uid')
+        assert inv.options == [
+            (ldap.OPT_REFERRALS, 0),
+            (ldap.OPT_TIMEOUT, 10),
+            (ldap.OPT_NETWORK_TIMEOUT, 2),
+            (ldap.OPT_X_TLS_CACERTFILE, cfg['ca']),
+            (ldap.OPT_X_TLS_REQUIRE_CERT, ldap.OPT_X_TLS_DEMAND),
+            (ldap.OPT_X_TLS_NEWCTX, 0),
+            ]
+
+    def testFailover(self):
+        cfg2 = cfg.copy()
+        cfg2['uri'] = 'ldap://ldap1.example.org, ldap://ldap2.example.org'
+        cfg2['servers.probe_interval'] = 0
+        inv = Backend(cfg2, cherrypy.log, 'ldap', attr, 'uid')
+        ldap1, ldap2 = inv.servers.servers
+        down = set([])
+        opened = []
+
+        def connect(server=None):
+            client = ReplicaClient(server or inv.servers.best(), down)
+            opened.append(client)
+            return client
+        inv._connect = connect
+        assert inv.get_groups(u'jwatson') == \
+            ['cn=itpeople,ou=Groups,dc=example,dc=org']
+        assert opened[0].ldapcherry_server is ldap1
+        # ldap1 stops, the pooled connection breaks,
+        # the search is sent again to ldap2
+        down.add(ldap1.uri)
+        assert inv.get_groups(u'jwatson') == \
+            ['cn=itpeople,ou=Groups,dc=example,dc=org']
+        assert ldap1.failures == 1 and not ldap2.ejected
+        assert opened[-1].ldapcherry_server is ldap2
+        # new connections go to ldap2
+        del opened[:]
+        inv.pool.clear()
+        inv.get_groups(u'jwatson')
+        assert [c.ldapcherry_server for c in opened] == [ldap2]
+        # both down, ldap1 ends up ejected
+        down.add(ldap2.uri)
+        for i in range(2):
+            inv.pool.clear()
+            with pytest.raises(ldap.SERVER_DOWN):
+                inv.get_groups(u'jwatson')
+        assert ldap1.ejected
+
+    def testReadWriteSplit(self):
+        cfg2 = cfg.copy()
+        del cfg2['uri']
+        cfg2['write_uri'] = 'ldap://provider.example.org'
+        cfg2['read_uris'] = 'ldap://replica.example.org'
+        cfg2['read_your_writes.ttl'] = 0.5
+        cfg2['servers.probe_interval'] = 0
+        inv = Backend(cfg2, cherrypy.log, 'ldap', attr, 'uid')
+        provider = inv.servers.servers[0]
+        replica = inv.read_servers.servers[0]
+        opened = []
+
+        def connect(server=None):
+            client = ReplicaClient(server or inv.servers.best(), set([]))
+            opened.append(client)
+            return client
+        inv._connect = connect
+        inv.get_user(u'jwatson')
+        inv.get_groups(u'jwatson')
+        assert [c.ldapcherry_server for c in opened] == [replica]
+        assert inv._read_pool() is inv.read_pool
+        # the writes go to the provider
+        inv.set_attrs(u'jwatson', {'sn': 'holmes'})
+        assert opened[-1].ldapcherry_server is provider
+        assert opened[-1].modified
+        # and the reads right after, for the modified user and the searches
+        del opened[-1].searches[:]
+        inv.get_user(u'jwatson')
+        inv.get_groups(u'jwatson')
+        assert len(opened) == 2 and len(opened[1].searches) == 3
+        assert inv._read_pool() is inv.pool
+        assert inv._read_pool(u'mmoriarty') is inv.read_pool
+        # back to the replica at the end of the window
+        time.sleep(0.6)
+        assert inv._read_pool(u'jwatson') is inv.read_pool
+        assert inv._read_pool() is inv.read_pool
+
+    def testReadWriteSame(self):
+        inv = Backend(cfg, cherrypy.log, 'ldap', attr, 'uid')
+        assert inv.read_servers is inv.servers
+        assert inv.read_pool is inv.pool
+        assert inv._read_pool(u'jwatson') is inv.pool
+
+    def testSearchPagePooled(self):
+        cfg2 = cfg.copy()
+        cfg2['search.page_size'] = 2
+        cfg2['pool.max_size'] = 3
+        inv = Backend(cfg2, cherrypy.log, 'ldap', attr, 'uid')
+        opened = []
+
+        def connect(server=None):
+            opened.append(PagedClient([u'jsmith', u'ssmith', u'tsmith']))
+            return opened[-1]
+        inv._connect = connect
+        # a finished search gives its connection back
+        page, cookie = inv.search_page('smith')
+        assert sorted(page) == [u'jsmith', u'ssmith'] and cookie
+        page, cookie = inv.search_page('smith', cookie)
+        assert sorted(page) == [u'tsmith'] and cookie is None
+        assert len(opened) == 1 and inv.pool._size == 1
+        page, cookie = inv.search_page('smith')
+        assert len(opened) == 1
+        # the unfinished searches keep their connections out of the pool,
+        # at most MAX_CURSORS of them
+        cookies = [inv.search_page('smith')[1]
+                   for i in range(MAX_CURSORS + 1)]
+        assert len(inv._cursors) == MAX_CURSORS and inv.pool._size == 0
+        assert opened[0].unbound and opened[1].unbound
+        # evicted search, started over
+        page, cookie = inv.search_page('smith', cookie)
+        assert sorted(page) == [u'tsmith'] and cookie is None
+        assert inv.pool._size == 1
+        # resumed search, its connection is given back to the pool
+        page, cookie = inv.search_page('smith', cookies[-1])
+        assert sorted(page) == [u'tsmith'] and cookie is None
+        assert len(inv._cursors) == MAX_CURSORS - 1
+        assert inv.pool._size == 2
+        # forged offsets are ignored, the search starts over
+        for offset in [-2, MAX_SKIP + 1]:
+            page, cookie = inv.search_page('smith', 'x:%d' % offset)
+            assert sorted(page) == [u'jsmith', u'ssmith']
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import with_statement
+from __future__ import unicode_literals
+
+import pytest
+import sys
+import io
+import json
+import time
+from ldapcherry.bulk import Bulk, Checkpoint, load, read_csv, read_jsonl, \
+    ExportRestarted
+from ldapcherry.exceptions import BackendTimeout
+
+
+def users_jsonl():
+    return [
+        json.dumps({'attrs': {'uid': 'jsmith', 'name': 'Smith',
+                              'password': 'Passw0rd!'},
+                    'roles': ['users']}),
+        json.dumps({'attrs': {'uid': 'jdoe', 'name': 'Doe',
+                              'password': 'short'}}),
+        json.dumps({'attrs': {'uid': 'ssmith', 'uidNumber': 'nan'}}),
+        json.dumps({'attrs': {'uid': 'tsmith'}, 'roles': ['dontexist']}),
+        'not json',
+        ]
+
+
+class TestError(object):
+
+    def testReadCsv(self):
+        f = io.StringIO('uid,name,roles\njsmith,Smith,"admin, users"\n'
+                        'jdoe,,\n')
+        items = list(read_csv(f))
+        assert items == [
+            (2, {'attrs': {'uid': 'jsmith', 'name': 'Smith'},
+                 'roles': ['admin', 'users']}),
+            (3, {'attrs': {'uid': 'jdoe'}, 'roles': []}),
+            ]
+
+    def testImport(self):
+        app = load('./tests/cfg/ldapcherry_demo.ini')
+        err = io.StringIO()
+        bulk = Bulk(app, err=err)
+        items = read_jsonl(io.StringIO('\n'.join(users_jsonl())))
+        stats = bulk.import_users(items, jobs=2)
+        assert stats == {'imported': 1, 'skipped': 0, 'errors': 4}
+        errors = err.getvalue().splitlines()
+        assert len(errors) == 4 and errors[0].startswith('line 2: ')
+        demo = app.backends['demo']
+        assert demo.users['jsmith']['sn'] == 'Smith'
+        assert demo.users['jsmith']['groups'] == set(['Test 1', 'Test 2'])
+        assert 'jdoe' not in demo.users
+
+    def testCheckpoint(self, tmpdir):
+        path = str(tmpdir.join('checkpoint'))
+        app = load('./tests/cfg/ldapcherry_demo.ini')
+        checkpoint = Checkpoint(path)
+        items = read_jsonl(io.StringIO(users_jsonl()[0]))
+        Bulk(app, err=io.StringIO()).import_users(items, 1, checkpoint)
+        checkpoint.close()
+        # resumed in a new process: already imported users are skipped
+        app = load('./tests/cfg/ldapcherry_demo.ini')
+        checkpoint = Checkpoint(path)
+        items = read_jsonl(io.StringIO(users_jsonl()[0]))
+        stats = Bulk(app).import_users(items, 1, checkpoint)
+        checkpoint.close()
+        assert stats == {'imported': 0, 'skipped': 1, 'errors': 0}
+        assert 'jsmith' not in app.backends['demo'].users
+
+    def testCheckpointSteps(self, tmpdir):
+        path = str(tmpdir.join('checkpoint'))
+        app = load('./tests/cfg/ldapcherry_demo.ini')
+        demo = app.backends['demo']
+        add_to_groups = demo.add_to_groups
+
+        def fail(username, groups):
+            raise Exception('down')
+        demo.add_to_groups = fail
+        checkpoint = Checkpoint(path)
+        items = read_jsonl(io.StringIO(users_jsonl()[0]))
+        stats = Bulk(app, err=io.StringIO()).import_users(items, 1, checkpoint)
+        checkpoint.close()
+        assert stats['errors'] == 1 and 'jsmith' in demo.users
+        # resumed: the user is not added again, only to its groups
+        demo.add_to_groups = add_to_groups
+        checkpoint = Checkpoint(path)
+        assert checkpoint.has_step('jsmith', 'user:demo')
+        items = read_jsonl(io.StringIO(users_jsonl()[0]))
+        stats = Bulk(app).import_users(items, 1, checkpoint)
+        checkpoint.close()
+        assert stats == {'imported': 1, 'skipped': 0, 'errors': 0}
+        assert demo.users['jsmith']['groups'] == set(['Test 1', 'Test 2'])
+        assert Checkpoint(path).done == set(['jsmith'])
+
+    def testExport(self):
+        app = load('./tests/cfg/ldapcherry_demo.ini')
+        items = read_jsonl(io.StringIO(users_jsonl()[0]))
+        Bulk(app, err=io.StringIO()).import_users(items)
+
+        def get_user(username, partial=False):
+            raise AssertionError('users looked up one by one')
+        app._get_user = get_user
+        out = io.StringIO()
+        count = Bulk(app, out).export_users('jsonl')
+        users = [json.loads(l) for l in out.getvalue().splitlines()]
+        assert count == 3 and len(users) == 3
+        assert {'attrs': {'uid': 'jsmith', 'name': 'Smith'},
+                'roles': ['users']} in users
+        assert {'attrs': {'uid': 'admin'}, 'roles': ['admin']} in users
+        out = io.StringIO()
+        Bulk(app, out).export_users('csv')
+        lines = out.getvalue().splitlines()
+        assert lines[0] == 'name,cn,email,uid,uidNumber,roles'
+        assert 'Smith,,,jsmith,,users' in lines
+
+    def testExportTimeout(self):
+        app = load('./tests/cfg/ldapcherry_demo.ini')
+        app.backends_timeout = 0.1
+        for b in app.backends.values():
+            b.search_page = lambda searchstring, cookie=None: \
+                time.sleep(0.5) or ({}, None)
+        out = io.StringIO()
+        # no partial export
+        with pytest.raises(BackendTimeout):
+            Bulk(app, out).export_users('jsonl')
+
+    def testExportRestarted(self):
+        app = load('./tests/cfg/ldapcherry_demo.ini')
+
+        def search_page(searchstring, page=None, partial=True):
+            # a search starting over at each page
+            return ({'admin': {'uid': 'admin'}}, 'next')
+        app._search_page = search_page
+        out = io.StringIO()
+        with pytest.raises(ExportRestarted):
+            Bulk(app, out).export_users('jsonl')
+        assert len(out.getvalue().splitlines()) == 1
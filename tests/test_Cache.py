@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import with_statement
+from __future__ import unicode_literals
+
+import pytest
+import sys
+import time
+from ldapcherry.cache import TTLCache, SearchCache
+
+
+class TestError(object):
+
+    def testHitMiss(self):
+        cache = TTLCache(10, 60)
+        assert cache.get('a') is None
+        cache.set('a', {'roles': set(['users'])})
+        assert cache.get('a') == {'roles': set(['users'])}
+        stats = cache.stats()
+        assert stats['hits'] == 1 and stats['misses'] == 1
+
+    def testCopy(self):
+        cache = TTLCache(10, 60)
+        value = {'ldap': ['group1']}
+        cache.set('a', value)
+        value['ldap'].append('group2')
+        ret = cache.get('a')
+        ret['ad'] = []
+        assert cache.get('a') == {'ldap': ['group1']}
+
+    def testLRU(self):
+        cache = TTLCache(2, 60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        assert cache.get('a') == 1
+        assert cache.get('b') is None
+        assert cache.get('c') == 3
+
+    def testTTL(self):
+        cache = TTLCache(10, 0.05)
+        cache.set('a', 1)
+        time.sleep(0.1)
+        assert cache.get('a') is None
+
+    def testDisabled(self):
+        cache = TTLCache(10, 0)
+        cache.set('a', 1)
+        assert cache.get('a') is None
+
+    def testInvalidate(self):
+        cache = TTLCache(10, 60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.invalidate('a')
+        assert cache.get('a') is None and cache.get('b') == 2
+        cache.clear()
+        assert cache.get('b') is None
+
+    def testSearchRefined(self):
+        cache = SearchCache(10, 60)
+        users = {'jsmith': {'sn': 'Smith'}, 'jdoe': {'sn': 'Doe'}}
+        cache.set_results('ldap', 'D', users)
+
+        def matcher(searchstring):
+            return lambda attrs: attrs['sn'].lower().startswith(searchstring)
+        assert cache.get_refined('ldap', 'd') == users
+        assert cache.get_refined('ad', 'd', matcher('d')) is None
+        assert cache.get_refined('ldap', 'do') is None
+        assert cache.get_refined('ldap', 'do', matcher('do')) == \
+            {'jdoe': {'sn': 'Doe'}}
+        # refined results are cached too
+        assert cache.get_refined('ldap', 'doe', matcher('doe')) == \
+            {'jdoe': {'sn': 'Doe'}}
+        stats = cache.stats()
+        assert stats['hits'] == 1 and stats['refined'] == 2
+        assert stats['misses'] == 2 and stats['size'] == 3
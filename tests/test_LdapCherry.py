@@ -12,6 +12,7 @@ import re
 from ldapcherry import LdapCherry
 from ldapcherry.exceptions import *
 from ldapcherry.pyyamlwrapper import DumplicatedKey, RelationError
+import ldapcherry.backend
 import ldapcherry.backend.backendAD
 import cherrypy
 from cherrypy.process import plugins, servers
@@ -20,6 +21,7 @@ import logging
 from ldapcherry.lclogging import *
 from disable import *
 import json
+import time
 from tidylib import tidy_document
 if sys.version < '3':
     from sets import Set as set
@@ -120,6 +122,47 @@ def htmlvalidator(page):
 class BadModule():
     pass
 
+class FakeBackend(ldapcherry.backend.Backend):
+    def __init__(self, users, delay=0, page_size=100):
+        self.config = {'search.page_size': page_size}
+        self.backend_name = 'fake'
+        self.users = users
+        self.delay = delay
+        self.auth_calls = 0
+        self.groups_calls = 0
+        self.search_calls = 0
+        self.added = []
+
+    def search(self, searchstring):
+        self.search_calls += 1
+        time.sleep(self.delay)
+        return self.users
+
+    def search_matcher(self, searchstring):
+        return lambda attrs: \
+            attrs.get('sn', '').lower().startswith(searchstring.lower())
+
+    def get_user(self, username):
+        time.sleep(self.delay)
+        return self.users.get(username, {})
+
+    def add_user(self, attrs):
+        self.added.append(attrs)
+
+    def auth(self, username, password):
+        self.auth_calls += 1
+        return username in self.users
+
+    def get_groups(self, username):
+        self.groups_calls += 1
+        return []
+
+    def del_user(self, username):
+        pass
+
+    def set_attrs(self, username, attrs):
+        self.users[username].update(attrs)
+
 class TestError(object):
 
     def testNominal(self):
@@ -373,6 +416,229 @@ class TestError(object):
 
 
 
+    def testSearchSlowBackend(self):
+        app = LdapCherry()
+        loadconf('./tests/cfg/ldapcherry.ini', app)
+        app.backends_timeout = 0.2
+        app.backends['ldap'] = FakeBackend({u'jsmith': {'sn': u'Smith'}})
+        app.backends['ad'] = FakeBackend({u'jsmith': {'sn': u'Smit'}}, 2)
+        app.notifications = {}
+        ret = app._search('smith')
+        assert ret == {u'jsmith': {'name': u'Smith'}}
+        assert len(app._empty_notification()) == 1
+
+    def testGetUserSlowBackend(self):
+        app = LdapCherry()
+        loadconf('./tests/cfg/ldapcherry.ini', app)
+        app.backends_timeout = 0.2
+        app.backends['ldap'] = FakeBackend({u'jsmith': {'sn': u'Smith'}})
+        app.backends['ad'] = FakeBackend({u'jsmith': {'sn': u'Smit'}}, 2)
+        app.notifications = {}
+        # incomplete attributes only for display
+        ret = app._get_user(u'jsmith', partial=True)
+        assert ret == {'name': u'Smith'}
+        assert len(app._empty_notification()) == 1
+        with pytest.raises(BackendTimeout):
+            app._get_user(u'jsmith')
+        # the deadline also applies with a single backend
+        del app.backends['ad']
+        app.backends['ldap'].delay = 2
+        with pytest.raises(BackendTimeout):
+            app._get_user(u'jsmith')
+
+    def testReloadClosesBackends(self):
+        app = LdapCherry()
+        loadconf('./tests/cfg/ldapcherry.ini', app)
+        old = app.backends['ldap']
+        loadconf('./tests/cfg/ldapcherry.ini', app)
+        assert app.backends['ldap'] is not old
+        assert old.servers._stop.is_set()
+        assert not app.backends['ldap'].servers._stop.is_set()
+
+    def testSearchPage(self):
+        app = LdapCherry()
+        loadconf('./tests/cfg/ldapcherry.ini', app)
+        users = {}
+        for u in [u'jsmith', u'ssmith', u'tsmith']:
+            users[u] = {'sn': u'Smith'}
+        app.backends['ldap'] = FakeBackend(users, page_size=2)
+        app.backends['ad'] = FakeBackend({u'jsmith': {}}, page_size=2)
+        ret, page = app._search_page('smith')
+        assert sorted(ret) == [u'jsmith', u'ssmith']
+        assert page is not None
+        ret, page = app._search_page('smith', page)
+        assert sorted(ret) == [u'tsmith']
+        assert page is None
+        # the page of a token of another search.backend is invalid
+        page = app._search_page('smith')[1]
+        app.search_backend = 'ad'
+        try:
+            app._search_page('smith', page)
+        except cherrypy.HTTPError as e:
+            assert e.status == 400
+        else:
+            raise AssertionError("expected an exception")
+        app.search_backend = 'ldap'
+        try:
+            app._search_page('smith', 'notatoken')
+        except cherrypy.HTTPError as e:
+            assert e.status == 400
+        else:
+            raise AssertionError("expected an exception")
+
+    def testSearchPageSeveralBackends(self):
+        app = LdapCherry()
+        loadconf('./tests/cfg/ldapcherry.ini', app)
+        app.backends['ldap'] = FakeBackend({
+            u'jsmith': {'sn': u'Smith'},
+            u'ssmith': {'sn': u'Smith'},
+            u'tsmith': {'sn': u'Smith'},
+            }, page_size=2)
+        # the other backend pages its users differently
+        app.backends['ad'] = FakeBackend({
+            u'asmith': {'mail': u'asmith@example.org'},
+            u'ssmith': {'mail': u'ssmith@example.org'},
+            u'tsmith': {'mail': u'tsmith@example.org'},
+            }, page_size=1)
+        app.attributes.backend_attributes['ad'] = {'mail': 'email'}
+        found = {}
+        ret, page = app._search_page('smith')
+        found.update(ret)
+        ret, page = app._search_page('smith', page)
+        assert page is None
+        # each user of search.backend once, with all its attributes
+        assert not set(ret) & set(found)
+        found.update(ret)
+        assert found == {
+            u'jsmith': {'name': u'Smith'},
+            u'ssmith': {'name': u'Smith', 'email': u'ssmith@example.org'},
+            u'tsmith': {'name': u'Smith', 'email': u'tsmith@example.org'},
+            }
+        ret = list(app._search_stream('smith'))
+        assert ret[-1] == (None, (app._encode_page(u'2'), []))
+        assert dict(ret[:-1]) == {
+            u'jsmith': {'name': u'Smith'},
+            u'ssmith': {'name': u'Smith', 'email': u'ssmith@example.org'},
+            }
+
+    def testSearchCache(self):
+        app = LdapCherry()
+        loadconf('./tests/cfg/ldapcherry.ini', app)
+        users = {u'jsmith': {'sn': u'Smith'}, u'jdoe': {'sn': u'Doe'}}
+        app.backends['ldap'] = FakeBackend(users)
+        app.backends['ad'] = FakeBackend({})
+        ret, page = app._search_page('D')
+        assert sorted(ret) == [u'jdoe', u'jsmith'] and page is None
+        # refined from the results of 'D'
+        ret, page = app._search_page('do')
+        assert sorted(ret) == [u'jdoe'] and page is None
+        ret, page = app._search_page('DO')
+        assert sorted(ret) == [u'jdoe']
+        assert app.backends['ldap'].search_calls == 1
+        # only search.backend is searched
+        stats = app.search_cache.stats()
+        assert stats['misses'] == 1
+        assert stats['refined'] == 1
+        assert stats['hits'] == 1
+        assert stats['hit_rate'] == 2.0 / 3
+        # writes invalidate cached searches
+        app._invalidate_user(u'jdoe')
+        app._search_page('do')
+        assert app.backends['ldap'].search_calls == 2
+
+    def testSelfModifyInvalidatesSearches(self):
+        app = LdapCherry()
+        loadconf('./tests/cfg/ldapcherry.ini', app)
+        users = {u'jsmith': {'sn': u'Smith', 'shell': u'/bin/sh'}}
+        app.backends['ldap'] = FakeBackend(users)
+        app.backends['ad'] = FakeBackend({u'jsmith': {}})
+        app._search_page('smith')
+        cherrypy.session['_cp_username'] = u'jsmith'
+        app._selfmodify({'attrs': {'shell': u'/bin/zsh'}})
+        ret, page = app._search_page('smith')
+        assert app.backends['ldap'].search_calls == 2
+        assert users[u'jsmith']['shell'] == u'/bin/zsh'
+
+    def testApi(self):
+        app = LdapCherry()
+        loadconf('./tests/cfg/ldapcherry_test.ini', app)
+        app.backends['ldap'] = FakeBackend({u'jsmith': {'sn': u'Smith'}})
+        app.backends['ad'] = FakeBackend({})
+        cherrypy.request.json = [u'jsmith', u'jdoe']
+        ret = app.api.v1.get()['results']
+        assert ret[0]['status'] == 'ok' and ret[0]['attrs'] == {'name': u'Smith'}
+        assert ret[1]['status'] == 'error' and ret[1]['user'] == u'jdoe'
+        user = {'attr.password1': u'password☭', 'attr.password2': u'password☭', 'attr.cn': u'Test ☭ Test', 'attr.name': u'Test ☭', 'attr.uidNumber': u'1000', 'attr.gidNumber': u'1000', 'attr.home': u'/home/test', 'attr.first-name': u'Test ☭', 'attr.email': u'test@test.fr', 'attr.uid': u'test', 'role.users': u'on'}
+        mismatch = dict(user)
+        mismatch['attr.password2'] = u'other'
+        cherrypy.request.json = [user, mismatch, {'attr.sn': u'Smith'}]
+        ret = app.api.v1.add()['results']
+        assert [r['status'] for r in ret] == ['ok', 'error', 'error']
+        assert ret[1]['error'] == 'password missmatch'
+        assert len(app.backends['ldap'].added) == 1
+        cherrypy.request.json = [1]
+        try:
+            app.api.v1.delete()
+        except cherrypy.HTTPError as e:
+            assert e.status == 400
+        else:
+            raise AssertionError("expected an exception")
+
+    def testSearchStream(self):
+        app = LdapCherry()
+        loadconf('./tests/cfg/ldapcherry.ini', app)
+        app.backends_timeout = 0.5
+        app.backends['ldap'] = FakeBackend(
+            {u'jsmith': {'sn': u'Smith'}, u'ssmith': {'sn': u'Smith'}})
+        app.backends['ad'] = FakeBackend({u'jsmith': {}}, 0.1)
+        ret = list(app._search_stream('smith'))
+        assert ret[-1] == (None, (None, []))
+        assert sorted(ret[:-1]) == [
+            (u'jsmith', {'name': u'Smith'}),
+            (u'ssmith', {'name': u'Smith'}),
+            ]
+
+    def testSearchStreamHtml(self):
+        app = LdapCherry()
+        loadconf('./tests/cfg/ldapcherry.ini', app)
+        app.search_stream = True
+        app.backends_timeout = 0.2
+        app.backends['ldap'] = FakeBackend({u'jsmith': {'sn': u'Smith'}})
+        app.backends['ad'] = FakeBackend({u'ssmith': {}}, 2)
+        page = ''.join(
+            app._render_search('searchadmin.tmpl', 'smith', None, True)
+            )
+        assert cherrypy.response.stream
+        assert 'jsmith' in page and 'ssmith' not in page
+        # the slow backend didn't complete the attributes of jsmith
+        assert 'did not answer in time' in page
+        assert re.search('page=([^"]*)"', page) is None
+        htmlvalidator(page)
+
+    def testAuthOrShortCircuit(self):
+        app = LdapCherry()
+        loadconf('./tests/cfg/ldapcherry.ini', app)
+        app.auth_mode = 'or'
+        app.auth_backends_order = ['ad']
+        app.backends['ldap'] = FakeBackend({u'jsmith': {}})
+        app.backends['ad'] = FakeBackend({u'jsmith': {}})
+        ret = app._auth(u'jsmith', u'password')
+        assert ret == {'connected': True, 'isadmin': False}
+        assert app.backends['ad'].auth_calls == 1
+        assert app.backends['ldap'].auth_calls == 0
+
+    def testRolesCache(self):
+        app = LdapCherry()
+        loadconf('./tests/cfg/ldapcherry.ini', app)
+        app.backends['ldap'] = FakeBackend({u'jsmith': {}})
+        app.backends['ad'] = FakeBackend({u'jsmith': {}})
+        app._get_roles(u'jsmith')
+        app._get_roles(u'jsmith')
+        assert app.backends['ldap'].groups_calls == 1
+        app._deleteuser(u'jsmith')
+        app._get_roles(u'jsmith')
+        assert app.backends['ldap'].groups_calls == 2
+
     def testLogger(self):
         app = LdapCherry()
         loadconf('./tests/cfg/ldapcherry.ini', app)
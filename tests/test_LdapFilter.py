@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import with_statement
+from __future__ import unicode_literals
+
+import pytest
+import sys
+from ldapcherry.backend.ldapfilter import parse, evaluate, \
+    SearchRefiner, FilterError, FilterTemplate, escape
+
+ATTRS = ['uid', 'sn', 'cn', 'mail']
+TMPL = '(|(uid=%(searchstring)s*)(sn=%(searchstring)s*))'
+
+
+class TestError(object):
+
+    def testParse(self):
+        node = parse('(&(objectClass=person)(!(uid=a\\2a*))(cn=*))')
+        assert node == ('&', [
+            ('=', 'objectclass', 'person'),
+            ('!', ('sub', 'uid', ['a*', ''])),
+            ('*', 'cn'),
+            ])
+
+    def testParseError(self):
+        for f in ['uid=a', '(uid=a', '(uid=a))', '(&(uid=a)']:
+            try:
+                parse(f)
+            except FilterError:
+                pass
+            else:
+                raise AssertionError("expected an exception")
+
+    def testEvaluate(self):
+        attrs = {'uid': 'JSmith', 'cn': ['John Smith', 'Johnny']}
+        assert evaluate(parse('(uid=jsm*)'), attrs)
+        assert evaluate(parse('(cn=*ohn*mi*)'), attrs)
+        assert not evaluate(parse('(cn=*ith*mi*)'), attrs)
+        assert evaluate(parse('(|(sn=x*)(cn=johnny))'), attrs)
+        assert not evaluate(parse('(&(uid=*)(sn=*))'), attrs)
+        assert evaluate(parse('(!(uid>=a))'), attrs) is None
+
+    def testRefiner(self):
+        refiner = SearchRefiner(TMPL, ATTRS)
+        assert refiner.refinable
+        match = refiner.matcher('(|(uid=jo*)(sn=jo*))')
+        assert match({'uid': 'john', 'sn': 'Smith'})
+        assert match({'uid': 'ssmith', 'sn': 'Jones'})
+        assert not match({'uid': 'ssmith', 'sn': 'Smith'})
+
+    def testRefinerConstant(self):
+        tmpl = '(&(objectClass=person)(uid=%(searchstring)s*))'
+        refiner = SearchRefiner(tmpl, ATTRS)
+        assert refiner.refinable
+        # objectClass is not returned, but searches only return persons
+        assert refiner.matcher('(&(objectClass=person)(uid=jo*))')(
+            {'uid': 'john'})
+
+    def testNotRefinable(self):
+        for tmpl in [
+                '(uid=%(searchstring)s)',
+                '(uid=*%(searchstring)s)',
+                '(uid=%(searchstring)s-%(searchstring)s*)',
+                '(!(uid=%(searchstring)s*))',
+                '(|(uid=%(searchstring)s*)(description=%(searchstring)s*))',
+                '(|(uid=%(searchstring)s*)(objectClass=person))',
+                '(uid~=%(searchstring)s)',
+                '(uid=%(searchstring)s*',
+                ]:
+            refiner = SearchRefiner(tmpl, ATTRS)
+            assert not refiner.refinable
+            assert refiner.matcher(tmpl % {'searchstring': 'a'}) is None
+
+    def testEscape(self):
+        assert escape('jwatson') == 'jwatson'
+        assert escape('a*(b)\\\x00') == 'a\\2a\\28b\\29\\5c\\00'
+
+    def testTemplate(self):
+        tmpl = FilterTemplate(
+            '(&(|(cn=%(searchstring)s*)(sn=%(searchstring)s*)'
+            '(cn=%(searchstring)s*))(objectClass=person)'
+            '(objectClass=person))'
+        )
+        # repeated clauses are removed
+        assert tmpl.template == \
+            '(&(|(cn=%(searchstring)s*)(sn=%(searchstring)s*))' \
+            '(objectClass=person))'
+        assert tmpl.keys == set(['searchstring'])
+        # values are escaped (once)
+        assert tmpl.fill({'searchstring': 'j*'}) == \
+            '(&(|(cn=j\\2a*)(sn=j\\2a*))(objectClass=person))'
+
+    def testTemplateNoParentheses(self):
+        tmpl = FilterTemplate('uid=%(username)s')
+        assert tmpl.fill({'username': 'jwatson'}) == '(uid=jwatson)'
+
+    def testTemplateError(self):
+        for tmpl in ['(uid=%(username)s', '(uid=%(username)d)',
+                     '(uid=%(username)s))']:
+            with pytest.raises(FilterError):
+                FilterTemplate(tmpl)
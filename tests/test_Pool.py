@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import with_statement
+from __future__ import unicode_literals
+
+import pytest
+import sys
+import time
+import threading
+from ldapcherry.backend.pool import ConnectionPool, PoolExhausted
+
+
+class ServerDown(Exception):
+    pass
+
+
+class FakeConnection(object):
+
+    def __init__(self, num):
+        self.num = num
+        self.alive = True
+        self.closed = False
+
+
+class FakeServer(object):
+
+    def __init__(self):
+        self.opened = 0
+        self.closed = 0
+        self.checked = 0
+
+    def factory(self):
+        self.opened += 1
+        return FakeConnection(self.opened)
+
+    def check(self, conn):
+        self.checked += 1
+        return conn.alive
+
+    def close(self, conn):
+        self.closed += 1
+        conn.closed = True
+
+
+def newpool(server, **kwargs):
+    return ConnectionPool(
+        'test',
+        server.factory,
+        server.check,
+        server.close,
+        broken=(ServerDown,),
+        **kwargs
+        )
+
+
+class TestError(object):
+
+    def testReuse(self):
+        server = FakeServer()
+        pool = newpool(server)
+        for i in range(10):
+            with pool.connection() as conn:
+                assert conn.num == 1
+        assert server.opened == 1
+
+    def testBounded(self):
+        server = FakeServer()
+        pool = newpool(server, max_size=2, wait_timeout=0.1)
+        c1 = pool.get()
+        c2 = pool.get()
+        try:
+            pool.get()
+        except PoolExhausted:
+            pass
+        else:
+            raise AssertionError("expected an exception")
+        pool.put(c1)
+        c3 = pool.get()
+        assert c3 is c1 and server.opened == 2
+
+    def testWaitForRelease(self):
+        server = FakeServer()
+        pool = newpool(server, max_size=1, wait_timeout=5)
+        c1 = pool.get()
+
+        def release():
+            time.sleep(0.1)
+            pool.put(c1)
+        t = threading.Thread(target=release)
+        t.start()
+        c2 = pool.get()
+        t.join()
+        assert c2 is c1 and server.opened == 1
+
+    def testIdleTimeout(self):
+        server = FakeServer()
+        pool = newpool(server, idle_timeout=0)
+        with pool.connection() as conn:
+            pass
+        time.sleep(0.01)
+        with pool.connection() as conn2:
+            pass
+        assert conn.closed and server.opened == 2
+
+    def testCheckOnCheckout(self):
+        server = FakeServer()
+        pool = newpool(server, check_interval=0)
+        with pool.connection() as conn:
+            pass
+        conn.alive = False
+        time.sleep(0.01)
+        with pool.connection() as conn2:
+            pass
+        assert server.checked == 1 and conn.closed and conn2.num == 2
+
+    def testBrokenConnection(self):
+        server = FakeServer()
+        pool = newpool(server)
+        c1 = pool.get()
+        c2 = pool.get()
+        c3 = pool.get()
+        pool.put(c2)
+        pool.put(c3)
+        try:
+            with pool.connection() as conn:
+                raise ServerDown()
+        except ServerDown:
+            pass
+        else:
+            raise AssertionError("expected an exception")
+        # the broken connection and the idle one are dropped
+        assert c2.closed and c3.closed and server.closed == 2
+        pool.put(c1)
+        with pool.connection() as conn:
+            assert conn is c1
+
+    def testFactoryFailure(self):
+        server = FakeServer()
+
+        def factory():
+            raise ServerDown()
+        pool = ConnectionPool('test', factory, server.check, server.close,
+                              max_size=1, wait_timeout=0.1)
+        for i in range(3):
+            try:
+                pool.get()
+            except ServerDown:
+                pass
+            else:
+                raise AssertionError("expected an exception")
+
+    def testDetach(self):
+        server = FakeServer()
+        pool = newpool(server, max_size=1, wait_timeout=0.1)
+        c1 = pool.get()
+        # a detached connection doesn't hold a slot of the pool
+        pool.detach(c1)
+        c2 = pool.get()
+        assert c2 is not c1 and not c1.closed
+        pool.put(c2)
+        # attached again, it's given back like the other ones
+        pool.attach(c1)
+        pool.put(c1)
+        assert pool._size == 2 and server.closed == 0
@@ -6,12 +6,60 @@ from __future__ import unicode_literals
 
 import pytest
 import sys
+import random
+import yaml
 from ldapcherry.roles import Roles
 from ldapcherry.exceptions import DumplicateRoleKey, MissingKey, DumplicateRoleContent, MissingRolesFile, MissingRole
 from ldapcherry.pyyamlwrapper import DumplicatedKey, RelationError
 if sys.version < '3':
     from sets import Set as set
 
+
+def random_roles(rand, nb_roles, backends, groups, size=3):
+    roles = {}
+    contents = set([])
+    pairs = [(b, g) for b in backends for g in groups]
+    while len(roles) < nb_roles:
+        content = tuple(sorted(rand.sample(pairs, size)))
+        # roles with identical content are rejected
+        if content in contents:
+            continue
+        contents.add(content)
+        backends_groups = {}
+        for b, g in content:
+            backends_groups.setdefault(b, []).append(g)
+        roleid = 'role%d' % len(roles)
+        roles[roleid] = {
+            'display_name': roleid,
+            'description': 'description',
+            'backends_groups': backends_groups,
+            }
+    return roles
+
+
+def reference_roles(roles, groups):
+    """naive computation: a user is member of the roles
+    whose groups are all present"""
+    ret = {'roles': set([]), 'unusedgroups': {}}
+    usedgroups = set([])
+    for roleid in roles:
+        backends_groups = roles[roleid]['backends_groups']
+        member = True
+        for b in backends_groups:
+            for g in backends_groups[b]:
+                if b not in groups or g not in groups[b]:
+                    member = False
+        if member:
+            ret['roles'].add(roleid)
+            for b in backends_groups:
+                for g in backends_groups[b]:
+                    usedgroups.add((b, g))
+    for b in groups:
+        for g in groups[b]:
+            if (b, g) not in usedgroups:
+                ret['unusedgroups'].setdefault(b, set([])).add(g)
+    return ret
+
 class TestError(object):
 
     def testNominal(self):
@@ -193,3 +241,42 @@ class TestError(object):
         }
         expected = {'unusedgroups': {'toto': set(['not a group']), 'ad': set(['Domain Users 2'])}, 'roles': set(['developpers', 'admin-lv2', 'users'])}
         assert inv.get_roles(groups) == expected
+
+    def testGetRoleRandom(self, tmpdir):
+        rand = random.Random(42)
+        backends = ['ad', 'ldap']
+        groups = ['group%d' % i for i in range(12)]
+        for i in range(20):
+            roles = random_roles(rand, 15, backends, groups)
+            role_file = tmpdir.join('roles%d.yml' % i)
+            role_file.write(yaml.dump(roles))
+            inv = Roles(str(role_file))
+            for j in range(50):
+                user_groups = {}
+                for b in backends + ['other']:
+                    user_groups[b] = rand.sample(groups, rand.randint(0, 8))
+                assert inv.get_roles(user_groups) == \
+                    reference_roles(roles, user_groups)
+
+    def testNestedChain(self, tmpdir):
+        roles = {}
+        groups = []
+        for i in range(5):
+            groups = groups + ['group%d' % i]
+            roles['role%d' % i] = {
+                'display_name': 'role%d' % i,
+                'description': 'description',
+                'backends_groups': {'ldap': groups},
+                }
+        role_file = tmpdir.join('roles.yml')
+        role_file.write(yaml.dump(roles))
+        inv = Roles(str(role_file))
+        # only the direct sub roles are nested
+        for i in range(4):
+            subroles = inv.roles['role%d' % i]['subroles']
+            assert list(subroles) == ['role%d' % (i + 1)]
+        assert inv.roles['role4']['subroles'] == {}
+        assert inv.graph['role0']['sub_roles'] == \
+            set(['role1', 'role2', 'role3', 'role4'])
+        assert inv.graph['role4']['parent_roles'] == \
+            set(['role0', 'role1', 'role2', 'role3'])
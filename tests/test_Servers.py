@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import with_statement
+from __future__ import unicode_literals
+
+import pytest
+import sys
+import time
+from ldapcherry.backend.servers import ServerSet
+
+
+class Directory(object):
+    """fake servers, answering probes unless down"""
+
+    def __init__(self):
+        self.down = set([])
+        self.probed = []
+
+    def probe(self, server):
+        self.probed.append(server.uri)
+        if server.uri in self.down:
+            raise Exception('down')
+
+
+def uris(servers):
+    return [s.uri for s in servers]
+
+
+class TestError(object):
+
+    def testFastestFirst(self):
+        servers = ServerSet('test', ['ldap://a', 'ldap://b'])
+        a, b = servers.servers
+        # not measured yet, in configuration order
+        assert uris(servers.candidates()) == ['ldap://a', 'ldap://b']
+        servers.success(a, 0.5)
+        servers.success(b, 0.1)
+        assert servers.best() is b
+        # the average follows the latency
+        for i in range(10):
+            servers.success(b, 2)
+        assert servers.best() is a
+        assert 1 < b.latency < 2
+
+    def testEjection(self):
+        servers = ServerSet('test', ['ldap://a', 'ldap://b'],
+                            max_failures=2, backoff=5, max_backoff=12)
+        a, b = servers.servers
+        servers.failure(a)
+        assert not a.ejected
+        # the servers which just failed come after the other ones
+        assert uris(servers.candidates()) == ['ldap://b', 'ldap://a']
+        servers.failure(a)
+        assert a.ejected and a.backoff == 5
+        assert a.retry_at > time.time() + 4
+        # ejected servers are only tried last
+        assert uris(servers.candidates()) == ['ldap://b', 'ldap://a']
+        # exponential backoff, bounded
+        servers.failure(a)
+        assert a.backoff == 10
+        servers.failure(a)
+        assert a.backoff == 12
+        servers.success(a)
+        assert not a.ejected and a.failures == 0 and a.backoff == 0
+
+    def testProbe(self):
+        directory = Directory()
+        servers = ServerSet('test', ['ldap://a', 'ldap://b'],
+                            directory.probe, max_failures=1, backoff=0.1,
+                            probe_interval=0)
+        a, b = servers.servers
+        directory.down.add('ldap://a')
+        servers.probe()
+        assert a.ejected and b.latency is not None
+        # ejected server not probed before the end of its ejection
+        directory.probed = []
+        servers.probe()
+        assert directory.probed == ['ldap://b']
+        time.sleep(0.2)
+        directory.down = set([])
+        servers.probe()
+        assert not a.ejected
+
+    def testProber(self):
+        directory = Directory()
+        servers = ServerSet('test', ['ldap://a', 'ldap://b'],
+                            directory.probe, probe_interval=0.01)
+        try:
+            servers.candidates()
+            deadline = time.time() + 5
+            while len(directory.probed) < 4 and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            servers.stop()
+        assert len(directory.probed) >= 4